@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Admin App Load Test
+Starts the web app under gunicorn (sync workers, as deployed) on a fixture
+tree with stand-ins for systemctl, journalctl, sudo and dhcpd, then drives
+each route with concurrent clients and reports p50/p90/p99 latency,
+throughput and errors. Runs entirely offline.
+
+Usage: python3 benchmarks/bench_admin_app.py [--workers 4] [--clients 16]
+           [--seconds 5] [--images 500] [--json results.json] [route ...]
+"""
+
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fixtures import build, percentile, save_results
+
+ROUTES = ['/', '/images', '/api/images', '/menus', '/dhcp', '/tftp', '/api/system/status']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(env, port, workers):
+    command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+               '--chdir', env['BENCH_ROOT'], '--log-level', 'warning', 'fixtures:load_app()']
+    server = subprocess.Popen(command, env={**os.environ, **env})
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            status, _ = fetch(port, '/api/images')
+            if status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not come up')
+
+
+def fetch(port, path):
+    # Sync workers close the connection after every response, like behind nginx
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request('GET', path, headers={'X-Forwarded-Prefix': '/admin'})
+        response = conn.getresponse()
+        body = response.read()
+        return response.status, len(body)
+    finally:
+        conn.close()
+
+
+def load(port, path, clients, seconds):
+    """Closed-loop load: each client issues the next request when the last returns"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def client():
+        local = []
+        failed = 0
+        while time.monotonic() < stop_at:
+            t0 = time.perf_counter()
+            try:
+                status, _ = fetch(port, path)
+                ok = status < 500
+            except OSError:
+                ok = False
+            local.append(time.perf_counter() - t0)
+            failed += not ok
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return {
+        'route': path,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the admin app on fixture data')
+    parser.add_argument('routes', nargs='*', default=ROUTES)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn sync workers')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients per route')
+    parser.add_argument('--seconds', type=float, default=5, help='load duration per route')
+    parser.add_argument('--images', type=int, default=500, help='images in the synthetic catalog')
+    parser.add_argument('--leases', type=int, default=200)
+    parser.add_argument('--command-delay', type=float, default=0.01,
+                        help='seconds each systemctl/journalctl stand-in takes')
+    parser.add_argument('--json', help='save results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        env = build(root, images=args.images, leases=args.leases, delay=args.command_delay)
+        port = free_port()
+        server = start_server(env, port, args.workers)
+        try:
+            for path in args.routes:
+                fetch(port, path)  # warm caches in at least one worker
+            print(f"Admin app load test: {args.workers} workers, {args.clients} clients, "
+                  f"{args.seconds:g}s per route, {args.images} images")
+            print(f"{'route':<22} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+            results = []
+            for path in args.routes:
+                result = load(port, path, args.clients, args.seconds)
+                results.append(result)
+                print(f"{path:<22} {result['rps']:>8.1f} {result['p50_ms']:>8.2f} {result['p90_ms']:>8.2f} "
+                      f"{result['p99_ms']:>8.2f} {result['max_ms']:>8.2f} {result['errors']:>7}")
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        save_results(args.json, 'admin_app', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Image Registry Benchmark
+Times the legacy load_images() + linear lookup + toggle against the
+cached ImageRegistry on synthetic catalogs of 100, 1k and 10k images.
+
+Usage: python3 benchmarks/bench_image_registry.py [sizes...]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+from image_registry import ImageRegistry
+
+CATEGORIES = ['ubuntu', 'debian', 'centos', 'fedora', 'custom', 'tools']
+
+
+def synthetic_images(count):
+    return [{
+        'id': f'image_{n:05d}',
+        'name': f'Image {n}',
+        'category': CATEGORIES[n % len(CATEGORIES)],
+        'type': 'live',
+        'kernel': f'assets/images/{n}/vmlinuz',
+        'initrd': f'assets/images/{n}/initrd',
+        'squashfs': f'assets/images/{n}/filesystem.squashfs',
+        'boot_args': 'boot=casper netboot=url ip=dhcp',
+        'enabled': n % 2 == 0,
+        'size': '3.2 GB',
+        'description': f'Synthetic image {n}'
+    } for n in range(count)]
+
+
+def legacy_load(path):
+    with open(path) as f:
+        return yaml.safe_load(f).get('images', [])
+
+
+def legacy_toggle(path, image_id):
+    images = legacy_load(path)
+    image = next((i for i in images if i['id'] == image_id), None)
+    image['enabled'] = not image.get('enabled', False)
+    with open(path, 'w') as f:
+        yaml.dump({'images': images}, f, default_flow_style=False)
+
+
+def timed(func, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - t0) * 1000 / repeat
+
+
+def run(count):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'images.yaml')
+        with open(path, 'w') as f:
+            yaml.dump({'images': synthetic_images(count)}, f, default_flow_style=False)
+        target = f'image_{count - 1:05d}'
+        repeat = max(3, 3000 // count)
+
+        legacy_get = timed(lambda: next(i for i in legacy_load(path) if i['id'] == target), repeat)
+        legacy_tog = timed(lambda: legacy_toggle(path, target), repeat)
+
+        registry = ImageRegistry(path)
+        cold = timed(lambda: (setattr(registry, '_key', None), registry.get(target)), repeat)
+        warm = timed(lambda: registry.get(target), repeat * 100)
+        toggle = timed(lambda: registry.update(target, enabled=not registry.get(target)['enabled']), repeat)
+
+    print(f"{count:>6} images | legacy get {legacy_get:9.3f} ms  toggle {legacy_tog:9.3f} ms | "
+          f"registry cold {cold:9.3f} ms  warm {warm * 1000:7.2f} us  toggle {toggle:9.3f} ms")
+
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or [100, 1000, 10000]
+    loader = 'libyaml' if yaml.__with_libyaml__ else 'pure Python'
+    print(f"Image registry benchmark (registry loader: {loader})")
+    for count in sizes:
+        run(count)
+
+
+if __name__ == '__main__':
+    main()
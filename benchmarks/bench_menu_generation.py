@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Menu Generation Benchmark
+Times images.yaml dump and load, and the menu compiler behind
+scripts/menu-generator.py and /api/menus/regenerate (full rewrite,
+incremental with nothing changed, incremental after one toggle), on
+synthetic catalogs of 100 to 50k images.
+
+Usage: python3 benchmarks/bench_menu_generation.py [--json results.json] [sizes...]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import yaml
+
+from fixtures import save_results, synthetic_images
+
+from image_registry import ImageRegistry
+from menu_compiler import compile_menus
+
+SIZES = [100, 1000, 10000, 50000]
+
+
+def timed(func, repeat=1):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return round(min(samples), 3)
+
+
+def run(count, options):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'images.yaml')
+        menus_dir = os.path.join(tmp, 'menus')
+        images = synthetic_images(count)
+        repeat = 3 if count <= 10000 else 1
+
+        registry = ImageRegistry(path)
+        dump = timed(lambda: registry.save(images), repeat)
+        load = timed(lambda: (setattr(registry, '_key', None), registry.images()), repeat)
+        full = timed(lambda: compile_menus(registry, '10.0.0.1', menus_dir, incremental=False,
+                                           options=options), repeat)
+        unchanged = timed(lambda: compile_menus(registry, '10.0.0.1', menus_dir, options=options), repeat)
+        target = images[-1]['id']
+        toggle = timed(lambda: registry.update(target, enabled=not registry.get(target)['enabled']), repeat)
+        after_toggle = timed(lambda: compile_menus(registry, '10.0.0.1', menus_dir, options=options))
+        menu_bytes = sum(os.path.getsize(os.path.join(menus_dir, name)) for name in os.listdir(menus_dir)
+                         if name.endswith('.ipxe'))
+        yaml_bytes = os.path.getsize(path)
+
+    return {
+        'images': count,
+        'yaml_bytes': yaml_bytes,
+        'menu_bytes': menu_bytes,
+        'yaml_dump_ms': dump,
+        'yaml_load_ms': load,
+        'toggle_ms': toggle,
+        'compile_full_ms': full,
+        'compile_unchanged_ms': unchanged,
+        'compile_after_toggle_ms': after_toggle
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time YAML load/save and menu compilation')
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES)
+    parser.add_argument('--gzip', action='store_true', help='also write precompressed .gz menus')
+    parser.add_argument('--content-addressed', action='store_true', help='hash-stamped category menus')
+    parser.add_argument('--json', help='save results to this file')
+    args = parser.parse_args()
+    options = {'gzip': args.gzip, 'content_addressed': args.content_addressed}
+
+    loader = 'libyaml' if yaml.__with_libyaml__ else 'pure Python'
+    print(f"Menu generation benchmark (YAML: {loader}, options: {options})")
+    print(f"{'images':>7} {'yaml':>9} {'dump ms':>9} {'load ms':>9} {'toggle ms':>9} "
+          f"{'full ms':>9} {'same ms':>9} {'1 chg ms':>9}")
+    results = []
+    for count in args.sizes:
+        result = run(count, options)
+        results.append(result)
+        print(f"{count:>7} {result['yaml_bytes'] / 1048576:>7.1f}MB {result['yaml_dump_ms']:>9.1f} "
+              f"{result['yaml_load_ms']:>9.1f} {result['toggle_ms']:>9.1f} {result['compile_full_ms']:>9.1f} "
+              f"{result['compile_unchanged_ms']:>9.1f} {result['compile_after_toggle_ms']:>9.1f}")
+
+    if args.json:
+        save_results(args.json, 'menu_generation', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Mirror Download Benchmark
+Serves a random file from local HTTP mirror stand-ins that honour Range
+requests, with a per-connection bandwidth cap like a real upstream, and
+compares a single stream with segmented downloads across one and two
+mirrors. Also interrupts a download halfway, resumes it and checks that
+every result matches the source digest.
+
+Usage: python3 benchmarks/bench_mirror_download.py [size_mb] [per_connection_mbps]
+"""
+
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+from jobs import Cancelled
+from mirror_download import SegmentedDownload
+
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+def make_handler(payload, rate):
+    class RangeHandler(BaseHTTPRequestHandler):
+        """GET with single-range support, ETag/If-Range and a bandwidth cap"""
+
+        protocol_version = 'HTTP/1.1'
+        etag = '"%s"' % hashlib.sha256(payload).hexdigest()[:16]
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            start, end = 0, len(payload)
+            match = RANGE_RE.match(self.headers.get('Range', ''))
+            if_range = self.headers.get('If-Range')
+            if match and (if_range is None or if_range == self.etag):
+                start = int(match.group(1))
+                end = int(match.group(2)) + 1 if match.group(2) else len(payload)
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(payload)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('ETag', self.etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            view = memoryview(payload)
+            chunk = 64 * 1024
+            started = time.monotonic()
+            sent = 0
+            try:
+                for offset in range(start, end, chunk):
+                    piece = view[offset:min(end, offset + chunk)]
+                    self.wfile.write(piece)
+                    sent += len(piece)
+                    if rate:
+                        # Pace the connection to `rate` bytes/s
+                        delay = sent / rate - (time.monotonic() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return RangeHandler
+
+
+def start_mirror(payload, rate):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(payload, rate))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/filesystem.squashfs'
+
+
+def timed(urls, dest, digest, connections, segment_mb):
+    download = SegmentedDownload(urls, dest, sha256=digest, connections=connections,
+                                 segment_size=segment_mb * 1024 * 1024)
+    started = time.perf_counter()
+    result = download.run()
+    elapsed = time.perf_counter() - started
+    download.commit()
+    return result == digest, elapsed
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    mbps = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    payload = os.urandom(size_mb * 1024 * 1024)
+    digest = hashlib.sha256(payload).hexdigest()
+    rate = mbps * 125000
+
+    servers = [start_mirror(payload, rate) for _ in range(2)]
+    urls = [url for _, url in servers]
+    print(f"{size_mb} MiB file, mirrors capped at {mbps} Mbit/s per connection")
+
+    profiles = [
+        ('single stream', urls[:1], 1, size_mb),
+        ('1 mirror, 4 segments', urls[:1], 4, 4),
+        ('1 mirror, 8 segments', urls[:1], 8, 4),
+        ('2 mirrors, 8 segments', urls, 8, 4),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        dest = os.path.join(directory, 'filesystem.squashfs')
+        for name, profile_urls, connections, segment_mb in profiles:
+            ok, elapsed = timed(profile_urls, dest, digest, connections, segment_mb)
+            print(f"{name:<24} | {'ok' if ok else 'MISMATCH':<8} | {elapsed * 1000:8.1f} ms | "
+                  f"{size_mb / elapsed:7.1f} MiB/s")
+
+        # Interrupt halfway through, then resume from the state file
+        os.unlink(dest)
+        done = [0]
+
+        def stop_halfway(stage, nbytes):
+            done[0] += nbytes
+            if done[0] >= len(payload) // 2:
+                raise Cancelled()
+
+        try:
+            SegmentedDownload(urls, dest, sha256=digest, connections=8, segment_size=4 * 1024 * 1024,
+                              progress=stop_halfway).run()
+        except Cancelled:
+            pass
+        resumed = [0]
+        download = SegmentedDownload(urls, dest, sha256=digest, connections=8, segment_size=4 * 1024 * 1024,
+                                     progress=lambda stage, n: resumed.__setitem__(0, resumed[0] + n)
+                                     if stage == 'resume' else None)
+        result = download.run()
+        download.commit()
+        print(f"{'interrupt + resume':<24} | {'ok' if result == digest else 'MISMATCH':<8} | "
+              f"resumed from {resumed[0] / (1024 * 1024):.1f} MiB")
+
+    for server, _ in servers:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
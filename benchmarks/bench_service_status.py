@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Service Status Benchmark
+Compares the legacy per-service `systemctl is-active` forks with the
+batched `systemctl show` query used by the dashboard.
+
+Usage: python3 benchmarks/bench_service_status.py [rounds]
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+from service_status import SYSTEMCTL, query_is_active, query_services
+
+UNITS = ['isc-dhcp-server', 'tftpd-hpa', 'nginx', 'knetboot-web']
+
+
+def legacy():
+    return {unit: query_is_active(unit) for unit in UNITS}
+
+
+def batched():
+    return query_services(UNITS)
+
+
+def measure(func, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"  {name:<28} mean {statistics.mean(samples):8.2f} ms   "
+          f"p50 {statistics.median(samples):8.2f} ms   p99 {p99:8.2f} ms")
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if not os.path.exists(SYSTEMCTL):
+        print("systemctl not available on this host, nothing to benchmark")
+        return
+
+    print(f"Service status probe for {len(UNITS)} units, {rounds} rounds")
+    report('per-service is-active', measure(legacy, rounds))
+    report('batched systemctl show', measure(batched, rounds))
+
+
+if __name__ == '__main__':
+    main()
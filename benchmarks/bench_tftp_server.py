@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - TFTP Server Benchmark
+Runs the built-in TFTP server on loopback and has hundreds of simulated
+clients fetch a boot file at once, comparing plain 512-byte lock-step
+transfers with negotiated blksize/windowsize. Every download is checked
+against the source file.
+
+Usage: python3 benchmarks/bench_tftp_server.py [clients] [file_kb]
+"""
+
+import asyncio
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+
+from tftp_server import ACK, DATA, ERROR, OACK, RRQ, serve
+
+PROFILES = [
+    ('lock-step 512', {}),
+    ('blksize 1432', {'blksize': '1432', 'tsize': '0'}),
+    ('blksize 1432 window 8', {'blksize': '1432', 'tsize': '0', 'windowsize': '8'}),
+    ('blksize 8192 window 16', {'blksize': '8192', 'tsize': '0', 'windowsize': '16'}),
+]
+
+
+class Client(asyncio.DatagramProtocol):
+    """Minimal RFC 1350/2347/7440 client that acks each full window"""
+
+    def __init__(self, server, filename, options, done):
+        self.server = server
+        self.filename = filename
+        self.options = options
+        self.done = done
+        self.blksize = 512
+        self.windowsize = 1
+        self.expected = 1
+        self.in_window = 0
+        self.chunks = []
+        self.peer = None
+        self.transport = None
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        packet = struct.pack('!H', RRQ) + self.filename.encode() + b'\0octet\0'
+        for name, value in self.options.items():
+            packet += name.encode() + b'\0' + value.encode() + b'\0'
+        self.request = packet
+        transport.sendto(packet, self.server)
+        self.arm()
+
+    def arm(self):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(1.0, self.on_timeout)
+
+    def on_timeout(self):
+        if self.peer is None:
+            self.transport.sendto(self.request, self.server)
+        else:
+            self.ack(self.expected - 1)
+        self.arm()
+
+    def ack(self, number):
+        self.transport.sendto(struct.pack('!HH', ACK, number & 0xFFFF), self.peer)
+
+    def datagram_received(self, packet, addr):
+        if self.done.done():
+            return
+        self.peer = self.peer or addr
+        opcode = struct.unpack('!H', packet[:2])[0]
+        if opcode == OACK:
+            fields = packet[2:].split(b'\0')[:-1]
+            accepted = dict(zip(fields[::2], fields[1::2]))
+            self.blksize = int(accepted.get(b'blksize', 512))
+            self.windowsize = int(accepted.get(b'windowsize', 1))
+            self.ack(0)
+        elif opcode == DATA:
+            number = struct.unpack('!H', packet[2:4])[0]
+            payload = packet[4:]
+            if number != self.expected & 0xFFFF:
+                self.ack(self.expected - 1)
+                self.in_window = 0
+                return
+            self.chunks.append(payload)
+            self.expected += 1
+            self.in_window += 1
+            last = len(payload) < self.blksize
+            if last or self.in_window >= self.windowsize:
+                self.in_window = 0
+                self.ack(self.expected - 1)
+            if last:
+                self.finish(b''.join(self.chunks))
+            else:
+                self.arm()
+        elif opcode == ERROR:
+            self.finish(None)
+
+    def finish(self, data):
+        self.timer.cancel()
+        self.transport.close()
+        self.done.set_result(data)
+
+
+async def fetch(server, filename, options):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    started = time.perf_counter()
+    await loop.create_datagram_endpoint(lambda: Client(server, filename, options, done),
+                                        local_addr=('127.0.0.1', 0))
+    data = await asyncio.wait_for(done, timeout=120)
+    return data, time.perf_counter() - started
+
+
+async def run_profile(address, clients, options, digest, size):
+    started = time.perf_counter()
+    results = await asyncio.gather(*(fetch(address, 'undionly.kpxe', options) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    ok = sum(1 for data, _ in results if data is not None and hashlib.sha256(data).digest() == digest)
+    durations = sorted(d for _, d in results)
+    p50 = durations[len(durations) // 2] * 1000
+    p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000
+    throughput = clients * size / elapsed / (1024 * 1024)
+    return ok, elapsed, p50, p99, throughput
+
+
+async def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    file_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    with tempfile.TemporaryDirectory() as root:
+        payload = os.urandom(file_kb * 1024)
+        with open(os.path.join(root, 'undionly.kpxe'), 'wb') as f:
+            f.write(payload)
+        digest = hashlib.sha256(payload).digest()
+
+        transport, server = await serve(root, '127.0.0.1', 0)
+        address = transport.get_extra_info('sockname')
+        print(f"{clients} concurrent clients, {file_kb} KiB file, server on {address[0]}:{address[1]}")
+        for name, options in PROFILES:
+            ok, elapsed, p50, p99, throughput = await run_profile(address, clients, options, digest, len(payload))
+            print(f"{name:<24} | {ok:>4}/{clients} ok | total {elapsed * 1000:8.1f} ms | "
+                  f"p50 {p50:8.1f} ms  p99 {p99:8.1f} ms | {throughput:7.1f} MiB/s | "
+                  f"retransmits {server.stats.snapshot()['retransmits']}")
+        transport.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Benchmark Comparison
+Compares two result files written with --json by the same benchmark and
+prints every metric side by side with the relative change. Latencies and
+timings (*_ms) are better when lower, throughput (rps) when higher;
+changes beyond the threshold are marked as regressions or improvements.
+
+Usage: python3 benchmarks/compare.py baseline.json candidate.json [--threshold 10]
+"""
+
+import argparse
+import json
+import sys
+
+# Result fields identifying a row rather than measuring it
+KEY_FIELDS = ('route', 'images')
+HIGHER_IS_BETTER = ('rps',)
+
+
+def rows(data):
+    result = {}
+    for row in data['results']:
+        key = next((f"{field}={row[field]}" for field in KEY_FIELDS if field in row), str(len(result)))
+        result[key] = row
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change to flag')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline['benchmark'] != candidate['benchmark']:
+        sys.exit(f"✗ Different benchmarks: {baseline['benchmark']} vs {candidate['benchmark']}")
+
+    print(f"{baseline['benchmark']}: {baseline['started_at']} → {candidate['started_at']}")
+    regressions = 0
+    old_rows, new_rows = rows(baseline), rows(candidate)
+    for key, old in old_rows.items():
+        new = new_rows.get(key)
+        if new is None:
+            continue
+        print(f"\n{key}")
+        for metric, before in old.items():
+            after = new.get(metric)
+            if metric in KEY_FIELDS or not isinstance(before, (int, float)) or not isinstance(after, (int, float)):
+                continue
+            change = (after - before) * 100 / before if before else 0.0
+            better = change > 0 if metric in HIGHER_IS_BETTER else change < 0
+            mark = ''
+            if abs(change) >= args.threshold and (metric.endswith('_ms') or metric in HIGHER_IS_BETTER):
+                mark = '  improved' if better else '  REGRESSED'
+                regressions += not better
+            print(f"  {metric:<26} {before:>12g} {after:>12g} {change:>+8.1f}%{mark}")
+
+    print(f"\n{regressions} regression(s) beyond {args.threshold:g}%")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
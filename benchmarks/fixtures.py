@@ -0,0 +1,185 @@
+"""
+Kapadokya NetBoot - Benchmark Fixtures
+Builds an offline knetboot tree for the benchmarks: synthetic images.yaml,
+settings and system.json, a dhcpd.leases file, and stand-in executables
+for systemctl, journalctl, sudo, uptime and dhcpd that answer from fixture
+data after a fixed delay (BENCH_COMMAND_DELAY, seconds), so pages that
+shell out cost roughly what they do on a server. Also saves results as
+JSON for benchmarks/compare.py.
+"""
+
+import json
+import os
+import platform
+import stat
+import sys
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+WEB_DIR = os.path.join(BENCH_DIR, '..', 'web')
+sys.path.insert(0, WEB_DIR)
+
+DEFAULT_COMMAND_DELAY = 0.01
+CATEGORIES = ['ubuntu', 'debian', 'centos', 'fedora', 'custom', 'tools']
+
+STAND_INS = {
+    # systemctl show -p ... -- unit...: one property block per unit
+    'systemctl': '''#!/bin/sh
+sleep "${BENCH_COMMAND_DELAY:-%(delay)s}"
+case "$1" in
+  show)
+    first=1
+    for arg in "$@"; do
+      case "$arg" in show|--no-pager|-p|--|*,*) continue ;; esac
+      [ $first -eq 1 ] || echo
+      first=0
+      printf 'Id=%%s\\nLoadState=loaded\\nActiveState=active\\nSubState=running\\n' "$arg"
+      printf 'ActiveEnterTimestamp=Mon 2025-01-06 09:00:00 UTC\\nNRestarts=0\\n'
+    done ;;
+  is-active) echo active ;;
+esac
+''',
+    # journalctl -o json: a day of RRQ/sent lines for the TFTP counters
+    'journalctl': '''#!/bin/sh
+sleep "${BENCH_COMMAND_DELAY:-%(delay)s}"
+case " $* " in
+  *" --after-cursor "*) ;;
+  *) cat "$BENCH_ROOT/journal.json" ;;
+esac
+''',
+    'sudo': '''#!/bin/sh
+exec "$@"
+''',
+    'uptime': '''#!/bin/sh
+echo "up 3 days, 4 hours, 5 minutes"
+''',
+    'dhcpd': '''#!/bin/sh
+sleep "${BENCH_COMMAND_DELAY:-%(delay)s}"
+exit 0
+''',
+    'hostnamectl': '''#!/bin/sh
+echo knetboot-bench
+''',
+}
+
+
+def synthetic_images(count):
+    """Catalog entries shaped like images.yaml; every other image is enabled"""
+    return [{
+        'id': f'image_{n:05d}',
+        'name': f'Image {n}',
+        'category': CATEGORIES[n % len(CATEGORIES)],
+        'type': 'live',
+        'kernel': f'assets/images/{n}/vmlinuz',
+        'initrd': f'assets/images/{n}/initrd',
+        'squashfs': f'assets/images/{n}/filesystem.squashfs',
+        'boot_args': 'boot=casper netboot=url ip=dhcp',
+        'enabled': n % 2 == 0,
+        'size': '3.2 GB',
+        'description': f'Synthetic image {n}'
+    } for n in range(count)]
+
+
+def write_leases(path, count):
+    """dhcpd.leases with count bound leases ending in the future"""
+    now = time.time()
+    with open(path, 'w') as f:
+        for n in range(count):
+            starts = time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(now - 600))
+            ends = time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(now + 3600))
+            f.write(f"lease 10.0.{n // 250}.{n % 250 + 2} {{\n"
+                    f"  starts 1 {starts};\n  ends 1 {ends};\n"
+                    f"  binding state active;\n"
+                    f"  hardware ethernet 52:54:00:{n >> 16 & 255:02x}:{n >> 8 & 255:02x}:{n & 255:02x};\n"
+                    f"  client-hostname \"client-{n}\";\n}}\n")
+
+
+def write_journal(path, boots):
+    """journalctl -o json output for boots successful TFTP transfers"""
+    start_us = int(time.time() * 1_000_000) - boots * 1_000_000
+    with open(path, 'w') as f:
+        for n in range(boots):
+            for message in (f'RRQ from 10.0.0.{n % 250 + 2} filename undionly.kpxe',
+                            f'Client 10.0.0.{n % 250 + 2} finished undionly.kpxe, sent'):
+                f.write(json.dumps({'MESSAGE': message, '__REALTIME_TIMESTAMP': str(start_us + n * 1_000_000),
+                                    '__CURSOR': f's=bench;i={n}'}) + '\n')
+
+
+def build(root, images=500, leases=200, boots=1000, delay=DEFAULT_COMMAND_DELAY):
+    """Create the fixture tree under root and return the environment to run the app with"""
+    config_dir = os.path.join(root, 'config')
+    for directory in ('bin', 'config/menus', 'assets', 'run', 'tftp', 'iso'):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    with open(os.path.join(config_dir, 'images.yaml'), 'w') as f:
+        yaml.safe_dump({'images': synthetic_images(images)}, f, default_flow_style=False)
+    with open(os.path.join(config_dir, 'settings.yaml'), 'w') as f:
+        yaml.safe_dump({'server': {'ip': '10.0.0.1', 'name': 'knetboot-bench'}}, f)
+    with open(os.path.join(BENCH_DIR, '..', 'config', 'system.json')) as f:
+        system = json.load(f)
+    system.setdefault('imports', {})['iso_dir'] = os.path.join(root, 'iso')
+    with open(os.path.join(config_dir, 'system.json'), 'w') as f:
+        json.dump(system, f, indent=2)
+    for name in ('undionly.kpxe', 'ipxe.efi'):
+        with open(os.path.join(root, 'tftp', name), 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+
+    write_leases(os.path.join(root, 'dhcpd.leases'), leases)
+    write_journal(os.path.join(root, 'journal.json'), boots)
+    for name, script in STAND_INS.items():
+        path = os.path.join(root, 'bin', name)
+        with open(path, 'w') as f:
+            f.write(script % {'delay': delay})
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    from image_registry import ImageRegistry
+    from menu_compiler import compile_menus
+    compile_menus(ImageRegistry(os.path.join(config_dir, 'images.yaml')), '10.0.0.1',
+                  os.path.join(config_dir, 'menus'))
+
+    return {
+        'BENCH_ROOT': root,
+        'BENCH_COMMAND_DELAY': str(delay),
+        'KNETBOOT_BASE_DIR': root,
+        'KNETBOOT_RUN_DIR': os.path.join(root, 'run'),
+        'KNETBOOT_TFTP_ROOT': os.path.join(root, 'tftp'),
+        'KNETBOOT_DHCP_LEASES': os.path.join(root, 'dhcpd.leases'),
+        'PATH': os.path.join(root, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+        'PYTHONPATH': os.pathsep.join([BENCH_DIR, WEB_DIR])
+    }
+
+
+def load_app():
+    """The Flask app wired to the fixture tree in $BENCH_ROOT (gunicorn 'fixtures:load_app()')"""
+    import service_status
+    service_status.SYSTEMCTL = os.path.join(os.environ['BENCH_ROOT'], 'bin', 'systemctl')
+    import app
+    return app.app
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def save_results(path, name, params, results):
+    """Write a run to JSON: {benchmark, params, host, started_at, results}"""
+    data = {
+        'benchmark': name,
+        'params': params,
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'libyaml': bool(yaml.__with_libyaml__)
+        },
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+    print(f"\nResults saved to {path}")
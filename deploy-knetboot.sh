@@ -121,7 +121,7 @@ echo "  ✓ Packages installed"
 
 # 2. Create directories
 echo "[2/10] Creating directory structure..."
-mkdir -p \$INSTALL_DIR/{config/{menus,themes},web,scripts,assets/{ipxe,images,kernels}}
+mkdir -p \$INSTALL_DIR/{config/{menus,themes},web,scripts,assets/{ipxe,images,kernels},iso,data}
 mkdir -p \$WEB_ROOT
 mkdir -p \$TFTP_ROOT
 
@@ -154,6 +154,9 @@ if [ ! -f "ipxe.efi" ]; then
 fi
 chmod 644 *.kpxe *.efi 2>/dev/null || true
 chown tftp:tftp * 2>/dev/null || true
+# Only root writes here; web uploads are installed by knetboot-helper
+chown root:root \$TFTP_ROOT
+chmod 755 \$TFTP_ROOT
 
 # 5. Setup Python environment
 echo "[5/10] Setting up Python environment..."
@@ -276,6 +279,9 @@ fi
 
 chmod +x \$INSTALL_DIR/web/app.py
 chown -R www-data:www-data \$INSTALL_DIR/web
+# Image assets and ISOs are uploaded/imported through the web UI; data/ holds stats history
+# and boot file uploads staged for the helper
+chown -R www-data:www-data \$INSTALL_DIR/assets \$INSTALL_DIR/iso \$INSTALL_DIR/data
 echo "  ✓ Flask app ready"
 
 # 7. Configure DHCP
@@ -337,6 +343,30 @@ server {
         proxy_set_header X-Forwarded-Prefix /admin;
     }
 
+    # Live dashboard stream (SSE) - served by knetboot-live, not the gunicorn workers
+    location = /admin/api/stream {
+        proxy_pass http://127.0.0.1:5001/stream;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_buffering off;
+        proxy_cache off;
+        proxy_read_timeout 1h;
+    }
+
+    # Resumable upload chunks: up to MAX_CHUNK_BYTES each, streamed to the app unbuffered
+    location ^~ /admin/api/uploads/ {
+        proxy_pass http://127.0.0.1:5000/api/uploads/;
+        proxy_http_version 1.1;
+        proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Prefix /admin;
+        client_max_body_size 64m;
+        proxy_request_buffering off;
+        proxy_send_timeout 300s;
+        proxy_read_timeout 300s;
+    }
+
     # Web UI root /admin (without trailing slash)
     location = /admin {
         return 301 /admin/;
@@ -346,6 +376,7 @@ server {
     location ~ ^/(?!admin/).*\.ipxe\$ {
         default_type text/plain;
         add_header Cache-Control "no-cache, must-revalidate";
+        access_log /var/log/nginx/knetboot-boot.log combined;
     }
 
     # Large assets
@@ -357,13 +388,63 @@ server {
         tcp_nodelay on;
         expires 7d;
         add_header Cache-Control "public, immutable";
+        access_log /var/log/nginx/knetboot-boot.log combined;
+    }
+
+    # Per-client menu rendered by the web app (exact match wins over the .ipxe regex)
+    location = /knetboot/client.ipxe {
+        proxy_pass http://127.0.0.1:5000/boot/menu.ipxe;
+        proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        access_log /var/log/nginx/knetboot-boot.log combined;
+    }
+
+    # Download slots for squashfs images (admission control)
+    location = /knetboot/slot.ipxe {
+        proxy_pass http://127.0.0.1:5000/boot/slot.ipxe;
+        proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        access_log /var/log/nginx/knetboot-boot.log combined;
+    }
+
+    location ^~ /knetboot/slot/ {
+        proxy_pass http://127.0.0.1:5000/boot/slot/;
+        proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        proxy_set_header X-Sendfile-Type X-Accel-Redirect;
+        proxy_set_header X-Accel-Mapping /opt/knetboot/assets/=/_knetboot/assets/;
+        proxy_buffering off;
+        access_log /var/log/nginx/knetboot-boot.log combined;
+    }
+
+    location ^~ /_knetboot/assets/ {
+        internal;
+        alias /opt/knetboot/assets/;
+        add_header Accept-Ranges bytes;
+        sendfile on;
+        tcp_nopush on;
+        tcp_nodelay on;
+        access_log /var/log/nginx/knetboot-boot.log combined;
     }
 
     # Menu files
-    location /knetboot/menus/ {
+    location ^~ /knetboot/menus/ {
         alias /opt/knetboot/config/menus/;
         default_type text/plain;
         access_log /var/log/nginx/knetboot-boot.log combined;
+        # menu-generator writes a .gz next to every menu
+        gzip_static on;
+        etag on;
+        add_header Cache-Control "no-cache";
+
+        # Hash-stamped copies never change once written
+        location ~ "\.[0-9a-f]{12}\.ipxe$" {
+            access_log /var/log/nginx/knetboot-boot.log combined;
+            add_header Cache-Control "public, max-age=31536000, immutable";
+        }
     }
 
     # HTTP Boot - TFTP Alternative (v2.3 Feature)
@@ -373,8 +454,23 @@ server {
         proxy_set_header Host \$host;
         proxy_set_header X-Real-IP \$remote_addr;
         proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        # The app answers 304s itself and lets nginx send the file
+        proxy_set_header X-Sendfile-Type X-Accel-Redirect;
+        proxy_set_header X-Accel-Mapping /srv/tftp/=/_knetboot/tftp/;
         proxy_buffering off;
-        add_header Cache-Control "no-cache, must-revalidate";
+        access_log /var/log/nginx/knetboot-boot.log combined;
+    }
+
+    # Boot file bodies, handed over by the web app with X-Accel-Redirect
+    location ^~ /_knetboot/tftp/ {
+        internal;
+        alias /srv/tftp/;
+        default_type application/octet-stream;
+        sendfile on;
+        tcp_nopush on;
+        etag off;
+        add_header ETag \$upstream_http_etag;
+        add_header Cache-Control "no-cache";
         access_log /var/log/nginx/knetboot-boot.log combined;
     }
 }
@@ -434,6 +530,7 @@ cat > \$INSTALL_DIR/config/system.json <<EOF
     "tftp": {
       "enabled": true,
       "service_name": "tftpd-hpa",
+      "engine": "tftpd-hpa",
       "root": "/srv/tftp",
       "config_path": "/etc/default/tftpd-hpa"
     },
@@ -455,6 +552,51 @@ cat > \$INSTALL_DIR/config/system.json <<EOF
     "config_dir": "\$INSTALL_DIR/config",
     "assets_dir": "\$INSTALL_DIR/assets"
   },
+  "menus": {
+    "gzip": true,
+    "content_addressed": true,
+    "broken_images": "flag"
+  },
+  "stats": {
+    "refresh_interval": 15
+  },
+  "admission": {
+    "enabled": false,
+    "max_concurrent": 8,
+    "bandwidth_mbps": 1000,
+    "per_image": {},
+    "retry_min": 2,
+    "retry_max": 30,
+    "max_wait": 900,
+    "start_timeout": 180
+  },
+  "imports": {
+    "iso_dir": "\$INSTALL_DIR/iso",
+    "workers": 2
+  },
+  "downloads": {
+    "workers": 2,
+    "connections": 8,
+    "segment_mb": 32,
+    "retries": 5,
+    "timeout": 30
+  },
+  "verify": {
+    "workers": 4
+  },
+  "profiling": {
+    "enabled": false,
+    "slow_ms": 1000
+  },
+  "boot_funnel": {
+    "nginx_log": "/var/log/nginx/knetboot-boot.log",
+    "session_timeout": 300,
+    "window_hours": 24
+  },
+  "history": {
+    "enabled": true,
+    "retention_days": {"minute": 2, "hour": 90, "day": 1825}
+  },
   "last_updated": "$(date -u +%Y-%m-%dT%H:%M:%SZ)"
 }
 EOF
@@ -473,6 +615,8 @@ images:
     enabled: true
     description: "Exit PXE and boot from local hard drive"
 EOF
+# Web UI rewrites images.yaml atomically (temp file + rename) under a lock file
+chown www-data:www-data \$INSTALL_DIR/config \$INSTALL_DIR/config/images.yaml
 
 # Create boot.ipxe
 cat > \$WEB_ROOT/boot.ipxe <<'IPXE'
@@ -498,7 +642,7 @@ echo Boot Server: \${boot_server}
 echo.
 
 set base_url http://\${boot_server}/knetboot
-chain \${base_url}/menus/main.ipxe || goto chain_failed
+chain \${base_url}/client.ipxe?mac=\${net0/mac:hexhyp}&uuid=\${uuid}&hostname=\${hostname}&platform=\${platform}&buildarch=\${buildarch} || chain \${base_url}/menus/main.ipxe || goto chain_failed
 
 :dhcp_failed
 echo DHCP failed! Press any key to retry...
@@ -569,53 +713,98 @@ chmod 664 \$INSTALL_DIR/config/menus/*.ipxe 2>/dev/null || true
 # 10. Create and enable systemd service
 echo "[10/10] Setting up systemd service..."
 
-# Add sudoers entry for www-data to run systemctl and dhcpd commands without password
-cat > /etc/sudoers.d/knetboot-web <<'SUDOERS'
-# Allow www-data to check service status
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl is-active *
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl status *
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl is-enabled *
-# Allow www-data to control DHCP service
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl start isc-dhcp-server
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl stop isc-dhcp-server
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl restart isc-dhcp-server
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl enable isc-dhcp-server
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl disable isc-dhcp-server
-# Allow www-data to manage DHCP config
-www-data ALL=(ALL) NOPASSWD: /usr/bin/tee /etc/dhcp/dhcpd.conf
-www-data ALL=(ALL) NOPASSWD: /usr/sbin/dhcpd -t -cf /etc/dhcp/dhcpd.conf
-# Allow www-data to control TFTP service
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl start tftpd-hpa
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl stop tftpd-hpa
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl restart tftpd-hpa
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl enable tftpd-hpa
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl disable tftpd-hpa
-# Allow www-data to manage TFTP config
-www-data ALL=(ALL) NOPASSWD: /usr/bin/tee /etc/default/tftpd-hpa
-# Allow www-data to manage NTP and timezone
-www-data ALL=(ALL) NOPASSWD: /usr/bin/timedatectl set-timezone *
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl restart systemd-timesyncd
-www-data ALL=(ALL) NOPASSWD: /usr/bin/tee /etc/systemd/timesyncd.conf.d/local.conf
-# Allow www-data to manage TFTP boot files (upload/delete)
-www-data ALL=(ALL) NOPASSWD: /usr/bin/cp /tmp/* /srv/tftp/*
-www-data ALL=(ALL) NOPASSWD: /usr/bin/chmod 644 /srv/tftp/*
-www-data ALL=(ALL) NOPASSWD: /usr/bin/rm -f /srv/tftp/*
-# Allow www-data to restart NGINX
-www-data ALL=(ALL) NOPASSWD: /usr/bin/systemctl restart nginx
-SUDOERS
-chmod 440 /etc/sudoers.d/knetboot-web
+# Privileged actions go through knetboot-helper (root, Unix socket) instead of sudo
+rm -f /etc/sudoers.d/knetboot-web
+# Boot funnel and TFTP statistics read the journal directly
+usermod -a -G systemd-journal www-data
+
+# The helper runs as root, so it is installed root-owned outside the web tree
+# (www-data owns \$INSTALL_DIR/web) from the uploaded sources, never from that copy
+HELPER_DIR=/usr/local/lib/knetboot
+install -d -o root -g root -m 0755 \$HELPER_DIR
+if [ -f /tmp/knetboot/web/privileged_helper.py ]; then
+    install -o root -g root -m 0644 /tmp/knetboot/web/privileged_helper.py \$HELPER_DIR/privileged_helper.py
+elif [ ! -f \$HELPER_DIR/privileged_helper.py ]; then
+    echo "  ✗ privileged_helper.py not found in /tmp/knetboot/web"
+fi
+
+cat > /etc/systemd/system/knetboot-helper.service <<EOF
+[Unit]
+Description=Kapadokya NetBoot Privileged Helper
+After=network.target
+Before=knetboot-web.service
+
+[Service]
+Type=simple
+User=root
+RuntimeDirectory=knetboot-helper
+ExecStart=/usr/bin/python3 -I \$HELPER_DIR/privileged_helper.py --socket /run/knetboot-helper/helper.sock --user www-data --group www-data --tftp-root /srv/tftp
+Restart=always
+RestartSec=2
+ProtectHome=yes
+PrivateTmp=yes
+
+[Install]
+WantedBy=multi-user.target
+EOF
 
 cat > /etc/systemd/system/knetboot-web.service <<EOF
 [Unit]
 Description=Kapadokya NetBoot Web UI
-After=network.target
+After=network.target knetboot-helper.service
+Wants=knetboot-helper.service
 
 [Service]
 Type=simple
 User=www-data
+RuntimeDirectory=knetboot
+RuntimeDirectoryPreserve=yes
 WorkingDirectory=\$INSTALL_DIR/web
 Environment="PATH=\$INSTALL_DIR/web/venv/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
-ExecStart=\$INSTALL_DIR/web/venv/bin/gunicorn -w 4 -b 127.0.0.1:5000 app:app
+# Upload chunks (up to 64 MB) are read inside one request; match the nginx upload timeouts
+ExecStart=\$INSTALL_DIR/web/venv/bin/gunicorn -w 4 -b 127.0.0.1:5000 --timeout 300 app:app
+Restart=always
+RestartSec=5
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# Live dashboard stream (Server-Sent Events), proxied by nginx at /admin/api/stream
+cat > /etc/systemd/system/knetboot-live.service <<EOF
+[Unit]
+Description=Kapadokya NetBoot Live Dashboard Stream
+After=network.target knetboot-web.service
+
+[Service]
+Type=simple
+User=www-data
+RuntimeDirectory=knetboot
+RuntimeDirectoryPreserve=yes
+WorkingDirectory=\$INSTALL_DIR/web
+ExecStart=\$INSTALL_DIR/web/venv/bin/python \$INSTALL_DIR/web/live_stream.py --address 127.0.0.1:5001 --run-dir /run/knetboot --config \$INSTALL_DIR/config/system.json
+Restart=always
+RestartSec=5
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# Optional built-in TFTP server (services.tftp.engine = "builtin" in system.json).
+# Installed but not enabled; it replaces tftpd-hpa when switched on.
+cat > /etc/systemd/system/knetboot-tftp.service <<EOF
+[Unit]
+Description=Kapadokya NetBoot TFTP Server
+After=network.target
+Conflicts=tftpd-hpa.service
+
+[Service]
+Type=simple
+User=www-data
+AmbientCapabilities=CAP_NET_BIND_SERVICE
+RuntimeDirectory=knetboot
+RuntimeDirectoryPreserve=yes
+ExecStart=/usr/bin/python3 \$INSTALL_DIR/web/tftp_server.py --root /srv/tftp --address 0.0.0.0:69 --stats /run/knetboot/tftp-transfers.json
 Restart=always
 RestartSec=5
 
@@ -637,7 +826,11 @@ systemctl stop knetboot-web 2>/dev/null || true
 systemctl enable --now isc-dhcp-server 2>&1 | grep -v "Created symlink" || true
 systemctl enable --now tftpd-hpa 2>&1 | grep -v "Created symlink" || true
 systemctl restart nginx
+systemctl enable knetboot-helper 2>&1 | grep -v "Created symlink" || true
+systemctl restart knetboot-helper
 systemctl enable --now knetboot-web 2>&1 | grep -v "Created symlink" || true
+systemctl enable knetboot-live 2>&1 | grep -v "Created symlink" || true
+systemctl restart knetboot-live
 
 # Wait for services to start
 echo "  Waiting for services to initialize..."
@@ -664,10 +857,12 @@ echo "Service Status:"
 systemctl is-active isc-dhcp-server >/dev/null && echo "  ✓ DHCP: Running" || echo "  ✗ DHCP: Failed (check: journalctl -u isc-dhcp-server)"
 systemctl is-active tftpd-hpa >/dev/null && echo "  ✓ TFTP: Running" || echo "  ✗ TFTP: Failed"
 systemctl is-active nginx >/dev/null && echo "  ✓ NGINX: Running" || echo "  ✗ NGINX: Failed"
+systemctl is-active knetboot-helper >/dev/null && echo "  ✓ Privileged helper: Running" || echo "  ✗ Privileged helper: Failed (check: journalctl -u knetboot-helper)"
 systemctl is-active knetboot-web >/dev/null && echo "  ✓ Web UI: Running" || echo "  ✗ Web UI: Failed (check: journalctl -u knetboot-web)"
+systemctl is-active knetboot-live >/dev/null && echo "  ✓ Live stream: Running" || echo "  ✗ Live stream: Failed (check: journalctl -u knetboot-live)"
 echo
 echo "Network Ports:"
-netstat -tlnp 2>/dev/null | grep -E ":(80|5000|69) " || echo "  No services listening"
+netstat -tlnp 2>/dev/null | grep -E ":(80|5000|5001|69) " || echo "  No services listening"
 echo
 REMOTE_SCRIPT
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Asset Store
+Deduplicates image assets into the content-addressed store under
+assets/.store, garbage collects blobs no image refers to and reports
+the bytes saved.
+
+Usage:
+  asset-store.py dedupe          # move catalog assets into the store
+  asset-store.py gc [--dry-run]  # remove unreferenced blobs
+  asset-store.py report          # logical vs physical bytes
+  asset-store.py verify          # hash assets and compare with checksums
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+# Shared modules live next to the web app
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'web'))
+from asset_store import AssetStore
+from asset_verify import AssetVerifier
+from image_registry import ImageRegistry
+from storage import format_bytes
+
+# Paths
+BASE_DIR = Path('/opt/knetboot')
+CONFIG_DIR = BASE_DIR / 'config'
+ASSETS_DIR = BASE_DIR / 'assets'
+IMAGES_YAML = CONFIG_DIR / 'images.yaml'
+
+def print_report(report):
+    print(f"  - Catalog assets:   {report['assets']} ({report['in_store']} in store, "
+          f"{report['unique_digests']} unique, {report['unhashed']} unhashed)")
+    print(f"  - Logical size:     {format_bytes(report['logical_bytes'])}")
+    print(f"  - On disk:          {format_bytes(report['physical_bytes'])}")
+    print(f"  - Saved:            {report['saved']}")
+    print(f"  - Store blobs:      {report['blobs']} ({format_bytes(report['blob_bytes'])})")
+    print(f"  - Unreferenced:     {report['unreferenced_blobs']} "
+          f"({format_bytes(report['unreferenced_bytes'])})")
+
+def main():
+    parser = argparse.ArgumentParser(description='Content-addressed asset store')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('dedupe', help='move catalog assets into the store and link duplicates')
+    gc_parser = sub.add_parser('gc', help='remove blobs no image refers to')
+    gc_parser.add_argument('--dry-run', action='store_true', help='only list what would be removed')
+    sub.add_parser('report', help='show logical vs physical asset bytes')
+    verify_parser = sub.add_parser('verify', help='check that every asset exists and matches its checksum')
+    verify_parser.add_argument('--workers', type=int, default=4, help='files hashed in parallel')
+    args = parser.parse_args()
+
+    images = ImageRegistry(str(IMAGES_YAML)).images()
+    store = AssetStore(BASE_DIR, ASSETS_DIR)
+
+    if args.command == 'verify':
+        report = AssetVerifier(store, workers=args.workers).check(images, hash_files=True)
+        for image_id, result in report['images'].items():
+            mark = {'ok': '✓', 'broken': '✗', 'unverified': '?'}[result['status']]
+            detail = ', '.join(result['problems'])
+            print(f"  {mark} {image_id:<24} {detail}")
+        summary = report['summary']
+        print(f"\n{summary['ok']} ok, {summary['broken']} broken, {summary['unverified']} unverified "
+              f"({format_bytes(report['hashed_bytes'])} hashed in {report['duration_ms'] / 1000:.1f}s)")
+        sys.exit(1 if summary['broken'] else 0)
+
+    if args.command == 'dedupe':
+        result = store.dedupe(images)
+        for entry in result['files']:
+            detail = entry.get('error') or (format_bytes(entry['saved']) + ' saved' if entry['saved'] else '')
+            print(f"  {entry['action']:<24} {entry['path']} {detail}")
+        print(f"\n✓ Deduplication complete, {result['saved']} freed")
+    elif args.command == 'gc':
+        result = store.gc(images, dry_run=args.dry_run)
+        if result.get('aborted'):
+            print(f"✗ Garbage collection aborted: {result['aborted']}")
+            sys.exit(1)
+        for blob in result['removed']:
+            note = f", still linked from {blob['links']} path(s)" if blob['links'] else ''
+            print(f"  {'would remove' if args.dry_run else 'removed'} {blob['digest'][:16]} "
+                  f"({format_bytes(blob['bytes'])}{note})")
+        print(f"\n✓ {len(result['removed'])} unreferenced blob(s), {result['reclaimed']} "
+              f"{'reclaimable' if args.dry_run else 'reclaimed'}")
+        return
+
+    # Hash what the report would otherwise count as unhashed
+    store.build_references(images)
+    print()
+    print_report(store.report(images))
+
+if __name__ == '__main__':
+    main()
@@ -63,7 +63,7 @@ echo.
 
 # Chain to main menu
 set base_url http://${boot_server}/knetboot
-chain ${base_url}/menus/main.ipxe || goto chain_failed
+chain ${base_url}/client.ipxe?mac=${net0/mac:hexhyp}&uuid=${uuid}&hostname=${hostname}&platform=${platform}&buildarch=${buildarch} || chain ${base_url}/menus/main.ipxe || goto chain_failed
 
 :dhcp_failed
 echo DHCP failed! Press any key to retry...
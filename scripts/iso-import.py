@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - ISO Import
+Extracts the kernel, initrd and squashfs of an Ubuntu (casper) or Debian
+(live) ISO into assets/<image id>/ without mounting it, and adds a
+disabled image entry to images.yaml.
+
+Usage:
+  iso-import.py inspect <file.iso>
+  iso-import.py import <file.iso> <image id> [--name N] [--category C] [--replace]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# Shared modules live next to the web app
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'web'))
+from image_registry import ImageRegistry
+from iso_import import IsoImportError, import_iso, inspect_iso
+from storage import format_bytes
+
+# Paths
+BASE_DIR = Path('/opt/knetboot')
+CONFIG_DIR = BASE_DIR / 'config'
+IMAGES_YAML = CONFIG_DIR / 'images.yaml'
+
+def print_plan(plan):
+    print(f"  - Volume:   {plan['volume_id']} ({plan['names']} names)")
+    print(f"  - Layout:   {plan['layout']} ({plan['boot_args']})")
+    for field, info in plan['files'].items():
+        print(f"  - {field + ':':<9} {info['path']} ({format_bytes(info['size'])})")
+
+def main():
+    parser = argparse.ArgumentParser(description='Import boot files from an ISO')
+    sub = parser.add_subparsers(dest='command', required=True)
+    inspect_parser = sub.add_parser('inspect', help='show which files would be imported')
+    inspect_parser.add_argument('iso')
+    import_parser = sub.add_parser('import', help='copy boot files and add the image to images.yaml')
+    import_parser.add_argument('iso')
+    import_parser.add_argument('image_id')
+    import_parser.add_argument('--name', help='menu name (default: ISO volume id)')
+    import_parser.add_argument('--category', default='custom')
+    import_parser.add_argument('--replace', action='store_true', help='replace an existing image entry')
+    args = parser.parse_args()
+
+    try:
+        plan = inspect_iso(args.iso)
+        print_plan(plan)
+        if args.command == 'inspect':
+            return
+
+        registry = ImageRegistry(str(IMAGES_YAML))
+        if registry.get(args.image_id) is not None and not args.replace:
+            sys.exit(f"✗ Image {args.image_id} already exists (use --replace)")
+
+        done = [0]
+        started = time.monotonic()
+
+        def progress(field, nbytes):
+            done[0] += nbytes
+            percent = done[0] * 100 // max(1, plan['total_bytes'])
+            print(f"\r  {field:<9} {percent:3d}% {format_bytes(done[0])}", end='', flush=True)
+
+        image = import_iso(args.iso, BASE_DIR, args.image_id, name=args.name, category=args.category,
+                           progress=progress)
+        registry.upsert(image)
+    except (IsoImportError, OSError) as e:
+        sys.exit(f"\n✗ {e}")
+
+    elapsed = time.monotonic() - started
+    rate = plan['total_bytes'] / elapsed if elapsed else 0
+    print(f"\n\n✓ Imported {image['name']} as {image['id']} in {elapsed:.1f}s ({format_bytes(rate)}/s)")
+    print("  Enable it in the web UI (or images.yaml) and regenerate menus")
+
+if __name__ == '__main__':
+    main()
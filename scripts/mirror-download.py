@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Mirror Download
+Refreshes an image's kernel/initrd/squashfs from the mirrors listed under
+its 'sources' in images.yaml, using parallel Range segments. Interrupted
+downloads resume on the next run. Suitable for cron.
+
+Usage:
+  mirror-download.py <image id> [--field squashfs] [--url URL ...] [--sha256 HEX]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.parse
+from pathlib import Path
+
+# Shared modules live next to the web app
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'web'))
+from image_registry import ImageRegistry
+from jobs import JobError
+from mirror_download import (DEFAULTS, SegmentedDownload, asset_sources, fetch_sha256sums,
+                             load_download_config)
+from storage import ASSET_FIELDS, format_bytes
+
+# Paths
+BASE_DIR = Path('/opt/knetboot')
+CONFIG_DIR = BASE_DIR / 'config'
+IMAGES_YAML = CONFIG_DIR / 'images.yaml'
+SYSTEM_CONFIG_JSON = CONFIG_DIR / 'system.json'
+
+def load_config():
+    try:
+        with open(SYSTEM_CONFIG_JSON) as f:
+            return load_download_config(json.load(f))
+    except (OSError, ValueError):
+        return dict(DEFAULTS)
+
+def download_field(registry, image, field, urls, sha256, sha256sums, config):
+    if not sha256 and sha256sums:
+        filename = os.path.basename(urllib.parse.urlparse(urls[0]).path)
+        sha256 = fetch_sha256sums(sha256sums, filename, config['timeout'])
+    rel_path = image.get(field) or f"assets/{image['id']}/{Path(urllib.parse.urlparse(urls[0]).path).name}"
+    dest = BASE_DIR / rel_path
+    dest.parent.mkdir(parents=True, exist_ok=True)
+
+    done = [0]
+    total = [0]
+
+    def progress(stage, nbytes):
+        done[0] += nbytes
+        percent = done[0] * 100 // max(1, total[0])
+        print(f"\r  {field:<9} {percent:3d}% {format_bytes(done[0])} / {format_bytes(total[0])}", end='', flush=True)
+
+    def on_plan(size, mirrors):
+        total[0] = size
+        print(f"  {field}: {format_bytes(size)} from {len(mirrors)} mirror(s)")
+
+    download = SegmentedDownload(urls, str(dest), sha256=sha256, connections=config['connections'],
+                                 segment_size=config['segment_mb'] * 1024 * 1024,
+                                 retries=config['retries'], timeout=config['timeout'],
+                                 progress=progress, on_plan=on_plan)
+    started = time.monotonic()
+    digest = download.run()
+    download.commit()
+    registry.set_asset(image['id'], field, rel_path, sha256=digest)
+    elapsed = time.monotonic() - started
+    print(f"\n  ✓ {rel_path} ({'verified' if sha256 else 'sha256 ' + digest[:16]}, "
+          f"{format_bytes(total[0] / elapsed if elapsed else 0)}/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh image assets from upstream mirrors')
+    parser.add_argument('image_id')
+    parser.add_argument('--field', choices=ASSET_FIELDS, help='only this asset (default: all with sources)')
+    parser.add_argument('--url', action='append', help='mirror URL, overrides images.yaml (repeatable)')
+    parser.add_argument('--sha256', help='expected SHA-256 of the file')
+    args = parser.parse_args()
+
+    config = load_config()
+    registry = ImageRegistry(str(IMAGES_YAML))
+    image = registry.get(args.image_id)
+    if image is None:
+        sys.exit(f"✗ Image {args.image_id} not found")
+
+    if args.url:
+        fields = {args.field or 'squashfs': (args.url, args.sha256, None)}
+    else:
+        fields = {f: asset_sources(image, f) for f in ([args.field] if args.field else ASSET_FIELDS)}
+        fields = {f: source for f, source in fields.items() if source[0]}
+    if not fields:
+        sys.exit(f"✗ No sources listed for {args.image_id} in images.yaml")
+
+    failed = False
+    for field, (urls, sha256, sha256sums) in fields.items():
+        try:
+            download_field(registry, image, field, urls, sha256, sha256sums, config)
+        except (JobError, OSError) as e:
+            print(f"\n  ✗ {field}: {e}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -169,6 +169,8 @@ After=network.target
 [Service]
 Type=simple
 User=www-data
+RuntimeDirectory=knetboot
+RuntimeDirectoryPreserve=yes
 WorkingDirectory=$INSTALL_DIR/web
 Environment="PATH=$INSTALL_DIR/web/venv/bin"
 ExecStart=$INSTALL_DIR/web/venv/bin/gunicorn -w 4 -b 127.0.0.1:5000 app:app
@@ -0,0 +1,266 @@
+"""
+Kapadokya NetBoot - Boot Storm Admission Control
+Hands out download slots for squashfs images so a room full of clients
+booting at once queue up instead of saturating the link. Slots, the wait
+queue and counters live in a JSON file under a lock file, shared by all
+gunicorn workers.
+"""
+
+import fcntl
+import json
+import os
+import random
+import re
+import secrets
+import tempfile
+import time
+
+from menu_compiler import image_boot_commands
+
+# 6 octets, ':' or '-' separated (iPXE ${net0/mac:hexhyp} uses dashes)
+MAC_RE = re.compile(r'^[0-9A-Fa-f]{2}([:-][0-9A-Fa-f]{2}){5}$')
+# Let iPXE fill in the MAC itself when the request did not carry a valid one
+IPXE_MAC = '${net0/mac:hexhyp}'
+
+DEFAULTS = {
+    'enabled': False,
+    # Concurrent squashfs downloads for the whole server
+    'max_concurrent': 8,
+    # Total bandwidth budget; each download is limited to its share
+    'bandwidth_mbps': 1000,
+    # {image_id: {'max_concurrent': n, 'bandwidth_mbps': m}}
+    'per_image': {},
+    # Client backoff between slot requests, in seconds
+    'retry_min': 2,
+    'retry_max': 30,
+    # After this long in the queue a client is let through regardless
+    'max_wait': 900,
+    # A granted slot is released if the download has not started by then
+    'start_timeout': 180
+}
+
+
+def load_admission_config(system_config):
+    """The 'admission' section of system.json merged over DEFAULTS"""
+    config = dict(DEFAULTS)
+    config.update(system_config.get('admission', {}) or {})
+    return config
+
+
+def _empty_state():
+    return {
+        'slots': {},
+        'queue': [],
+        'counters': {
+            'granted': 0,
+            'overflow': 0,
+            'requests': 0,
+            'wait_seconds': 0.0,
+            'downloads': 0,
+            'expired': 0
+        }
+    }
+
+
+class AdmissionControl:
+    """Slot table and FIFO wait queue for squashfs downloads"""
+
+    def __init__(self, state_path, config):
+        self.state_path = state_path
+        self.lock_path = f"{state_path}.lock"
+        self.config = config
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return _empty_state()
+
+    def save_state(self, state):
+        """Atomically write the state file"""
+        directory = os.path.dirname(self.state_path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.admission-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _locked(self, func):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.load_state()
+            result = func(state, time.time())
+            self.save_state(state)
+            return result
+
+    def limits(self, image_id):
+        """(max_concurrent, bytes/s per download) for an image"""
+        image = self.config['per_image'].get(image_id, {})
+        server_slots = max(1, int(self.config['max_concurrent']))
+        slots = max(1, min(int(image.get('max_concurrent', server_slots)), server_slots))
+        rates = [self.config['bandwidth_mbps'] * 125000 / server_slots]
+        if image.get('bandwidth_mbps'):
+            rates.append(image['bandwidth_mbps'] * 125000 / slots)
+        return slots, int(min(rates)) if all(rates) else 0
+
+    def _prune(self, state, now):
+        slots = state['slots']
+        for token in [t for t, s in slots.items() if s['expires_at'] < now]:
+            del slots[token]
+            state['counters']['expired'] += 1
+        # Clients that stopped retrying (powered off, booted elsewhere)
+        stale = now - max(60, self.config['retry_max'] * 3)
+        state['queue'] = [w for w in state['queue'] if w['last_seen'] >= stale]
+
+    def _active(self, state, image_id=None):
+        return sum(1 for s in state['slots'].values() if image_id is None or s['image'] == image_id)
+
+    def backoff(self, attempt):
+        """Exponential backoff with jitter, capped at retry_max"""
+        delay = min(self.config['retry_max'], self.config['retry_min'] * (2 ** min(attempt, 10)))
+        return max(1, int(delay * random.uniform(0.75, 1.25)))
+
+    def request_slot(self, image_id, client, attempt=0):
+        """Grant a slot to client or report its place in the queue"""
+        def decide(state, now):
+            self._prune(state, now)
+            for token, slot in state['slots'].items():
+                if slot['image'] == image_id and slot['client'] == client:
+                    return {'granted': True, 'token': token, 'overflow': slot.get('overflow', False)}
+
+            queue = state['queue']
+            waiter = next((w for w in queue if w['image'] == image_id and w['client'] == client), None)
+            if waiter is None:
+                waiter = {'image': image_id, 'client': client, 'first_seen': now}
+                queue.append(waiter)
+                state['counters']['requests'] += 1
+            waiter['last_seen'] = now
+
+            # FIFO across the whole server: a client is let in when enough
+            # slots are free for everyone ahead of it whose image has room
+            image_slots, _ = self.limits(image_id)
+            server_free = int(self.config['max_concurrent']) - self._active(state)
+            image_free = image_slots - self._active(state, image_id)
+            ahead = 0
+            ahead_same = 0
+            for other in queue:
+                if other is waiter:
+                    break
+                other_slots, _ = self.limits(other['image'])
+                if self._active(state, other['image']) < other_slots:
+                    ahead += 1
+                    if other['image'] == image_id:
+                        ahead_same += 1
+
+            waited = now - waiter['first_seen']
+            overflow = waited > self.config['max_wait']
+            if overflow or (ahead < server_free and ahead_same < image_free):
+                queue.remove(waiter)
+                token = secrets.token_hex(8)
+                state['slots'][token] = {
+                    'image': image_id,
+                    'client': client,
+                    'granted_at': now,
+                    'started_at': None,
+                    'expires_at': now + self.config['start_timeout'],
+                    'overflow': overflow
+                }
+                counters = state['counters']
+                counters['granted'] += 1
+                counters['wait_seconds'] += waited
+                if overflow:
+                    counters['overflow'] += 1
+                return {'granted': True, 'token': token, 'overflow': overflow, 'waited': waited}
+
+            return {
+                'granted': False,
+                'position': queue.index(waiter) + 1,
+                'depth': len(queue),
+                'waited': waited,
+                'delay': self.backoff(attempt)
+            }
+
+        return self._locked(decide)
+
+    def start_download(self, token, size):
+        """Mark a slot's download as started; returns the rate limit in bytes/s.
+
+        The slot is held for the time size bytes need at that rate, so it
+        frees up on its own once the client is done; size 0 (a probe that
+        sends no body) only looks up the rate. Unknown or expired tokens are
+        served anyway (0 = no limit) rather than failing a boot.
+        """
+        def start(state, now):
+            self._prune(state, now)
+            slot = state['slots'].get(token)
+            if slot is None:
+                return 0
+            _, rate = self.limits(slot['image'])
+            if not size:
+                return rate
+            if slot['started_at'] is None:
+                slot['started_at'] = now
+                state['counters']['downloads'] += 1
+            duration = size / rate if rate else size / 125000000
+            slot['expires_at'] = max(slot['expires_at'], now + duration * 1.2 + 30)
+            return rate
+
+        return self._locked(start)
+
+    def metrics(self):
+        """Live slot usage and queue depth, overall and per image"""
+        state = self.load_state()
+        now = time.time()
+        slots = [s for s in state['slots'].values() if s['expires_at'] >= now]
+        queue = state['queue']
+        by_image = {}
+        for slot in slots:
+            entry = by_image.setdefault(slot['image'], {'active': 0, 'downloading': 0, 'queued': 0})
+            entry['active'] += 1
+            if slot['started_at']:
+                entry['downloading'] += 1
+        for waiter in queue:
+            by_image.setdefault(waiter['image'], {'active': 0, 'downloading': 0, 'queued': 0})['queued'] += 1
+        for image_id, entry in by_image.items():
+            entry['max_concurrent'], entry['rate_bytes'] = self.limits(image_id)
+        counters = state['counters']
+        return {
+            'enabled': bool(self.config['enabled']),
+            'max_concurrent': self.config['max_concurrent'],
+            'bandwidth_mbps': self.config['bandwidth_mbps'],
+            'active': len(slots),
+            'queue_depth': len(queue),
+            'oldest_wait': round(now - min(w['first_seen'] for w in queue), 1) if queue else 0,
+            'avg_wait': round(counters['wait_seconds'] / counters['granted'], 1) if counters['granted'] else 0,
+            'by_image': by_image,
+            'counters': counters
+        }
+
+
+def slot_script(img, server_ip, decision, mac, attempt):
+    """iPXE script answering a slot request: boot now, or wait and ask again.
+
+    mac ends up in the retry URL of the script, so anything but a plain
+    MAC address is replaced with the iPXE variable.
+    """
+    if not mac or not MAC_RE.match(mac):
+        mac = IPXE_MAC
+    if decision['granted']:
+        squashfs = img['squashfs']
+        if squashfs.startswith('assets/'):
+            squashfs = squashfs[len('assets/'):]
+        squashfs_url = f"http://{server_ip}/knetboot/slot/{decision['token']}/{squashfs}"
+        script = "#!ipxe\n"
+        script += f"echo Download slot granted for {img['name']}\n"
+        script += f"set base_url http://{server_ip}/knetboot\n"
+        script += image_boot_commands(img, server_ip, squashfs_url)
+        script += "boot || exit 1\n"
+        return script
+
+    script = "#!ipxe\n"
+    script += (f"echo Waiting for a download slot for {img['name']} "
+               f"({decision['position']} of {decision['depth']} in queue), retrying in {decision['delay']}s\n")
+    script += f"sleep {decision['delay']}\n"
+    script += (f"chain --autofree http://{server_ip}/knetboot/slot.ipxe"
+               f"?image={img['id']}&mac={mac}&attempt={attempt + 1} || exit 1\n")
+    return script
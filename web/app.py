@@ -4,15 +4,39 @@ Kapadokya NetBoot - Web UI
 Version: 1.0 MVP
 """
 
-from flask import Flask, render_template, jsonify, request, redirect, url_for, flash, Blueprint, send_from_directory
+from flask import Flask, render_template, jsonify, request, redirect, url_for, flash, Blueprint, send_from_directory, send_file, Response, g
 from werkzeug.utils import secure_filename
-import yaml
 import json
+import mimetypes
 import os
 import subprocess
 import re
+import tempfile
+import time
 from pathlib import Path
 from datetime import datetime
+from stats_collector import StatsCollector
+from tftp_journal import TftpJournal
+from dhcp_leases import LeaseIndex, is_active
+from service_status import query_services
+from storage import ASSET_FIELDS, AssetSizeIndex, format_bytes, get_storage_usage
+from image_registry import ImageRegistry
+from menu_compiler import STAMPED_RE, compile_menus, load_menu_options, load_server_ip, publish_edited_menu
+from client_menus import AssignmentTable, ClientMenus, menu_etag
+from boot_files import BootFileManifest, TransferCounter
+from tftp_server import read_transfer_stats
+from admission import MAC_RE, AdmissionControl, load_admission_config, slot_script
+from asset_store import AssetStore
+from asset_verify import AssetVerifier, VerifyJobs, publish_verdicts
+from uploads import UploadError, UploadJobs, UploadManager
+from jobs import JobError
+from iso_import import ImportJobs, inspect_iso
+from mirror_download import DownloadJobs, load_download_config
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, metrics
+from profiling import ProfilingError, ProfilingMiddleware, load_profiling_config, profiler
+from boot_funnel import STAGES as FUNNEL_STAGES, BootFunnel, load_funnel_config
+from history import History, HistoryError, load_history_config, parse_time
+from privileged_helper import MAX_BOOT_FILE_SIZE, HelperError, PrivilegedHelper
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'kapadokya-netboot-secret-change-me'
@@ -36,34 +60,87 @@ class PrefixMiddleware(object):
                 environ['PATH_INFO'] = path_info[len(prefix):]
         return self.app(environ, start_response)
 
-app.wsgi_app = PrefixMiddleware(app.wsgi_app, prefix='/admin')
+# Profiling sits inside the prefix handling so it sees app paths (/images, /api/...)
+app.wsgi_app = PrefixMiddleware(ProfilingMiddleware(app.wsgi_app, profiler), prefix='/admin')
 
-# Paths
-BASE_DIR = Path('/opt/knetboot')
+# Paths (KNETBOOT_* environment overrides are for benchmarks and development)
+BASE_DIR = Path(os.environ.get('KNETBOOT_BASE_DIR', '/opt/knetboot'))
 CONFIG_DIR = BASE_DIR / 'config'
 ASSETS_DIR = BASE_DIR / 'assets'
+ISO_DIR = BASE_DIR / 'iso'
+DATA_DIR = BASE_DIR / 'data'
+HISTORY_DB = DATA_DIR / 'history.sqlite3'
 IMAGES_YAML = CONFIG_DIR / 'images.yaml'
 SETTINGS_YAML = CONFIG_DIR / 'settings.yaml'
 SYSTEM_CONFIG_JSON = CONFIG_DIR / 'system.json'
+ASSIGNMENTS_YAML = CONFIG_DIR / 'assignments.yaml'
 DHCP_CONFIG_PATH = '/etc/dhcp/dhcpd.conf'
 DHCP_SERVICE = 'isc-dhcp-server'
 TFTP_CONFIG_PATH = '/etc/default/tftpd-hpa'
 TFTP_SERVICE = 'tftpd-hpa'
-TFTP_ROOT = '/srv/tftp'
+TFTP_ROOT = os.environ.get('KNETBOOT_TFTP_ROOT', '/srv/tftp')
+BUILTIN_TFTP_SERVICE = 'knetboot-tftp'
 NGINX_SERVICE = 'nginx'
+WEB_SERVICE = 'knetboot-web'
+RUN_DIR = Path(os.environ.get('KNETBOOT_RUN_DIR', '/run/knetboot'))
+STATS_SNAPSHOT = RUN_DIR / 'stats.json'
+TFTP_JOURNAL_STATE = RUN_DIR / 'tftp-journal.json'
+TFTP_TRANSFERS_STATE = RUN_DIR / 'tftp-transfers.json'
+ADMISSION_STATE = RUN_DIR / 'admission.json'
+UPLOADS_STATE_DIR = RUN_DIR / 'uploads'
+UPLOAD_JOBS_STATE_DIR = RUN_DIR / 'upload-jobs'
+# Boot files uploaded for the TFTP root wait here until the helper installs them
+UPLOADS_STAGING_DIR = DATA_DIR / 'uploads'
+IMPORTS_STATE_DIR = RUN_DIR / 'imports'
+DOWNLOADS_STATE_DIR = RUN_DIR / 'downloads'
+VERIFY_STATE_DIR = RUN_DIR / 'verify'
+METRICS_STATE_DIR = RUN_DIR / 'metrics'
+PROFILING_STATE_DIR = RUN_DIR / 'profiling'
+BOOT_FILES_MANIFEST = RUN_DIR / 'boot-files.json'
+HTTP_TRANSFERS_STATE = RUN_DIR / 'http-transfers.json'
+BOOT_FUNNEL_STATE = RUN_DIR / 'boot-funnel.json'
+# Broken images from the latest quick/full verify, read by the per-client menus
+VERDICTS_STATE = RUN_DIR / 'verdicts.json'
+DHCP_LEASES_PATH = os.environ.get('KNETBOOT_DHCP_LEASES', '/var/lib/dhcp/dhcpd.leases')
+DEFAULT_STATS_INTERVAL = 15
+
+# Per-worker samples are shared through RUN_DIR so /metrics covers every worker
+metrics.configure(METRICS_STATE_DIR)
+
+def record_helper_call(op, seconds, failed):
+    """Metrics for a privileged helper call (the helper itself imports nothing of ours)"""
+    metrics.observe('knetboot_helper_duration_seconds', seconds, op=op)
+    if failed:
+        metrics.inc('knetboot_helper_failures_total', op=op)
+
+# Root-owned helper (knetboot-helper) for service control and writes outside our own tree
+helper = PrivilegedHelper(observe=record_helper_call)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('knetboot_http_request_duration_seconds', time.monotonic() - started,
+                        route=route, method=request.method)
+        metrics.inc('knetboot_http_requests_total', route=route, method=request.method,
+                    status=response.status_code)
+    metrics.flush()
+    return response
+
+image_registry = ImageRegistry(str(IMAGES_YAML))
 
 def load_images():
-    """Load images from YAML"""
-    if not IMAGES_YAML.exists():
-        return []
-    with open(IMAGES_YAML) as f:
-        data = yaml.safe_load(f)
-        return data.get('images', [])
+    """Load images from the cached registry (treat the result as read-only)"""
+    return image_registry.images()
 
 def save_images(images):
     """Save images to YAML"""
-    with open(IMAGES_YAML, 'w') as f:
-        yaml.dump({'images': images}, f, default_flow_style=False)
+    image_registry.save(images)
 
 def load_system_config():
     """Load system configuration from JSON"""
@@ -105,76 +182,42 @@ def load_settings():
     return system_config
 
 def get_disk_usage():
-    """Get disk usage using df -h for root filesystem"""
-    try:
-        # Get disk usage of root filesystem (where everything is stored)
-        result = subprocess.run(
-            ['df', '-h', '/'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.returncode == 0:
-            lines = result.stdout.strip().split('\n')
-            if len(lines) > 1:
-                # Parse output: Filesystem Size Used Avail Use% Mounted
-                parts = lines[1].split()
-                if len(parts) >= 5:
-                    size = parts[1]      # e.g., "100G"
-                    used = parts[2]      # e.g., "45G"
-                    avail = parts[3]     # e.g., "55G"
-                    percent = parts[4]   # e.g., "45%"
-
-                    # Convert to float (handle G, M, T suffixes)
-                    def parse_size(s):
-                        s = s.upper()
-                        if 'T' in s:
-                            return float(s.replace('T', '')) * 1024
-                        elif 'G' in s:
-                            return float(s.replace('G', ''))
-                        elif 'M' in s:
-                            return float(s.replace('M', '')) / 1024
-                        else:
-                            return 0
-
-                    return {
-                        'size': size,
-                        'used': used,
-                        'available': avail,
-                        'percent': percent,
-                        'used_gb': parse_size(used),
-                        'total_gb': parse_size(size)
-                    }
-        return {
-            'size': 'Unknown',
-            'used': 'Unknown',
-            'available': 'Unknown',
-            'percent': '0%',
-            'used_gb': 0,
-            'total_gb': 100
-        }
-    except Exception as e:
-        print(f"Error getting disk usage: {e}")
+    """Get disk usage of the assets, TFTP root and config filesystems via statvfs"""
+    filesystems = get_storage_usage({
+        'assets': ASSETS_DIR if ASSETS_DIR.exists() else BASE_DIR,
+        'tftp': TFTP_ROOT,
+        'config': CONFIG_DIR
+    })
+    if not filesystems:
         return {
             'size': 'Unknown',
             'used': 'Unknown',
             'available': 'Unknown',
             'percent': '0%',
             'used_gb': 0,
-            'total_gb': 100
+            'total_gb': 100,
+            'filesystems': []
         }
 
+    # Headline numbers are for the volume holding the boot assets
+    primary = filesystems[0]
+    for fs in filesystems:
+        fs['size'] = format_bytes(fs['total_bytes'])
+        fs['used'] = format_bytes(fs['used_bytes'])
+        fs['available'] = format_bytes(fs['available_bytes'])
+    return {
+        'size': primary['size'],
+        'used': primary['used'],
+        'available': primary['available'],
+        'percent': f"{primary['percent']}%",
+        'used_gb': round(primary['used_bytes'] / 1024 ** 3, 2),
+        'total_gb': round(primary['total_bytes'] / 1024 ** 3, 2),
+        'filesystems': filesystems
+    }
+
 def get_service_status(service):
     """Check if systemd service is active"""
-    try:
-        result = subprocess.run(
-            ['/usr/bin/sudo', '/usr/bin/systemctl', 'is-active', service],
-            capture_output=True,
-            text=True
-        )
-        return result.stdout.strip() == 'active'
-    except:
-        return False
+    return query_services([service])[service]['active']
 
 def parse_dhcp_config():
     """Parse current DHCP configuration"""
@@ -272,28 +315,77 @@ subnet {config['network']} netmask {config['netmask']} {{
 """
 
     try:
-        # Write config using sudo tee
-        process = subprocess.Popen(['/usr/bin/sudo', '/usr/bin/tee', DHCP_CONFIG_PATH],
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 text=True)
-        stdout, stderr = process.communicate(input=dhcp_config)
-
-        if process.returncode == 0:
-            # Test config syntax
-            test_result = subprocess.run(['/usr/bin/sudo', '/usr/sbin/dhcpd', '-t', '-cf', DHCP_CONFIG_PATH],
-                                       capture_output=True, text=True)
-            if test_result.returncode == 0:
-                return True, "Configuration updated successfully!"
-            else:
-                return False, f"Config syntax error: {test_result.stderr}"
+        # The helper runs dhcpd -t on the new file and only installs it if it passes
+        result = helper.call('write_config', target='dhcpd', content=dhcp_config)
+        if result.returncode == 0:
+            return True, "Configuration updated successfully!"
         else:
-            return False, f"Failed to write config: {stderr}"
+            return False, f"Config syntax error: {result.stderr}"
 
+    except HelperError as e:
+        return False, f"Failed to write config: {str(e)}"
     except Exception as e:
         return False, f"Error writing config: {str(e)}"
 
+# services.tftp.engine: "tftpd-hpa" (default) or "builtin" (web/tftp_server.py)
+TFTP_ENGINE = load_system_config().get('services', {}).get('tftp', {}).get('engine', 'tftpd-hpa')
+if TFTP_ENGINE == 'builtin':
+    TFTP_SERVICE = BUILTIN_TFTP_SERVICE
+
+# profiling.enabled: spans and slow log for every request; captures work either way
+profiler.configure(load_profiling_config(load_system_config()), PROFILING_STATE_DIR)
+profiler.connect_templates(app)
+
+asset_sizes = AssetSizeIndex(BASE_DIR)
+asset_store = AssetStore(BASE_DIR, ASSETS_DIR)
+# imports.iso_dir: where ISOs are uploaded to and imported from
+IMPORTS_CONFIG = load_system_config().get('imports', {})
+ISO_DIR = Path(IMPORTS_CONFIG.get('iso_dir', ISO_DIR))
+
+def install_tftp_upload(part_path, upload):
+    """Have the privileged helper copy a finished upload into the TFTP root"""
+    try:
+        with open(part_path, 'rb') as f:
+            helper.call('tftp_install', fd=f.fileno(), name=upload['path'])
+    except HelperError as e:
+        raise UploadError(f'Could not install boot file: {e}', 502)
+
+uploads = UploadManager(UPLOADS_STATE_DIR, {'assets': ASSETS_DIR, 'tftp': TFTP_ROOT, 'iso': ISO_DIR},
+                        staging_dir=UPLOADS_STAGING_DIR, installers={'tftp': install_tftp_upload})
+
+def register_upload(upload):
+    """Add a finished assets upload to the catalog if the client asked for it"""
+    register = upload.get('register')
+    if not register:
+        return None
+    new_image = {
+        'name': register.get('name') or register['id'],
+        'category': register.get('category') or 'custom',
+        'type': 'live',
+        'description': register.get('description', '')
+    }
+    return image_registry.set_asset(register['id'], register['field'], f"assets/{upload['path']}",
+                                    sha256=upload['sha256'], new_image=new_image)
+
+upload_jobs = UploadJobs(UPLOAD_JOBS_STATE_DIR, uploads, on_complete=register_upload)
+iso_imports = ImportJobs(IMPORTS_STATE_DIR, ISO_DIR, BASE_DIR, image_registry,
+                         workers=IMPORTS_CONFIG.get('workers', 2))
+mirror_downloads = DownloadJobs(DOWNLOADS_STATE_DIR, BASE_DIR, image_registry,
+                                load_download_config(load_system_config()))
+# verify.workers: assets hashed in parallel by a full verification
+asset_verifier = AssetVerifier(asset_store, workers=load_system_config().get('verify', {}).get('workers', 4))
+verify_jobs = VerifyJobs(VERIFY_STATE_DIR, asset_verifier, image_registry, str(VERDICTS_STATE))
+tftp_journal = TftpJournal(str(TFTP_JOURNAL_STATE), unit=TFTP_SERVICE)
+lease_index = LeaseIndex(DHCP_LEASES_PATH, helper)
+boot_files = BootFileManifest(TFTP_ROOT, str(BOOT_FILES_MANIFEST))
+http_transfers = TransferCounter(str(HTTP_TRANSFERS_STATE))
+admission = AdmissionControl(str(ADMISSION_STATE), load_admission_config(load_system_config()))
+# DHCP (and tftpd-hpa) from the journal, the built-in server's transfer log, nginx boot log
+boot_funnel = BootFunnel(str(BOOT_FUNNEL_STATE), load_funnel_config(load_system_config()), image_registry,
+                         units=[DHCP_SERVICE] if TFTP_ENGINE == 'builtin' else [DHCP_SERVICE, TFTP_SERVICE],
+                         transfers_path=str(TFTP_TRANSFERS_STATE) if TFTP_ENGINE == 'builtin' else None,
+                         lease_index=lease_index)
+
 def get_boot_statistics():
     """
     Parse DHCP leases and TFTP logs to get boot statistics
@@ -309,60 +401,15 @@ def get_boot_statistics():
     }
 
     try:
-        # Parse DHCP leases for active clients
-        dhcp_leases_path = '/var/lib/dhcp/dhcpd.leases'
-        if os.path.exists(dhcp_leases_path):
-            result = subprocess.run(
-                ['sudo', 'cat', dhcp_leases_path],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if result.returncode == 0:
-                # Count active leases (simple count of "lease" entries)
-                stats['active_leases'] = result.stdout.count('lease ')
-
-        # Parse TFTP logs for boot attempts (last 24 hours)
-        tftp_log_result = subprocess.run(
-            ['sudo', 'journalctl', '-u', 'tftpd-hpa', '--since', 'today', '--no-pager'],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        # Active clients: bound, unexpired leases from the incremental index
+        stats['active_leases'] = lease_index.active_count()
 
-        if tftp_log_result.returncode == 0:
-            log_lines = tftp_log_result.stdout.split('\n')
-
-            # Count RRQ (Read Request) as boot attempts
-            boot_attempts = [line for line in log_lines if 'RRQ' in line or 'sent' in line.lower()]
-            stats['total_boots_today'] = len(boot_attempts)
-
-            # Count successful transfers (files sent successfully)
-            successful = [line for line in log_lines if 'sent' in line.lower() and ('kpxe' in line.lower() or 'efi' in line.lower())]
-            stats['successful_boots'] = len(successful)
-
-            # Calculate failed boots
-            stats['failed_boots'] = max(0, stats['total_boots_today'] - stats['successful_boots'])
-
-            # Calculate success rate
-            if stats['total_boots_today'] > 0:
-                stats['success_rate'] = int((stats['successful_boots'] / stats['total_boots_today']) * 100)
-            else:
-                stats['success_rate'] = 0
-
-            # Find most requested file (most used image)
-            file_requests = {}
-            for line in log_lines:
-                if 'RRQ' in line:
-                    # Extract filename from log
-                    match = re.search(r'RRQ.*?([a-zA-Z0-9_\-\.]+\.(kpxe|efi|ipxe))', line)
-                    if match:
-                        filename = match.group(1)
-                        file_requests[filename] = file_requests.get(filename, 0) + 1
-
-            if file_requests:
-                most_used = max(file_requests, key=file_requests.get)
-                stats['most_used_image'] = most_used
+        if TFTP_ENGINE == 'builtin':
+            # Per-transfer counters written by the built-in server itself
+            stats.update(read_transfer_stats(str(TFTP_TRANSFERS_STATE)))
+        else:
+            # TFTP boot attempts since midnight, read incrementally from the journal
+            stats.update(tftp_journal.get_stats())
 
     except subprocess.TimeoutExpired:
         print("Timeout while fetching boot statistics")
@@ -374,7 +421,7 @@ def get_boot_statistics():
 def get_system_uptime():
     """Get system uptime in human-readable format"""
     try:
-        result = subprocess.run(
+        result = metrics.run(
             ['uptime', '-p'],
             capture_output=True,
             text=True,
@@ -388,26 +435,86 @@ def get_system_uptime():
     except:
         return "Unknown"
 
+MANAGED_SERVICES = {
+    'dhcp': DHCP_SERVICE,
+    'tftp': TFTP_SERVICE,
+    'nginx': NGINX_SERVICE,
+    'web': WEB_SERVICE
+}
+
+def get_all_service_status():
+    """Get state, sub-state, since and restart count of every managed service"""
+    status = query_services(MANAGED_SERVICES.values())
+    return {name: status[unit] for name, unit in MANAGED_SERVICES.items()}
+
+# history: minute/hour/day rollups of every published snapshot (survives restarts)
+history = History(HISTORY_DB, load_history_config(load_system_config()))
+
+stats_collector = StatsCollector(
+    STATS_SNAPSHOT,
+    sources={
+        'boot': get_boot_statistics,
+        'service_details': get_all_service_status,
+        'disk': get_disk_usage,
+        'uptime': get_system_uptime,
+        'http_boot': http_transfers.get_stats,
+        'admission': admission.metrics,
+        'funnel': boot_funnel.summary,
+        # Publishes broken images for the boot path from the leader only
+        'verify': lambda: asset_verifier.publish(image_registry, str(VERDICTS_STATE))
+    },
+    interval=load_system_config().get('stats', {}).get('refresh_interval', DEFAULT_STATS_INTERVAL),
+    on_refresh=history.record
+)
+# Each worker imports the app after gunicorn forks it, so this runs per worker;
+# starting here keeps history sampling without waiting for a dashboard request
+stats_collector.start()
+
+def get_stats_snapshot():
+    """Get the shared stats snapshot, filling gaps with safe defaults"""
+    snapshot = stats_collector.read()
+    data = snapshot['data']
+    if not data.get('boot'):
+        data['boot'] = {
+            'total_boots_today': 0,
+            'successful_boots': 0,
+            'failed_boots': 0,
+            'active_leases': 0,
+            'success_rate': 0,
+            'most_used_image': 'N/A'
+        }
+    details = data.get('service_details') or {}
+    data['services'] = {name: bool(details.get(name, {}).get('active')) for name in MANAGED_SERVICES}
+    if not data.get('disk'):
+        data['disk'] = {
+            'size': 'Unknown',
+            'used': 'Unknown',
+            'available': 'Unknown',
+            'percent': '0%',
+            'used_gb': 0,
+            'total_gb': 100
+        }
+    if not data.get('uptime'):
+        data['uptime'] = 'Unknown'
+    return snapshot
+
 @app.route('/')
 def index():
     """Dashboard"""
     images = load_images()
     settings = load_settings()
 
-    # Get boot statistics from logs
-    boot_stats = get_boot_statistics()
-    uptime = get_system_uptime()
+    # Boot statistics, services, disk and uptime come from the shared snapshot
+    snapshot = get_stats_snapshot()
+    boot_stats = snapshot['data']['boot']
+    uptime = snapshot['data']['uptime']
 
     stats = {
         'total_images': len(images),
         'enabled_images': len([i for i in images if i.get('enabled', False)]),
-        'disk_usage': get_disk_usage(),
-        'services': {
-            'dhcp': get_service_status('isc-dhcp-server'),
-            'tftp': get_service_status('tftpd-hpa'),
-            'nginx': get_service_status('nginx'),
-            'web': get_service_status('knetboot-web')
-        },
+        'disk_usage': snapshot['data']['disk'],
+        'services': snapshot['data']['services'],
+        'service_details': snapshot['data'].get('service_details') or {},
         # Boot statistics
         'boots_today': boot_stats['total_boots_today'],
         'successful_boots': boot_stats['successful_boots'],
@@ -415,16 +522,22 @@ def index():
         'boot_success_rate': boot_stats['success_rate'],
         'active_clients': boot_stats['active_leases'],
         'most_used_image': boot_stats['most_used_image'],
-        'uptime': uptime
+        'uptime': uptime,
+        'stats_age': snapshot['age'],
+        'stats_stale': snapshot['stale'],
+        'stats_interval': stats_collector.interval
     }
 
-    return render_template('dashboard.html', stats=stats, settings=settings)
+    return render_template('dashboard.html', stats=stats, settings=settings,
+                           funnel=snapshot['data'].get('funnel'), funnel_stages=FUNNEL_STAGES)
 
 @app.route('/images')
 def images_list():
     """Image list page"""
     images = load_images()
-    return render_template('images.html', images=images)
+    footprint = asset_sizes.catalog_footprint(images)
+    health = asset_verifier.cached_check(image_registry)['images']
+    return render_template('images.html', images=images, footprint=footprint, health=health)
 
 @app.route('/settings')
 def settings_page():
@@ -433,8 +546,8 @@ def settings_page():
 
     # Get real hostname from hostnamectl
     try:
-        result = subprocess.run(['/usr/bin/hostnamectl', 'hostname'],
-                              capture_output=True, text=True, timeout=5)
+        result = metrics.run(['/usr/bin/hostnamectl', 'hostname'],
+                             capture_output=True, text=True, timeout=5)
         if result.returncode == 0:
             settings['server']['name'] = result.stdout.strip()
     except Exception as e:
@@ -459,10 +572,12 @@ def update_time_settings():
 
         # Apply timezone change
         if timezone:
-            result = subprocess.run(['/usr/bin/sudo', '/usr/bin/timedatectl', 'set-timezone', timezone],
-                                  capture_output=True, text=True, timeout=10)
-            if result.returncode != 0:
-                flash(f'Warning: Could not set timezone: {result.stderr}', 'warning')
+            try:
+                result = helper.call('set_timezone', timezone=timezone)
+                if result.returncode != 0:
+                    flash(f'Warning: Could not set timezone: {result.stderr}', 'warning')
+            except HelperError as e:
+                flash(f'Warning: Could not set timezone: {str(e)}', 'warning')
 
         # Update NTP configuration
         if ntp_server:
@@ -471,17 +586,13 @@ def update_time_settings():
                 ntp_config += f"FallbackNTP={ntp_fallback}\n"
 
             # Write NTP config
-            process = subprocess.Popen(['/usr/bin/sudo', '/usr/bin/tee', '/etc/systemd/timesyncd.conf.d/local.conf'],
-                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            stdout, stderr = process.communicate(input=ntp_config)
-
-            if process.returncode == 0:
+            try:
+                helper.call('write_config', target='timesyncd', content=ntp_config)
                 # Restart NTP service
-                subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', 'restart', 'systemd-timesyncd'],
-                             capture_output=True, text=True, timeout=10)
+                helper.call('service', unit='systemd-timesyncd', action='restart')
                 flash('Time settings updated successfully!', 'success')
-            else:
-                flash(f'Error updating NTP config: {stderr}', 'danger')
+            except HelperError as e:
+                flash(f'Error updating NTP config: {str(e)}', 'danger')
         else:
             flash('Settings saved to system.json', 'success')
 
@@ -545,7 +656,8 @@ def menus_page():
     menus_dir = CONFIG_DIR / 'menus'
     menu_files = []
     if menus_dir.exists():
-        menu_files = [f.name for f in menus_dir.glob('*.ipxe')]
+        # Hash-stamped copies are generated artifacts, not editable menus
+        menu_files = [f.name for f in menus_dir.glob('*.ipxe') if not STAMPED_RE.match(f.name)]
     return render_template('menus.html', menu_files=menu_files)
 
 @app.route('/menus/edit/<filename>')
@@ -657,8 +769,7 @@ def dhcp_update():
 def dhcp_restart():
     """Restart DHCP service"""
     try:
-        result = subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', 'restart', DHCP_SERVICE],
-                              capture_output=True, text=True, timeout=10)
+        result = helper.call('service', unit=DHCP_SERVICE, action='restart')
         if result.returncode == 0:
             flash('DHCP server restarted successfully!', 'success')
         else:
@@ -676,8 +787,7 @@ def dhcp_toggle():
         enable = data.get('enable', False)
 
         action = 'start' if enable else 'stop'
-        result = subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', action, DHCP_SERVICE],
-                              capture_output=True, text=True, timeout=10)
+        result = helper.call('service', unit=DHCP_SERVICE, action=action)
 
         if result.returncode == 0:
             status = 'started' if enable else 'stopped'
@@ -783,15 +893,11 @@ TFTP_ADDRESS="{tftp_address}"
 TFTP_OPTIONS="{tftp_options}"
 '''
 
-        # Write config using sudo tee
-        process = subprocess.Popen(['/usr/bin/sudo', '/usr/bin/tee', TFTP_CONFIG_PATH],
-                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate(input=tftp_config)
-
-        if process.returncode == 0:
+        try:
+            helper.call('write_config', target='tftpd-hpa', content=tftp_config)
             flash('TFTP configuration updated successfully! Restart TFTP service to apply changes.', 'success')
-        else:
-            flash(f'Error writing TFTP config: {stderr}', 'danger')
+        except HelperError as e:
+            flash(f'Error writing TFTP config: {str(e)}', 'danger')
 
     except Exception as e:
         flash(f'Error updating TFTP config: {str(e)}', 'danger')
@@ -802,8 +908,7 @@ TFTP_OPTIONS="{tftp_options}"
 def tftp_restart():
     """Restart TFTP service"""
     try:
-        result = subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', 'restart', TFTP_SERVICE],
-                              capture_output=True, text=True, timeout=10)
+        result = helper.call('service', unit=TFTP_SERVICE, action='restart')
         if result.returncode == 0:
             flash('TFTP server restarted successfully!', 'success')
         else:
@@ -821,8 +926,7 @@ def tftp_toggle():
         enable = data.get('enable', False)
 
         action = 'start' if enable else 'stop'
-        result = subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', action, TFTP_SERVICE],
-                              capture_output=True, text=True, timeout=10)
+        result = helper.call('service', unit=TFTP_SERVICE, action=action)
 
         if result.returncode == 0:
             status = 'started' if enable else 'stopped'
@@ -846,8 +950,7 @@ def tftp_toggle():
 def nginx_restart():
     """Restart NGINX service"""
     try:
-        result = subprocess.run(['/usr/bin/sudo', '/usr/bin/systemctl', 'restart', NGINX_SERVICE],
-                              capture_output=True, text=True, timeout=10)
+        result = helper.call('service', unit=NGINX_SERVICE, action='restart')
 
         if result.returncode == 0:
             return jsonify({
@@ -894,25 +997,13 @@ def tftp_upload():
         # Secure the filename
         filename = secure_filename(file.filename)
 
-        # Save to temporary location first
-        temp_path = f"/tmp/{filename}"
-        file.save(temp_path)
-
-        # Move to TFTP directory with sudo (requires proper permissions)
-        tftp_path = f"{TFTP_ROOT}/{filename}"
-        result = subprocess.run(['/usr/bin/sudo', '/usr/bin/cp', temp_path, tftp_path],
-                              capture_output=True, text=True, timeout=10)
-
-        # Clean up temp file
-        os.remove(temp_path)
-
-        if result.returncode == 0:
-            # Set proper permissions (readable by all)
-            subprocess.run(['/usr/bin/sudo', '/usr/bin/chmod', '644', tftp_path],
-                         capture_output=True, text=True, timeout=5)
-            flash(f'File "{filename}" uploaded successfully to {TFTP_ROOT}', 'success')
-        else:
-            flash(f'Error uploading file: {result.stderr}', 'danger')
+        # Spool to an anonymous temp file and hand the helper its descriptor;
+        # it installs the file into the TFTP root as 0644
+        with tempfile.TemporaryFile() as spool:
+            file.save(spool)
+            spool.flush()
+            helper.call('tftp_install', fd=spool.fileno(), name=filename)
+        flash(f'File "{filename}" uploaded successfully to {TFTP_ROOT}', 'success')
 
     except Exception as e:
         flash(f'Error uploading file: {str(e)}', 'danger')
@@ -925,64 +1016,219 @@ def tftp_delete_file(filename):
     try:
         # Secure the filename
         filename = secure_filename(filename)
-        tftp_path = f"{TFTP_ROOT}/{filename}"
-
-        # Delete file with sudo
-        result = subprocess.run(['/usr/bin/sudo', '/usr/bin/rm', '-f', tftp_path],
-                              capture_output=True, text=True, timeout=10)
-
-        if result.returncode == 0:
-            flash(f'File "{filename}" deleted successfully', 'success')
-        else:
-            flash(f'Error deleting file: {result.stderr}', 'danger')
+        helper.call('tftp_delete', name=filename)
+        flash(f'File "{filename}" deleted successfully', 'success')
 
     except Exception as e:
         flash(f'Error deleting file: {str(e)}', 'danger')
 
     return redirect(url_for('tftp_config_page'))
 
+client_menus = ClientMenus(image_registry, AssignmentTable(str(ASSIGNMENTS_YAML)), str(SETTINGS_YAML),
+                           str(CONFIG_DIR / 'menus'), load_menu_options(SYSTEM_CONFIG_JSON),
+                           verdicts_path=str(VERDICTS_STATE))
+
+@app.route('/boot/menu.ipxe')
+def serve_client_menu():
+    """Per-client main menu, e.g. chain .../client.ipxe?mac=${mac}&uuid=${uuid}&platform=${platform}&buildarch=${buildarch}"""
+    try:
+        menu, rule = client_menus.render(
+            mac=request.args.get('mac'),
+            uuid=request.args.get('uuid'),
+            hostname=request.args.get('hostname'),
+            platform=request.args.get('platform'),
+            buildarch=request.args.get('buildarch')
+        )
+    except Exception as e:
+        print(f"Error rendering client menu: {e}")
+        return "#!ipxe\nchain ${base_url}/menus/main.ipxe\n", 200, {'Content-Type': 'text/plain'}
+
+    response = Response(menu, mimetype='text/plain')
+    response.set_etag(menu_etag(menu))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def accel_redirect_uri(path):
+    """Internal nginx URI for path when nginx advertised X-Accel-Redirect.
+
+    nginx sends "X-Sendfile-Type: X-Accel-Redirect" and a mapping such as
+    "X-Accel-Mapping: /srv/tftp/=/_knetboot/tftp/" on proxied requests.
+    """
+    if request.headers.get('X-Sendfile-Type') != 'X-Accel-Redirect':
+        return None
+    for mapping in request.headers.get('X-Accel-Mapping', '').split(','):
+        directory, _, internal = mapping.strip().partition('=')
+        if directory and internal and path.startswith(directory):
+            return internal + path[len(directory):]
+    return None
+
+def body_length(size):
+    """Bytes a GET will transfer, honouring a satisfiable Range header"""
+    byte_range = request.range
+    if byte_range is not None:
+        span = byte_range.range_for_length(size)
+        if span is not None:
+            return span[1] - span[0]
+    return size
+
+def record_boot_transfer(filename, nbytes=0, not_modified=False):
+    """Count a boot file response in the daily counters and in /metrics"""
+    http_transfers.record(filename, nbytes, not_modified=not_modified)
+    metrics.inc('knetboot_boot_file_requests_total', file=filename,
+                result='not_modified' if not_modified else 'transfer')
+    if nbytes:
+        metrics.inc('knetboot_asset_bytes_served_total', nbytes, file=filename)
+
 @app.route('/boot/http/<path:filename>')
 def serve_boot_file(filename):
-    """Serve boot files over HTTP (alternative to TFTP)"""
+    """Serve boot files over HTTP (alternative to TFTP).
+
+    Behind nginx the transfer is handed back with X-Accel-Redirect so no
+    worker streams the file; standalone, send_file uses sendfile through
+    the WSGI file wrapper. Either way ETag/Last-Modified come from the
+    boot file manifest and 304s are answered here.
+    """
+    entry = boot_files.lookup(filename)
+    if entry is None:
+        return "Error: file not found", 404
+    counted = request.method == 'GET'
+
+    uri = accel_redirect_uri(entry['path'])
+    if uri:
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.set_etag(entry['sha256'])
+        response.last_modified = entry['mtime']
+        response.headers['Cache-Control'] = 'no-cache'
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            if counted:
+                record_boot_transfer(filename, not_modified=True)
+            return response
+        response.headers['X-Accel-Redirect'] = uri
+        if counted:
+            record_boot_transfer(filename, body_length(entry['size']))
+        return response
+
+    response = send_file(entry['path'], conditional=True, etag=entry['sha256'],
+                         last_modified=entry['mtime'], max_age=0)
+    response.headers['Cache-Control'] = 'no-cache'
+    if counted:
+        if response.status_code == 304:
+            record_boot_transfer(filename, not_modified=True)
+        elif response.status_code in (200, 206):
+            record_boot_transfer(filename, response.content_length or 0)
+    return response
+
+@app.route('/boot/slot.ipxe')
+def serve_slot_script():
+    """Download slot request from a menu entry: boot now or wait and retry"""
+    img = image_registry.get(request.args.get('image', ''))
+    if not img or not img.get('squashfs'):
+        return "#!ipxe\necho Unknown image\nexit 1\n", 404, {'Content-Type': 'text/plain'}
+    mac = request.args.get('mac', '')
+    if not MAC_RE.match(mac):
+        # Only a real MAC may key the queue or be echoed into the script
+        mac = ''
+    client = mac or request.headers.get('X-Real-IP', request.remote_addr)
     try:
-        return send_from_directory(TFTP_ROOT, filename)
-    except Exception as e:
-        return f"Error: {str(e)}", 404
+        attempt = int(request.args.get('attempt', 0))
+    except ValueError:
+        attempt = 0
+
+    decision = admission.request_slot(img['id'], client, attempt)
+    if decision['granted']:
+        metrics.inc('knetboot_image_boots_total', image=img['id'])
+    script = slot_script(img, load_server_ip(SETTINGS_YAML), decision, mac, attempt)
+    response = Response(script, mimetype='text/plain')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/boot/slot/<token>/<path:filename>')
+def serve_slot_asset(token, filename):
+    """squashfs download under a slot, rate limited to the slot's bandwidth share"""
+    assets_root = os.path.realpath(ASSETS_DIR)
+    path = os.path.realpath(os.path.join(assets_root, filename))
+    if not path.startswith(assets_root + os.sep) or not os.path.isfile(path):
+        return "Error: file not found", 404
+
+    # Only a GET that sends a body is billed and holds the slot, and only for
+    # the bytes it asks for: HEAD probes and cache checks send nothing, and a
+    # resumed download asks for the rest of the file
+    conditional = 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers
+    nbytes = body_length(os.path.getsize(path)) if request.method == 'GET' and not conditional else 0
+    rate = admission.start_download(token, nbytes)
+    if nbytes:
+        metrics.inc('knetboot_asset_bytes_served_total', nbytes, file=filename)
+    uri = accel_redirect_uri(path)
+    if uri:
+        response = Response(mimetype='application/octet-stream')
+        response.headers['X-Accel-Redirect'] = uri
+        if rate:
+            response.headers['X-Accel-Limit-Rate'] = str(rate)
+        return response
+    return send_file(path, conditional=True, max_age=0)
 
 # API Endpoints
 
 @app.route('/api/images', methods=['GET'])
 def api_images_list():
-    """API: Get all images"""
+    """API: Get all images, with 'health' from a quick asset check"""
     images = load_images()
-    return jsonify({'success': True, 'images': images})
+    health = asset_verifier.cached_check(image_registry)['images']
+    return jsonify({'success': True, 'images': images, 'health': health})
+
+@app.route('/api/images', methods=['PATCH'])
+def api_images_batch():
+    """API: Apply many image operations in one atomic catalog write
+
+    Body: {"operations": [{"op": "enable", "id": "..."},
+                          {"op": "update", "id": "...", "fields": {...}}, ...],
+           "regenerate": true}
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'error': 'operations must be a non-empty list'}), 400
+
+    try:
+        success, result = image_registry.apply(operations)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    if not success:
+        return jsonify({'success': False, 'error': 'No changes applied', 'errors': result}), 400
+
+    response = {'success': True}
+    response.update(result)
+    if data.get('regenerate') and result['written']:
+        regenerated, output = regenerate_menus()
+        response['menus_regenerated'] = regenerated
+        if regenerated:
+            response['menus_report'] = output
+        else:
+            response['menus_error'] = output
+    return jsonify(response)
 
 @app.route('/api/images/<image_id>', methods=['GET'])
 def api_image_get(image_id):
     """API: Get single image"""
-    images = load_images()
-    image = next((i for i in images if i['id'] == image_id), None)
+    image = image_registry.get(image_id)
     if image:
-        return jsonify({'success': True, 'image': image})
+        return jsonify({'success': True, 'image': image, 'footprint': asset_sizes.image_footprint(image)})
     return jsonify({'success': False, 'error': 'Image not found'}), 404
 
 @app.route('/api/images/<image_id>/toggle', methods=['POST'])
 def api_image_toggle(image_id):
     """API: Toggle image enabled status"""
-    images = load_images()
-    image = next((i for i in images if i['id'] == image_id), None)
+    image = image_registry.get(image_id)
     if image:
-        image['enabled'] = not image.get('enabled', False)
-        save_images(images)
+        image = image_registry.update(image_id, enabled=not image.get('enabled', False))
         return jsonify({'success': True, 'enabled': image['enabled']})
     return jsonify({'success': False, 'error': 'Image not found'}), 404
 
 @app.route('/api/images/<image_id>', methods=['DELETE'])
 def api_image_delete(image_id):
     """API: Delete image"""
-    images = load_images()
-    images = [i for i in images if i['id'] != image_id]
-    save_images(images)
+    image_registry.delete(image_id)
     return jsonify({'success': True})
 
 @app.route('/api/menus/view/<filename>', methods=['GET'])
@@ -1020,6 +1266,10 @@ def api_menu_save(filename):
     if not filename.endswith('.ipxe'):
         return jsonify({'success': False, 'error': 'Invalid file type'}), 400
 
+    # Hash-stamped menus are immutable; edit the plain file instead
+    if STAMPED_RE.match(filename):
+        return jsonify({'success': False, 'error': 'Generated file cannot be edited'}), 400
+
     # Security: Prevent path traversal
     if '..' in filename or '/' in filename:
         return jsonify({'success': False, 'error': 'Invalid filename'}), 400
@@ -1044,6 +1294,9 @@ def api_menu_save(filename):
         with open(file_path, 'w') as f:
             f.write(content)
 
+        # Keep precompressed/hash-stamped copies and the manifest in step
+        publish_edited_menu(str(menus_dir), filename, load_menu_options(SYSTEM_CONFIG_JSON))
+
         return jsonify({
             'success': True,
             'message': f'{filename} saved successfully',
@@ -1052,40 +1305,495 @@ def api_menu_save(filename):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def regenerate_menus(incremental=True):
+    """Compile menus in-process, returning (success, report or error)"""
+    try:
+        options = load_menu_options(SYSTEM_CONFIG_JSON)
+        if options['broken_images'] != 'ignore':
+            options['broken'] = asset_verifier.broken(load_images())
+            publish_verdicts(str(VERDICTS_STATE), options['broken'])
+        with metrics.timer('knetboot_menu_generation_duration_seconds'):
+            report = compile_menus(image_registry, load_server_ip(SETTINGS_YAML),
+                                   str(CONFIG_DIR / 'menus'), incremental=incremental,
+                                   options=options)
+        return True, report
+    except Exception as e:
+        print(f"Error regenerating menus: {e}")
+        return False, str(e)
+
 @app.route('/api/menus/regenerate', methods=['POST'])
 def api_menus_regenerate():
-    """API: Regenerate iPXE menus"""
+    """API: Regenerate iPXE menus (?full=1 rewrites every file)"""
     try:
-        script_path = BASE_DIR / 'scripts' / 'menu-generator.py'
-        result = subprocess.run(
-            ['python3', str(script_path)],
-            capture_output=True,
-            text=True,
-            cwd=str(BASE_DIR)
-        )
-        if result.returncode == 0:
-            return jsonify({'success': True, 'output': result.stdout})
+        full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+        success, output = regenerate_menus(incremental=not full)
+        if success:
+            return jsonify({'success': True, 'report': output})
         return jsonify({
             'success': False,
-            'error': result.stderr
+            'error': output
         }), 500
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def serialize_lease(lease):
+    """Convert a lease index entry to JSON-friendly form"""
+    def fmt(ts):
+        return datetime.utcfromtimestamp(ts).isoformat() + 'Z' if ts is not None else None
+
+    return {
+        'ip': lease['ip'],
+        'mac': lease['mac'],
+        'state': lease['state'],
+        'active': is_active(lease),
+        'starts': fmt(lease['starts']),
+        'ends': fmt(lease['ends']),
+        'hostname': lease['hostname'],
+        'vendor_class': lease['vendor_class']
+    }
+
+@app.route('/api/leases', methods=['GET'])
+def api_leases_list():
+    """API: List DHCP leases (?active=1 for bound, unexpired leases only)"""
+    try:
+        active_only = request.args.get('active', '').lower() in ('1', 'true', 'yes')
+        leases = lease_index.leases(active_only=active_only)
+        return jsonify({
+            'success': True,
+            'count': len(leases),
+            'leases': [serialize_lease(l) for l in leases]
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/leases/<key>', methods=['GET'])
+def api_lease_get(key):
+    """API: Get the current lease for a MAC or IP address"""
+    try:
+        lease = lease_index.get(key)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    if lease:
+        return jsonify({'success': True, 'lease': serialize_lease(lease)})
+    return jsonify({'success': False, 'error': 'Lease not found'}), 404
+
+@app.route('/api/storage', methods=['GET'])
+def api_storage():
+    """API: Filesystem usage and per-image asset footprint"""
+    images = load_images()
+    footprint = asset_sizes.catalog_footprint(images)
+    return jsonify({
+        'success': True,
+        'filesystems': get_stats_snapshot()['data']['disk'].get('filesystems', []),
+        'images': footprint['images'],
+        'total_bytes': footprint['total_bytes'],
+        'total_size': footprint['total_size']
+    })
+
+@app.route('/api/assets/store', methods=['GET'])
+def api_asset_store():
+    """API: Content-addressed store usage and bytes saved by deduplication"""
+    try:
+        return jsonify({'success': True, **asset_store.report(load_images())})
+    except OSError as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def upload_error(e):
+    return jsonify({'success': False, 'error': str(e), **e.extra}), e.status
+
+@app.route('/api/uploads', methods=['GET'])
+def api_uploads_list():
+    """API: Uploads in progress"""
+    return jsonify({'success': True, 'uploads': uploads.uploads()})
+
+@app.route('/api/uploads', methods=['POST'])
+def api_upload_create():
+    """API: Start a resumable upload into assets/ or the TFTP root.
+
+    Body: {"target": "assets"|"tftp", "path": "ubuntu/24.04/vmlinuz",
+    "size": 123, "sha256": optional, "overwrite": false, "image": optional
+    {"id", "field": "kernel"|"initrd"|"squashfs", "name", "category"}}.
+    With "image", the finished asset is registered in the catalog.
+    """
+    data = request.get_json(silent=True) or {}
+    if data.get('target') == 'tftp' and not allowed_boot_file(str(data.get('path', ''))):
+        return jsonify({'success': False, 'error': f'Invalid file type. Allowed extensions: {", ".join(app.config["ALLOWED_BOOT_EXTENSIONS"])}'}), 400
+    if data.get('target') == 'tftp' and '/' in str(data.get('path', '')).strip('/'):
+        return jsonify({'success': False, 'error': 'Boot files go directly into the TFTP root, not a subdirectory'}), 400
+    if data.get('target') == 'tftp' and isinstance(data.get('size'), int) and data['size'] > MAX_BOOT_FILE_SIZE:
+        return jsonify({'success': False, 'error': f'Boot files are limited to {format_bytes(MAX_BOOT_FILE_SIZE)}'}), 413
+    if data.get('target') == 'iso' and not str(data.get('path', '')).lower().endswith('.iso'):
+        return jsonify({'success': False, 'error': 'Only .iso files can be uploaded to the ISO directory'}), 400
+    register = data.get('image')
+    if register is not None:
+        if data.get('target') != 'assets':
+            return jsonify({'success': False, 'error': 'Only assets uploads can be registered to an image'}), 400
+        if not isinstance(register, dict) or not register.get('id') or register.get('field') not in ASSET_FIELDS:
+            return jsonify({'success': False, 'error': f'image needs an id and a field ({", ".join(ASSET_FIELDS)})'}), 400
+    try:
+        upload = uploads.create(data.get('target'), data.get('path'), data.get('size'),
+                                sha256=data.get('sha256'), overwrite=bool(data.get('overwrite')),
+                                register=register)
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify({'success': True, 'upload': upload}), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def api_upload_get(upload_id):
+    """API: Upload state; 'offset' is where to resume"""
+    try:
+        return jsonify({'success': True, 'upload': uploads.get(upload_id)})
+    except UploadError as e:
+        return upload_error(e)
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def api_upload_chunk(upload_id):
+    """API: Append the request body at the Upload-Offset header.
+
+    The body is read from the WSGI input stream in fixed-size pieces and
+    written straight to disk, bypassing MAX_CONTENT_LENGTH and form parsing.
+    """
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Upload-Offset header required'}), 400
+    length = request.content_length
+    if length is None:
+        return jsonify({'success': False, 'error': 'Content-Length required'}), 411
+    try:
+        upload = uploads.append(upload_id, offset, request.environ['wsgi.input'], length)
+    except UploadError as e:
+        return upload_error(e)
+    response = jsonify({'success': True, 'upload': upload})
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    return response
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def api_upload_complete(upload_id):
+    """API: Verify and move the upload into place, registering it if asked.
+
+    If this worker did not hash every chunk, the rest is hashed in a
+    background job: the answer is 202 with the job to poll at
+    /api/uploads/jobs/<job id>.
+    """
+    try:
+        upload = uploads.get(upload_id)
+        if not uploads.hash_ready(upload):
+            return jsonify({'success': True, 'job': upload_jobs.submit(upload_id)}), 202
+        upload = uploads.complete(upload_id)
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify({'success': True, 'upload': upload, 'image': register_upload(upload)})
+
+@app.route('/api/uploads/jobs/<job_id>', methods=['GET'])
+def api_upload_job(job_id):
+    """API: Progress of a background upload completion"""
+    try:
+        return jsonify({'success': True, 'job': upload_jobs.get(job_id)})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def api_upload_abort(upload_id):
+    """API: Abort an upload and delete its partial file"""
+    try:
+        uploads.abort(upload_id)
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify({'success': True})
+
+@app.route('/api/imports', methods=['GET'])
+def api_imports():
+    """API: ISO import jobs and the ISOs available for import"""
+    return jsonify({'success': True, 'jobs': iso_imports.jobs(), 'isos': iso_imports.isos(),
+                    'iso_dir': str(ISO_DIR)})
+
+@app.route('/api/imports/inspect', methods=['GET'])
+def api_import_inspect():
+    """API: Boot files an import of ?iso=<name> would copy"""
+    try:
+        return jsonify({'success': True, 'plan': inspect_iso(iso_imports.resolve_iso(request.args.get('iso')))})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/imports', methods=['POST'])
+def api_import_start():
+    """API: Import kernel, initrd and squashfs from an ISO as a new image.
+
+    Body: {"iso": "ubuntu-24.04-desktop-amd64.iso", "id": "ubuntu_2404",
+    "name": optional, "category": optional, "description": optional,
+    "replace": false}. The copy runs in the background; poll
+    /api/imports/<job id> for progress.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        job = iso_imports.submit(data.get('iso'), data.get('id'), name=data.get('name'),
+                                 category=data.get('category'), description=data.get('description', ''),
+                                 replace=bool(data.get('replace')))
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    return jsonify({'success': True, 'job': job}), 202
+
+@app.route('/api/imports/<job_id>', methods=['GET'])
+def api_import_get(job_id):
+    """API: Import job state and progress"""
+    try:
+        return jsonify({'success': True, 'job': iso_imports.get(job_id)})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/imports/<job_id>', methods=['DELETE'])
+def api_import_cancel(job_id):
+    """API: Cancel a queued or running import"""
+    try:
+        return jsonify({'success': True, 'job': iso_imports.cancel(job_id)})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/downloads', methods=['GET'])
+def api_downloads():
+    """API: Mirror download jobs"""
+    return jsonify({'success': True, 'jobs': mirror_downloads.jobs()})
+
+@app.route('/api/downloads', methods=['POST'])
+def api_download_start():
+    """API: Refresh an image's assets from its mirrors.
+
+    Body: {"image": "ubuntu_2404_desktop", "fields": optional list of
+    kernel/initrd/squashfs (default: every field with sources), "urls":
+    optional mirror URLs overriding the catalog, "sha256": optional}.
+    """
+    data = request.get_json(silent=True) or {}
+    fields = data.get('fields')
+    if fields is not None and not isinstance(fields, list):
+        fields = [fields]
+    try:
+        jobs = mirror_downloads.submit(data.get('image'), fields=fields, urls=data.get('urls'),
+                                       sha256=data.get('sha256'))
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    return jsonify({'success': True, 'jobs': jobs}), 202
+
+@app.route('/api/downloads/<job_id>', methods=['GET'])
+def api_download_get(job_id):
+    """API: Download job state and progress"""
+    try:
+        return jsonify({'success': True, 'job': mirror_downloads.get(job_id)})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/downloads/<job_id>', methods=['DELETE'])
+def api_download_cancel(job_id):
+    """API: Stop a download; its partial file is kept for resuming"""
+    try:
+        return jsonify({'success': True, 'job': mirror_downloads.cancel(job_id)})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/verify', methods=['GET'])
+def api_verify():
+    """API: Quick asset check (stat, headers, cached digests) and verification jobs"""
+    try:
+        report = asset_verifier.check(load_images())
+    except OSError as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, **report, 'jobs': verify_jobs.jobs()})
+
+@app.route('/api/verify', methods=['POST'])
+def api_verify_start():
+    """API: Hash every asset without a cached digest and compare checksums.
+
+    Body: {"record": false}; with record, digests of assets that have no
+    checksum in images.yaml are stored there.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        job = verify_jobs.submit(record=data.get('record', False))
+    except (JobError, OSError) as e:
+        return jsonify({'success': False, 'error': str(e)}), getattr(e, 'status', 500)
+    return jsonify({'success': True, 'job': job}), 202
+
+@app.route('/api/verify/<job_id>', methods=['GET'])
+def api_verify_get(job_id):
+    """API: Verification job progress and result"""
+    try:
+        return jsonify({'success': True, 'job': verify_jobs.get(job_id)})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/verify/<job_id>', methods=['DELETE'])
+def api_verify_cancel(job_id):
+    """API: Stop a verification; digests hashed so far stay cached"""
+    try:
+        return jsonify({'success': True, 'job': verify_jobs.cancel(job_id)})
+    except JobError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+@app.route('/api/admission', methods=['GET'])
+def api_admission():
+    """API: Download slots in use and queue depth, overall and per image"""
+    return jsonify({'success': True, **admission.metrics()})
+
+@app.route('/api/boot/funnel', methods=['GET'])
+def api_boot_funnel():
+    """API: Boot sessions in the window: stage funnel, success rate, time-to-kernel, per image"""
+    snapshot = get_stats_snapshot()
+    funnel = snapshot['data'].get('funnel')
+    if not funnel:
+        return jsonify({'success': False, 'error': 'Boot funnel not collected yet'}), 503
+    return jsonify({'success': True, 'age': snapshot['age'], **funnel})
+
+@app.route('/api/boot/sessions', methods=['GET'])
+def api_boot_sessions():
+    """API: Newest boot sessions with stage timings (?client=<mac|ip>&limit=)"""
+    try:
+        limit = min(1000, max(1, int(request.args.get('limit', 100))))
+    except ValueError:
+        limit = 100
+    sessions = boot_funnel.sessions(request.args.get('client'), limit)
+    return jsonify({'success': True, 'count': len(sessions), 'sessions': sessions})
+
+@app.route('/api/history', methods=['GET'])
+def api_history_series():
+    """API: Recorded series with their kind and labels"""
+    try:
+        return jsonify({'success': True, 'series': history.series()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/history/events', methods=['GET'])
+def api_history_events():
+    """API: Service state changes (?start=-7d&end=&kind=service)"""
+    try:
+        events = history.events(parse_time(request.args.get('start')), parse_time(request.args.get('end')),
+                                request.args.get('kind'))
+    except HistoryError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, 'count': len(events), 'events': events})
+
+@app.route('/api/history/<series>', methods=['GET'])
+def api_history_query(series):
+    """API: One series over a range, downsampled.
+
+    ?start=-14d&end=now&step=86400&label=<image|service>; start/end take
+    epoch seconds, ISO dates or relative offsets (-30m, -12h, -7d, -4w).
+    Without step the resolution (minute/hour/day) follows the range.
+    """
+    try:
+        step = request.args.get('step', type=int)
+        result = history.query(series, parse_time(request.args.get('start')),
+                               parse_time(request.args.get('end')), step, request.args.get('label', ''))
+    except HistoryError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, **result})
+
+@app.route('/api/profiling', methods=['GET'])
+def api_profiling():
+    """API: Profiling settings, armed captures and the newest slow requests (?limit=)"""
+    try:
+        limit = min(500, max(1, int(request.args.get('limit', 50))))
+    except ValueError:
+        limit = 50
+    return jsonify({'success': True, 'config': profiler.config, 'captures': profiler.captures(),
+                    'slow': profiler.slow_requests(limit)})
+
+@app.route('/api/profiling/captures', methods=['POST'])
+def api_profiling_arm():
+    """API: Profile the next requests under a path.
+
+    Body: {"path": "/images", "mode": "cprofile"|"sample", "count": 1,
+    "method": optional}.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        capture = profiler.arm(data.get('path'), mode=data.get('mode', 'cprofile'),
+                               count=data.get('count', 1), method=data.get('method'))
+    except (ProfilingError, OSError) as e:
+        return jsonify({'success': False, 'error': str(e)}), getattr(e, 'status', 500)
+    return jsonify({'success': True, 'capture': capture}), 201
+
+@app.route('/api/profiling/captures/<capture_id>', methods=['DELETE'])
+def api_profiling_remove(capture_id):
+    """API: Disarm a capture and delete its results"""
+    try:
+        profiler.remove(capture_id)
+    except (ProfilingError, OSError) as e:
+        return jsonify({'success': False, 'error': str(e)}), getattr(e, 'status', 500)
+    return jsonify({'success': True})
+
+@app.route('/api/profiling/captures/<capture_id>/<name>', methods=['GET'])
+def api_profiling_result(capture_id, name):
+    """API: Download a captured profile (.prof for pstats/snakeviz, .folded for flame graphs)"""
+    try:
+        path = profiler.result_path(capture_id, name)
+    except ProfilingError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    return send_file(path, as_attachment=not name.endswith('.json'),
+                     download_name=f'{capture_id}-{name}', max_age=0)
+
 @app.route('/api/system/status', methods=['GET'])
 def api_system_status():
     """API: Get system status"""
+    snapshot = get_stats_snapshot()
     return jsonify({
         'success': True,
-        'services': {
-            'dhcp': get_service_status('isc-dhcp-server'),
-            'tftp': get_service_status('tftpd-hpa'),
-            'nginx': get_service_status('nginx'),
-            'web': get_service_status('knetboot-web')
-        },
-        'disk_usage': get_disk_usage()
+        'services': snapshot['data']['services'],
+        'service_details': snapshot['data'].get('service_details') or {},
+        'disk_usage': snapshot['data']['disk'],
+        'boot_stats': snapshot['data']['boot'],
+        'uptime': snapshot['data']['uptime'],
+        'http_boot': snapshot['data'].get('http_boot') or {},
+        'collected_at': snapshot['collected_at'],
+        'age': snapshot['age'],
+        'stale': snapshot['stale']
     })
 
+def snapshot_gauges(snapshot):
+    """Gauges for /metrics from the shared stats snapshot (no extra probing)"""
+    data = snapshot['data']
+    boot = data['boot']
+    http_boot = data.get('http_boot') or {}
+    admission_state = data.get('admission') or {}
+    gauges = [
+        ('knetboot_boots_today', 'TFTP boot attempts since midnight by result',
+         [({'result': 'attempts'}, boot.get('total_boots_today', 0)),
+          ({'result': 'successful'}, boot.get('successful_boots', 0)),
+          ({'result': 'failed'}, boot.get('failed_boots', 0))]),
+        ('knetboot_tftp_file_requests_today', 'TFTP read requests since midnight per file',
+         [({'file': name}, count) for name, count in sorted((boot.get('file_requests') or {}).items())]),
+        ('knetboot_http_boot_transfers_today', 'HTTP boot file transfers since midnight per file',
+         [({'file': name}, counts['transfers']) for name, counts in sorted((http_boot.get('files') or {}).items())]),
+        ('knetboot_active_leases', 'Bound, unexpired DHCP leases',
+         [({}, boot.get('active_leases', 0))]),
+        ('knetboot_service_up', 'Managed systemd service is active',
+         [({'service': name}, int(up)) for name, up in sorted(data['services'].items())]),
+        ('knetboot_stats_age_seconds', 'Age of the shared stats snapshot these gauges come from',
+         [({}, snapshot['age'])])
+    ]
+    if admission_state:
+        gauges += [
+            ('knetboot_admission_slots', 'squashfs download slots per image and state',
+             [({'image': image_id, 'state': state}, entry[state])
+              for image_id, entry in sorted(admission_state.get('by_image', {}).items())
+              for state in ('active', 'downloading', 'queued')]),
+            ('knetboot_admission_queue_depth', 'Clients waiting for a download slot',
+             [({}, admission_state.get('queue_depth', 0))])
+        ]
+    return gauges
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus exposition: request, command, YAML and boot metrics of all workers"""
+    try:
+        body = metrics.render(snapshot_gauges(get_stats_snapshot()))
+    except OSError as e:
+        return f"# metrics unavailable: {e}\n", 500, {'Content-Type': METRICS_CONTENT_TYPE}
+    return Response(body, content_type=METRICS_CONTENT_TYPE)
+
 if __name__ == '__main__':
     # Development server
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,339 @@
+"""
+Kapadokya NetBoot - Content-Addressed Asset Store
+Keeps one copy of each kernel/initrd/squashfs under assets/.store by
+SHA-256 and hardlinks it (or symlinks it across filesystems) into the
+legacy assets/... paths that images.yaml refers to. A reference index
+built from the catalog tells which blobs are still used, so unreferenced
+ones can be garbage collected.
+"""
+
+import errno
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from storage import ASSET_FIELDS, format_bytes
+
+STORE_DIRNAME = '.store'
+HASH_CHUNK = 16 * 1024 * 1024
+
+
+def _atomic_json(path, data):
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.store-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def hash_file(path, progress=None):
+    """SHA-256 of a file read through mmap; progress(nbytes) after each slice.
+
+    hashlib releases the GIL on large updates, so several files hash in
+    parallel on a thread pool.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return sha.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                for offset in range(0, size, HASH_CHUNK):
+                    with view[offset:offset + HASH_CHUNK] as chunk:
+                        sha.update(chunk)
+                    if progress:
+                        progress(min(HASH_CHUNK, size - offset))
+    return sha.hexdigest()
+
+
+def digest_key(st):
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+class AssetStore:
+    """Blobs in <assets>/.store/sha256/ab/<digest>, linked into legacy paths"""
+
+    def __init__(self, base_dir, assets_dir=None):
+        self.base_dir = str(base_dir)
+        self.assets_dir = str(assets_dir or os.path.join(self.base_dir, 'assets'))
+        self.store_dir = os.path.join(self.assets_dir, STORE_DIRNAME)
+        self.blob_dir = os.path.join(self.store_dir, 'sha256')
+        self.digests_path = os.path.join(self.store_dir, 'digests.json')
+        self.refs_path = os.path.join(self.store_dir, 'refs.json')
+        self._digests = None
+        self._digests_lock = threading.Lock()
+
+    def resolve(self, rel_path):
+        """Map an images.yaml asset path to an absolute path"""
+        return os.path.join(self.base_dir, rel_path)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    # Digest cache ---------------------------------------------------------
+
+    def _load_digests(self):
+        if self._digests is None:
+            try:
+                with open(self.digests_path) as f:
+                    self._digests = json.load(f)
+            except (OSError, ValueError):
+                self._digests = {}
+        return self._digests
+
+    def save_digests(self):
+        if self._digests is not None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            with self._digests_lock:
+                data = dict(self._digests)
+            _atomic_json(self.digests_path, data)
+
+    def reload_digests(self):
+        """Pick up digests other processes have cached since the last load"""
+        self._digests = None
+
+    def cached_digest(self, st):
+        """Cached SHA-256 for a stat result, or None"""
+        return self._load_digests().get(digest_key(st))
+
+    def remember_digest(self, st, digest):
+        with self._digests_lock:
+            self._load_digests()[digest_key(st)] = digest
+
+    def digest(self, path, st=None, progress=None):
+        """SHA-256 of a file, cached by (device, inode, size, mtime)"""
+        st = st or os.stat(path)
+        digest = self.cached_digest(st)
+        if digest is None:
+            digest = hash_file(path, progress)
+            self.remember_digest(st, digest)
+        return digest
+
+    # Reference index ------------------------------------------------------
+
+    def build_references(self, images, hash_files=True):
+        """{rel_path: {'images': [...], 'digest': ...}} for every catalog asset.
+
+        Without hash_files only cached digests are used and nothing is
+        written; assets not hashed yet keep digest None. An asset that
+        could not be read gets 'error' (FileNotFoundError: 'missing').
+        """
+        refs = {}
+        for image in images:
+            for field in ASSET_FIELDS:
+                rel_path = image.get(field)
+                if not rel_path:
+                    continue
+                entry = refs.setdefault(rel_path, {'images': [], 'digest': None})
+                entry['images'].append(image.get('id'))
+        for rel_path, entry in refs.items():
+            path = os.path.realpath(self.resolve(rel_path))
+            try:
+                if hash_files:
+                    entry['digest'] = self.digest(path)
+                else:
+                    entry['digest'] = self.cached_digest(os.stat(path))
+            except FileNotFoundError:
+                entry['error'] = 'missing'
+            except OSError as e:
+                entry['error'] = e.strerror
+        if not hash_files:
+            return refs
+        try:
+            os.makedirs(self.store_dir, exist_ok=True)
+            self.save_digests()
+            _atomic_json(self.refs_path, {'built_at': time.time(), 'paths': refs})
+        except OSError as e:
+            # Read-only callers still get the index
+            print(f"Error saving asset reference index: {e}")
+        return refs
+
+    # Deduplication --------------------------------------------------------
+
+    def _link_into(self, blob, path):
+        """Atomically replace path with a hardlink (or symlink) to blob"""
+        tmp_path = f"{path}.store-tmp"
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(blob, tmp_path)
+            mode = 'hardlink'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            os.symlink(blob, tmp_path)
+            mode = 'symlink'
+        os.replace(tmp_path, path)
+        return mode
+
+    def ingest(self, rel_path):
+        """Move one legacy asset into the store; returns what happened"""
+        path = self.resolve(rel_path)
+        if os.path.islink(path):
+            target = os.path.realpath(path)
+            return {'path': rel_path, 'action': 'symlinked' if target.startswith(self.blob_dir) else 'skipped',
+                    'saved': 0}
+        st = os.stat(path)
+        digest = self.digest(path, st)
+        blob = self.blob_path(digest)
+        try:
+            blob_st = os.stat(blob)
+        except FileNotFoundError:
+            blob_st = None
+
+        if blob_st is None:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                # Store on another filesystem: copy the bytes there, symlink back
+                tmp_path = f"{blob}.tmp"
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, blob)
+                self._link_into(blob, path)
+            os.chmod(blob, 0o444)
+            return {'path': rel_path, 'action': 'stored', 'digest': digest, 'saved': 0}
+
+        if (blob_st.st_dev, blob_st.st_ino) == (st.st_dev, st.st_ino):
+            return {'path': rel_path, 'action': 'linked', 'digest': digest, 'saved': 0}
+
+        # Same bytes already stored: drop this copy in favour of the blob
+        saved = st.st_blocks * 512 if st.st_nlink == 1 else 0
+        mode = self._link_into(blob, path)
+        return {'path': rel_path, 'action': f'deduplicated ({mode})', 'digest': digest, 'saved': saved}
+
+    def dedupe(self, images):
+        """Ingest every catalog asset; returns per-file results and bytes saved"""
+        results = []
+        saved = 0
+        for rel_path in sorted(self.build_references(images)):
+            try:
+                result = self.ingest(rel_path)
+            except OSError as e:
+                result = {'path': rel_path, 'action': 'error', 'error': str(e), 'saved': 0}
+            saved += result['saved']
+            results.append(result)
+        self.save_digests()
+        self.build_references(images)
+        return {'files': results, 'saved_bytes': saved, 'saved': format_bytes(saved)}
+
+    # Garbage collection ---------------------------------------------------
+
+    def blobs(self):
+        """(digest, path, stat) for every blob in the store"""
+        if not os.path.isdir(self.blob_dir):
+            return
+        for prefix in sorted(os.listdir(self.blob_dir)):
+            directory = os.path.join(self.blob_dir, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for digest in sorted(os.listdir(directory)):
+                if len(digest) != 64:
+                    continue  # interrupted copies (.tmp)
+                path = os.path.join(directory, digest)
+                yield digest, path, os.stat(path)
+
+    def gc(self, images, dry_run=False):
+        """Remove blobs no catalog asset refers to.
+
+        A blob still hardlinked from a path outside the catalog is removed
+        from the store only; its bytes are freed once that path goes too.
+        Nothing is removed while any catalog asset other than a missing one
+        cannot be hashed ('aborted' says which).
+        """
+        refs = self.build_references(images)
+        # A reference we could not read may point at any blob: delete nothing
+        unreadable = sorted(p for p, e in refs.items() if e.get('error') not in (None, 'missing'))
+        if unreadable:
+            return {'removed': [], 'reclaimed_bytes': 0, 'reclaimed': format_bytes(0), 'dry_run': dry_run,
+                    'aborted': f"could not hash {', '.join(unreadable)}"}
+        referenced = {e['digest'] for e in refs.values() if e['digest']}
+        removed = []
+        reclaimed = 0
+        for digest, path, st in self.blobs():
+            if digest in referenced:
+                continue
+            freed = st.st_blocks * 512 if st.st_nlink == 1 else 0
+            removed.append({'digest': digest, 'bytes': st.st_size, 'freed': freed, 'links': st.st_nlink - 1})
+            reclaimed += freed
+            if not dry_run:
+                os.unlink(path)
+        if not dry_run:
+            # Forget digests of inodes that no longer exist
+            digests = self._load_digests()
+            live = {d for d, _, _ in self.blobs()} | referenced
+            self._digests = {k: v for k, v in digests.items() if v in live}
+            self.save_digests()
+        return {'removed': removed, 'reclaimed_bytes': reclaimed, 'reclaimed': format_bytes(reclaimed),
+                'dry_run': dry_run}
+
+    # Reporting ------------------------------------------------------------
+
+    def report(self, images):
+        """Logical vs unique bytes of the catalog's assets and store usage.
+
+        Never hashes: assets without a cached digest are counted as
+        'unhashed' unless they are links to a blob (dedupe, verify and the
+        CLI fill the digest cache).
+        """
+        self.reload_digests()
+        refs = self.build_references(images, hash_files=False)
+        blobs = list(self.blobs())
+        blob_inodes = {(st.st_dev, st.st_ino): digest for digest, _, st in blobs}
+        stored = set(blob_inodes.values())
+        logical = 0
+        physical = 0
+        seen = set()
+        for rel_path, entry in refs.items():
+            try:
+                st = os.stat(self.resolve(rel_path))
+            except OSError:
+                continue
+            if entry['digest'] is None:
+                # Hardlinked or symlinked into the store: the blob name is the digest
+                entry['digest'] = blob_inodes.get((st.st_dev, st.st_ino))
+            logical += st.st_size * len(entry['images'])
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                physical += st.st_size
+        referenced = {e['digest'] for e in refs.values() if e['digest']}
+        unhashed = sum(1 for e in refs.values() if e['digest'] is None and 'error' not in e)
+        blob_count = 0
+        blob_bytes = 0
+        unreferenced = 0
+        unreferenced_bytes = 0
+        for digest, _, st in blobs:
+            blob_count += 1
+            blob_bytes += st.st_blocks * 512
+            if digest not in referenced:
+                unreferenced += 1
+                unreferenced_bytes += st.st_blocks * 512
+        in_store = sum(1 for e in refs.values() if e['digest'] in stored)
+        saved = max(0, logical - physical)
+        return {
+            'assets': len(refs),
+            'in_store': in_store,
+            'unhashed': unhashed,
+            'unique_digests': len(referenced),
+            'logical_bytes': logical,
+            'physical_bytes': physical,
+            'saved_bytes': saved,
+            'saved': format_bytes(saved),
+            'blobs': blob_count,
+            'blob_bytes': blob_bytes,
+            # Approximate while assets are unhashed: their blobs look unreferenced
+            'unreferenced_blobs': unreferenced,
+            'unreferenced_bytes': unreferenced_bytes
+        }
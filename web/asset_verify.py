@@ -0,0 +1,282 @@
+"""
+Kapadokya NetBoot - Asset Verification
+Checks that the kernel, initrd and squashfs of every image in images.yaml
+exist and look intact. A quick check (stat, header sanity, cached digest)
+runs on every Images page load; a full check hashes the files not hashed
+yet on a thread pool and compares them with the catalog's checksums.
+The broken images are published to a small shared file for the boot
+path (per-client menus), which never runs a check itself.
+Digests are cached in the asset store's index by (device, inode, size,
+mtime), so re-verifying unchanged files costs one stat each.
+"""
+
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asset_store import digest_key
+from jobs import BackgroundJobs
+from storage import ASSET_FIELDS, format_bytes
+
+HEADER_BYTES = 1024
+SQUASHFS_MAGIC = b'hsqs'
+# Quick verdicts are reused while the catalog and digest cache are
+# unchanged, but no longer than this so deleted assets still show up
+VERDICT_MAX_AGE = 60
+
+
+def check_header(field, path, size):
+    """Why the file is clearly not a usable <field>, or None"""
+    if size == 0:
+        return 'empty file'
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_BYTES)
+    if field == 'squashfs':
+        if head[:4] != SQUASHFS_MAGIC:
+            return 'not a squashfs image'
+        # Superblock bytes_used: a shorter file was cut off while copying
+        bytes_used = struct.unpack_from('<Q', head, 40)[0]
+        if bytes_used > size:
+            return f'truncated ({format_bytes(size)} of {format_bytes(bytes_used)})'
+    elif field == 'kernel':
+        # bzImage setup header, PE/EFI stub, or arm64 Image
+        if head[:2] != b'MZ' and head[0x202:0x206] != b'HdrS' and head[0x38:0x3c] != b'ARM\x64':
+            return 'not a kernel image'
+    return None
+
+
+class AssetVerifier:
+    """Existence, header and checksum checks over the image catalog"""
+
+    def __init__(self, store, workers=4):
+        self.store = store
+        self.workers = max(1, int(workers))
+        # Header verdicts per file version; headers are re-read only on change
+        self._headers = {}
+        self._verdicts = None
+        self._lock = threading.Lock()
+
+    def _inspect(self, field, rel_path):
+        """(stat or None, problem or None) for one asset path"""
+        path = self.store.resolve(rel_path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None, 'missing'
+        except OSError as e:
+            return None, e.strerror
+        key = (field, digest_key(st))
+        with self._lock:
+            if key in self._headers:
+                return st, self._headers[key]
+        try:
+            problem = check_header(field, path, st.st_size)
+        except OSError as e:
+            problem = e.strerror
+        with self._lock:
+            self._headers[key] = problem
+        return st, problem
+
+    def pending_bytes(self, images):
+        """Bytes a full check still has to hash"""
+        total = 0
+        for rel_path, field in self._assets(images).items():
+            st, problem = self._inspect(field, rel_path)
+            if st is not None and problem is None and self.store.cached_digest(st) is None:
+                total += st.st_size
+        return total
+
+    @staticmethod
+    def _assets(images):
+        assets = {}
+        for image in images:
+            for field in ASSET_FIELDS:
+                if image.get(field):
+                    assets.setdefault(image[field], field)
+        return assets
+
+    def check(self, images, hash_files=False, progress=None):
+        """Per-image verdicts: ok, broken (missing/corrupt) or unverified (not hashed yet).
+
+        With hash_files, assets without a cached digest are hashed on the
+        thread pool first; progress(nbytes) reports hashed bytes.
+        """
+        started = time.monotonic()
+        self.store.reload_digests()
+        files = {}
+        for rel_path, field in self._assets(images).items():
+            st, problem = self._inspect(field, rel_path)
+            digest = self.store.cached_digest(st) if st is not None and problem is None else None
+            files[rel_path] = {'stat': st, 'problem': problem, 'sha256': digest}
+
+        hashed = 0
+        if hash_files:
+            pending = [(p, f['stat']) for p, f in files.items() if f['stat'] is not None
+                       and f['problem'] is None and f['sha256'] is None]
+
+            def digest(item):
+                rel_path, st = item
+                try:
+                    return rel_path, self.store.digest(self.store.resolve(rel_path), st, progress), None
+                except OSError as e:
+                    return rel_path, None, e.strerror
+
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='verify') as pool:
+                    for rel_path, sha256, error in pool.map(digest, pending):
+                        files[rel_path]['sha256'] = sha256
+                        files[rel_path]['problem'] = error
+                        if sha256:
+                            hashed += files[rel_path]['stat'].st_size
+            finally:
+                # Keep what was hashed even if the run was cancelled
+                if pending:
+                    try:
+                        self.store.save_digests()
+                    except OSError as e:
+                        print(f"Error saving digest cache: {e}")
+
+        results = {}
+        summary = {'ok': 0, 'broken': 0, 'unverified': 0}
+        for image in images:
+            assets = {}
+            problems = []
+            unverified = False
+            for field in ASSET_FIELDS:
+                rel_path = image.get(field)
+                if not rel_path:
+                    continue
+                info = files[rel_path]
+                expected = (image.get('checksums') or {}).get(field)
+                problem = info['problem']
+                if problem is None and info['sha256'] and expected and info['sha256'] != expected.lower():
+                    problem = 'checksum mismatch'
+                if problem:
+                    status = 'missing' if problem == 'missing' else 'corrupt'
+                    problems.append(f'{field} {problem}')
+                elif info['sha256'] is None:
+                    status = 'unhashed'
+                    unverified = True
+                else:
+                    status = 'ok'
+                assets[field] = {
+                    'path': rel_path,
+                    'status': status,
+                    'problem': problem,
+                    'size': info['stat'].st_size if info['stat'] else None,
+                    'sha256': info['sha256'],
+                    'expected': expected
+                }
+            status = 'broken' if problems else 'unverified' if unverified else 'ok'
+            summary[status] += 1
+            results[image.get('id')] = {'status': status, 'problems': problems, 'assets': assets}
+
+        return {
+            'images': results,
+            'summary': summary,
+            'hashed_bytes': hashed,
+            'duration_ms': round((time.monotonic() - started) * 1000, 1),
+            'checked_at': time.time()
+        }
+
+    def cached_check(self, registry):
+        """check() of the registry's images, reused until images.yaml or digests.json change"""
+        try:
+            digests_mtime = os.stat(self.store.digests_path).st_mtime_ns
+        except OSError:
+            digests_mtime = None
+        key = (registry.version(), digests_mtime)
+        with self._lock:
+            cached = self._verdicts
+        if cached and cached[0] == key and time.monotonic() - cached[1] < VERDICT_MAX_AGE:
+            return cached[2]
+        report = self.check(registry.images())
+        with self._lock:
+            self._verdicts = (key, time.monotonic(), report)
+        return report
+
+    def publish(self, registry, path):
+        """Quick-check the catalog and publish its broken images; returns a summary"""
+        broken = broken_reasons(self.cached_check(registry))
+        publish_verdicts(path, broken)
+        return {'broken': len(broken)}
+
+    def broken(self, images):
+        """{image id: reason} for images with a missing or corrupt asset (no hashing)"""
+        return broken_reasons(self.check(images))
+
+
+def broken_reasons(report):
+    """{image id: reason} for the broken images of a check() report"""
+    return {image_id: ', '.join(result['problems'])
+            for image_id, result in report['images'].items() if result['status'] == 'broken'}
+
+
+def load_verdicts(path):
+    """{image id: reason} published by publish_verdicts(), {} if there is none yet"""
+    try:
+        with open(path) as f:
+            return json.load(f).get('broken', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def publish_verdicts(path, broken):
+    """Write the broken images to path, only when they changed (readers key on its stat)"""
+    if os.path.exists(path) and load_verdicts(path) == broken:
+        return
+    directory = os.path.dirname(str(path)) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.verdicts-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'broken': broken, 'published_at': time.time()}, f)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+class VerifyJobs(BackgroundJobs):
+    """Full verification runs (hash everything not hashed yet)"""
+
+    kind = 'verify'
+
+    def __init__(self, state_dir, verifier, registry, verdicts_path=None):
+        super().__init__(state_dir, workers=1)
+        self.verifier = verifier
+        self.registry = registry
+        # Where the broken images found are published for the boot path
+        self.verdicts_path = verdicts_path
+
+    def submit(self, record=False):
+        """Queue a full check; record=True stores digests of assets without a checksum"""
+        running = self.active()
+        if running:
+            return running[0]
+        return self.start(record=bool(record),
+                          bytes_total=self.verifier.pending_bytes(self.registry.images()))
+
+    def run(self, job, progress):
+        images = self.registry.images()
+        report = self.verifier.check(images, hash_files=True, progress=lambda n: progress('hash', n))
+        recorded = 0
+        if job['record']:
+            operations = []
+            for image in images:
+                result = report['images'].get(image.get('id'))
+                checksums = dict(image.get('checksums') or {})
+                for field, asset in result['assets'].items():
+                    if asset['status'] == 'ok' and not asset['expected']:
+                        checksums[field] = asset['sha256']
+                if checksums != (image.get('checksums') or {}):
+                    operations.append({'op': 'update', 'id': image['id'], 'fields': {'checksums': checksums}})
+            if operations:
+                self.registry.apply(operations)
+                recorded = len(operations)
+        broken = {image_id: r['problems'] for image_id, r in report['images'].items() if r['status'] == 'broken'}
+        if self.verdicts_path:
+            publish_verdicts(self.verdicts_path, broken_reasons(report))
+        return {'summary': report['summary'], 'broken': broken, 'hashed_bytes': report['hashed_bytes'],
+                'recorded': recorded}
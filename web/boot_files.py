@@ -0,0 +1,187 @@
+"""
+Kapadokya NetBoot - HTTP Boot Files
+Content-hash manifest of the files under TFTP_ROOT, used to answer
+conditional requests without reading the file, and per-file transfer
+counters shared by all gunicorn workers.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import date
+
+HASH_CHUNK = 1024 * 1024
+
+# Histogram size cap, as in tftp_journal
+MAX_TRACKED_FILES = 256
+OTHER_FILES = '(other)'
+
+
+def _atomic_json(path, data, prefix):
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BootFileManifest:
+    """SHA-256, size and mtime of boot files, keyed by (inode, mtime, size).
+
+    Digests are kept in memory and persisted to a JSON file so other
+    workers (and restarts) reuse them; a file is only re-hashed after it
+    was replaced or modified.
+    """
+
+    def __init__(self, root, state_path):
+        self.root = root
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._state_key = None
+
+    def _load_state(self):
+        try:
+            st = os.stat(self.state_path)
+        except OSError:
+            return
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if key == self._state_key:
+            return
+        try:
+            with open(self.state_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        for name, entry in entries.items():
+            self._entries.setdefault(name, entry)
+        self._state_key = key
+
+    def resolve(self, filename):
+        """Absolute path of filename under root, or None if it escapes it"""
+        root = os.path.realpath(self.root)
+        path = os.path.realpath(os.path.join(root, filename))
+        if path != root and path.startswith(root + os.sep):
+            return path
+        return None
+
+    def lookup(self, filename):
+        """Manifest entry for a boot file, or None if it does not exist"""
+        path = self.resolve(filename)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        key = [st.st_ino, st.st_mtime_ns, st.st_size]
+
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or entry['key'] != key:
+                self._load_state()
+                entry = self._entries.get(filename)
+        if entry is not None and entry['key'] == key:
+            return dict(entry, path=path)
+
+        entry = {
+            'key': key,
+            'sha256': file_sha256(path),
+            'size': st.st_size,
+            'mtime': st.st_mtime
+        }
+        with self._lock:
+            self._entries[filename] = entry
+            try:
+                _atomic_json(self.state_path, self._entries, '.boot-files-')
+            except OSError as e:
+                print(f"Error saving boot file manifest: {e}")
+        return dict(entry, path=path)
+
+
+def _empty_counts(day):
+    return {
+        'day': day,
+        'transfers': 0,
+        'bytes': 0,
+        'not_modified': 0,
+        'files': {}
+    }
+
+
+class TransferCounter:
+    """Today's HTTP boot transfers per file, merged under a lock file"""
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.lock_path = f"{state_path}.lock"
+
+    def load_state(self):
+        today = date.today().isoformat()
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return _empty_counts(today)
+        if state.get('day') != today:
+            return _empty_counts(today)
+        return state
+
+    def record(self, filename, nbytes=0, not_modified=False):
+        """Count one response for filename (body bytes, or a 304)"""
+        try:
+            with open(self.lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                state = self.load_state()
+                if not_modified:
+                    state['not_modified'] += 1
+                else:
+                    state['transfers'] += 1
+                    state['bytes'] += nbytes
+                files = state['files']
+                if filename not in files and len(files) >= MAX_TRACKED_FILES:
+                    filename = OTHER_FILES
+                counts = files.setdefault(filename, {'transfers': 0, 'bytes': 0, 'not_modified': 0})
+                if not_modified:
+                    counts['not_modified'] += 1
+                else:
+                    counts['transfers'] += 1
+                    counts['bytes'] += nbytes
+                _atomic_json(self.state_path, state, '.http-transfers-')
+        except OSError as e:
+            print(f"Error recording boot file transfer: {e}")
+
+    def get_stats(self):
+        """Totals and the per-file histogram for the stats snapshot"""
+        state = self.load_state()
+        files = state['files']
+        return {
+            'transfers': state['transfers'],
+            'bytes': state['bytes'],
+            'not_modified': state['not_modified'],
+            'most_requested': max(files, key=lambda f: files[f]['transfers']) if files else None,
+            'files': files
+        }
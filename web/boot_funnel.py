@@ -0,0 +1,573 @@
+"""
+Kapadokya NetBoot - Boot Funnel
+Reconstructs per-client boot sessions by joining DHCP and TFTP events from
+the journal (or the built-in TFTP server's transfer log) with menu, kernel,
+initrd and squashfs fetches from the nginx boot log, so success rates,
+time-to-kernel and the slowest stage can be reported per image.
+"""
+
+import fcntl
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+from metrics import metrics
+
+DEFAULTS = {
+    'nginx_log': '/var/log/nginx/knetboot-boot.log',
+    # A session with no new event for this long is closed as stalled/failed
+    'session_timeout': 300,
+    # Sessions kept for the summary (closed sessions beyond this are dropped)
+    'window_hours': 24,
+    'max_sessions': 5000,
+    # Upper bound on nginx log bytes read per refresh; the rest is read next time
+    'max_read_mb': 16
+}
+
+# Stages in boot order; a session records when it first reached each one
+STAGES = ('dhcp', 'tftp', 'menu', 'kernel', 'initrd', 'squashfs')
+BOOTLOADERS = ('.kpxe', '.efi', '.pxe', '.0')
+
+NGINX_LINE_RE = re.compile(r'^(\S+) \S+ \S+ \[([^\]]+)\] "(\S+) (\S+)[^"]*" (\d{3}) (\d+|-)')
+DHCPDISCOVER_RE = re.compile(r'DHCPDISCOVER from ((?:[0-9a-f]{2}:){5}[0-9a-f]{2})', re.I)
+DHCPACK_RE = re.compile(r'DHCPACK on ([\d.]+) to ((?:[0-9a-f]{2}:){5}[0-9a-f]{2})', re.I)
+RRQ_RE = re.compile(r'RRQ from (?:::ffff:)?([\d.]+) filename (\S+)')
+NAK_RE = re.compile(r'sending NAK \((\d+), ([^)]*)\) to (?:::ffff:)?([\d.]+)')
+SLOT_PATH_RE = re.compile(r'^/knetboot/slot/[^/]+/(.+)$')
+# Stage of an asset that is not in images.yaml (hand-written menu entries)
+ASSET_NAME_STAGES = (('squashfs', 'squashfs'), ('initrd', 'initrd'), ('vmlinuz', 'kernel'), ('linux', 'kernel'))
+
+MAX_SESSION_ERRORS = 10
+# IP to MAC bindings remembered from DHCPACKs
+MAX_BINDINGS = 10000
+
+
+def load_funnel_config(system_config):
+    """The 'boot_funnel' section of system.json merged over DEFAULTS"""
+    config = dict(DEFAULTS)
+    config.update(system_config.get('boot_funnel', {}) or {})
+    return config
+
+
+def _empty_state():
+    return {
+        'nginx': {'inode': None, 'offset': 0},
+        'cursor': None,
+        'tftp_seen': 0,
+        'bindings': {},
+        'open': {},
+        'closed': [],
+        # Bytes nginx sent per image (kernel, initrd, squashfs), never reset
+        'image_bytes': {}
+    }
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+
+def _median(values):
+    return _percentile(values, 0.5)
+
+
+def parse_nginx_line(line):
+    """Parse a 'combined' access log line into (ts, ip, path, status, bytes)"""
+    match = NGINX_LINE_RE.match(line)
+    if not match:
+        return None
+    ip, stamp, _method, target, status, sent = match.group(1, 2, 3, 4, 5, 6)
+    try:
+        ts = datetime.strptime(stamp, '%d/%b/%Y:%H:%M:%S %z').timestamp()
+    except ValueError:
+        return None
+    return ts, ip, target, int(status), 0 if sent == '-' else int(sent)
+
+
+def tail_lines(path, position, max_bytes):
+    """Complete lines appended to a log since position ({inode, offset}).
+
+    Rotation is followed by inode: if the file was renamed away (logrotate
+    without copytruncate), the rest of the old file is read from path.1
+    before starting the new one; a file that shrank was truncated in place
+    and is read from the start. position is updated in place.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return []
+    lines = []
+    if position['inode'] is not None and st.st_ino != position['inode']:
+        try:
+            rotated = f"{path}.1"
+            if os.stat(rotated).st_ino == position['inode']:
+                lines, _ = _read_lines(rotated, position['offset'], max_bytes)
+        except OSError:
+            pass
+        position['inode'], position['offset'] = st.st_ino, 0
+    elif st.st_size < position['offset']:
+        position['offset'] = 0
+    position['inode'] = st.st_ino
+    if st.st_size > position['offset']:
+        more, consumed = _read_lines(path, position['offset'], max_bytes)
+        lines.extend(more)
+        position['offset'] += consumed
+    return lines
+
+
+def _read_lines(path, offset, max_bytes):
+    """Read whole lines from offset, stopping once max_bytes were consumed"""
+    lines = []
+    consumed = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                # Line still being written; pick it up next time
+                break
+            consumed += len(raw)
+            lines.append(raw.decode('utf-8', 'replace'))
+            if consumed >= max_bytes:
+                break
+    return lines, consumed
+
+
+class BootFunnel:
+    """Per-client boot sessions backed by a JSON state file.
+
+    Every refresh reads only what is new in each source: the journal from
+    a stored cursor, the nginx boot log from a stored inode and offset,
+    and the built-in TFTP server's recent transfers newer than the last
+    one seen. Events are merged in time order and folded into the open
+    session of their client (keyed by MAC when known, otherwise by IP).
+    """
+
+    def __init__(self, state_path, config, registry, units=('isc-dhcp-server', 'tftpd-hpa'),
+                 transfers_path=None, lease_index=None, timeout=10):
+        self.state_path = state_path
+        self.lock_path = f"{state_path}.lock"
+        self.config = config
+        self.registry = registry
+        self.units = list(units)
+        self.transfers_path = transfers_path
+        self.lease_index = lease_index
+        self.timeout = timeout
+        self._assets_key = None
+        self._assets = {}
+        self._finals = {}
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return _empty_state()
+        fresh = _empty_state()
+        fresh.update(state)
+        return fresh
+
+    def save_state(self, state):
+        """Atomically write the state file"""
+        directory = os.path.dirname(self.state_path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.boot-funnel-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def asset_index(self):
+        """Map asset paths (assets/...) to (image_id, stage), rebuilt when the catalog changes"""
+        images = self.registry.images()
+        key = self.registry.version()
+        if key != self._assets_key:
+            assets = {}
+            finals = {}
+            for img in images:
+                final = None
+                for stage in ('kernel', 'initrd', 'squashfs'):
+                    if img.get(stage):
+                        assets[img[stage]] = (img['id'], stage)
+                        final = stage
+                finals[img['id']] = final
+            self._assets, self._finals = assets, finals
+            self._assets_key = key
+        return self._assets
+
+    def classify(self, target):
+        """(image, stage) for a requested URL; stage is None if it is not a boot fetch"""
+        parts = urlsplit(target)
+        path = parts.path
+        asset = None
+        if path.startswith('/knetboot/assets/'):
+            asset = 'assets/' + path[len('/knetboot/assets/'):]
+        else:
+            match = SLOT_PATH_RE.match(path)
+            if match:
+                asset = 'assets/' + match.group(1)
+        if asset:
+            known = self.asset_index().get(asset)
+            if known:
+                return known
+            name = os.path.basename(asset).lower()
+            return None, next((stage for word, stage in ASSET_NAME_STAGES if word in name), None)
+        if path == '/knetboot/slot.ipxe':
+            image = parse_qs(parts.query).get('image', [None])[0]
+            return image, 'slot'
+        if path.startswith('/knetboot/menus/') or path.endswith('.ipxe'):
+            return None, 'menu'
+        if path.startswith('/boot/http/') and path.endswith(BOOTLOADERS):
+            return None, 'tftp'
+        return None, None
+
+    def _journal_command(self, cursor):
+        cmd = ['journalctl', '--no-pager', '-o', 'json',
+               '--output-fields=MESSAGE,__REALTIME_TIMESTAMP,__CURSOR']
+        for unit in self.units:
+            cmd += ['-u', unit]
+        if cursor:
+            cmd += ['--after-cursor', cursor]
+        else:
+            cmd += ['--since', f"-{int(self.config['window_hours'])}h"]
+        return cmd
+
+    def read_journal(self, state, events):
+        """Append DHCP and TFTP events written since the stored cursor"""
+        if not self.units:
+            return
+        started = time.monotonic()
+        deadline = started + self.timeout
+        process = subprocess.Popen(self._journal_command(state['cursor']),
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        entries = 0
+        try:
+            for line in process.stdout:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries += 1
+                state['cursor'] = entry.get('__CURSOR', state['cursor'])
+                self.journal_event(entry, events)
+                if time.monotonic() > deadline:
+                    print("Timeout while reading boot journal, continuing next refresh")
+                    process.kill()
+                    break
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            returncode = process.wait()
+            metrics.observe('knetboot_subprocess_duration_seconds', time.monotonic() - started,
+                            command='journalctl')
+        if returncode not in (0, -9) and entries == 0 and state['cursor']:
+            # Cursor no longer valid (journal rotated/vacuumed): start over from the window
+            print("Boot journal cursor rejected, rereading the window")
+            state['cursor'] = None
+
+    def journal_event(self, entry, events):
+        message = entry.get('MESSAGE') or ''
+        if isinstance(message, list):
+            message = bytes(message).decode('utf-8', 'replace')
+        try:
+            ts = int(entry.get('__REALTIME_TIMESTAMP', 0)) / 1_000_000
+        except ValueError:
+            return
+        match = DHCPACK_RE.search(message)
+        if match:
+            events.append({'ts': ts, 'stage': 'dhcp', 'ip': match.group(1), 'mac': match.group(2).lower()})
+            return
+        match = DHCPDISCOVER_RE.search(message)
+        if match:
+            events.append({'ts': ts, 'stage': 'dhcp', 'ip': None, 'mac': match.group(1).lower()})
+            return
+        match = RRQ_RE.search(message)
+        if match and match.group(2).endswith(BOOTLOADERS):
+            events.append({'ts': ts, 'stage': 'tftp', 'ip': match.group(1), 'file': match.group(2)})
+            return
+        match = NAK_RE.search(message)
+        if match:
+            events.append({'ts': ts, 'stage': 'tftp', 'ip': match.group(3), 'error': match.group(2)})
+
+    def read_transfers(self, state, events):
+        """Append bootloader transfers finished by the built-in TFTP server"""
+        try:
+            with open(self.transfers_path) as f:
+                recent = json.load(f).get('recent', [])
+        except (OSError, ValueError):
+            return
+        seen = state['tftp_seen']
+        for record in recent:
+            finished = record.get('finished_at', 0)
+            if finished <= seen or not record.get('file', '').endswith(BOOTLOADERS):
+                continue
+            event = {'ts': finished - record.get('duration_ms', 0) / 1000, 'stage': 'tftp',
+                     'ip': record['client'], 'file': record['file']}
+            if record.get('status') != 'ok':
+                event['error'] = record.get('status')
+            events.append(event)
+            state['tftp_seen'] = max(state['tftp_seen'], finished)
+
+    def read_nginx(self, state, events):
+        """Append boot fetches logged by nginx since the stored offset"""
+        max_bytes = int(self.config['max_read_mb'] * 1024 * 1024)
+        try:
+            lines = tail_lines(self.config['nginx_log'], state['nginx'], max_bytes)
+        except OSError as e:
+            print(f"Error reading nginx boot log: {e}")
+            return
+        for line in lines:
+            parsed = parse_nginx_line(line)
+            if not parsed:
+                continue
+            ts, ip, target, status, sent = parsed
+            image, stage = self.classify(target)
+            if not stage:
+                continue
+            event = {'ts': ts, 'stage': stage, 'ip': ip, 'image': image}
+            if image and sent:
+                state['image_bytes'][image] = state['image_bytes'].get(image, 0) + sent
+            if stage == 'slot':
+                event['mac'] = parse_qs(urlsplit(target).query).get('mac', [''])[0].replace('-', ':').lower() or None
+            if status >= 400:
+                event['error'] = f"HTTP {status}"
+            events.append(event)
+
+    def client_key(self, state, event):
+        mac = event.get('mac')
+        ip = event.get('ip')
+        if mac and ip:
+            bindings = state['bindings']
+            bindings.pop(ip, None)
+            bindings[ip] = mac
+            if len(bindings) > MAX_BINDINGS:
+                del bindings[next(iter(bindings))]
+        if not mac and ip:
+            mac = state['bindings'].get(ip)
+            if not mac and self.lease_index is not None:
+                lease = self.lease_index.get(ip)
+                mac = lease['mac'] if lease else None
+        return mac or ip, mac
+
+    def ingest(self, state, event):
+        """Fold one event into its client's open session"""
+        key, mac = self.client_key(state, event)
+        if not key:
+            return
+        sessions = state['open']
+        ip = event.get('ip')
+        if mac and ip and ip != key and ip in sessions:
+            # Events seen before the MAC was known belong to the same client
+            self.adopt(sessions, sessions.pop(ip), key)
+        session = sessions.get(key)
+        stage = event['stage']
+        ts = event['ts']
+        if session and ts - session['last_seen'] > self.config['session_timeout']:
+            self.close(state, key, 'timeout')
+            session = None
+        if session and stage == 'tftp' and not event.get('error') and 'menu' in session['stages']:
+            # The client came back to the bootloader: it rebooted
+            dhcp = session.get('last_dhcp')
+            self.close(state, key, 'timeout')
+            session = self.open(state, key, dhcp if dhcp and ts - dhcp < 60 else ts)
+            if session['started_at'] < ts:
+                session['stages']['dhcp'] = session['started_at']
+        if session is None:
+            session = self.open(state, key, ts)
+        if mac:
+            session['mac'] = mac
+        if event.get('ip'):
+            session['ip'] = event['ip']
+        if event.get('image'):
+            session['image'] = event['image']
+        session['last_seen'] = max(session['last_seen'], ts)
+
+        if event.get('error'):
+            errors = session['errors']
+            if len(errors) < MAX_SESSION_ERRORS:
+                errors.append({'ts': ts, 'stage': stage, 'error': event['error']})
+            session['last_error'] = ts
+            return
+        if stage == 'dhcp':
+            session['last_dhcp'] = ts
+        if stage == 'slot':
+            session['slot_requests'] += 1
+            return
+        session['stages'].setdefault(stage, ts)
+        final = self._finals.get(session['image']) if session['image'] else 'squashfs'
+        if final and final in session['stages']:
+            self.close(state, key, 'complete')
+
+    def open(self, state, key, ts):
+        session = {
+            'client': key,
+            'mac': None,
+            'ip': None,
+            'image': None,
+            'started_at': ts,
+            'last_seen': ts,
+            'stages': {},
+            'errors': [],
+            'slot_requests': 0
+        }
+        state['open'][key] = session
+        return session
+
+    def adopt(self, sessions, orphan, key):
+        """File an IP-keyed session under its MAC, merging with one already there"""
+        session = sessions.get(key)
+        orphan['client'] = key
+        if session is None:
+            sessions[key] = orphan
+            return
+        for stage, ts in orphan['stages'].items():
+            session['stages'][stage] = min(ts, session['stages'].get(stage, ts))
+        session['started_at'] = min(session['started_at'], orphan['started_at'])
+        session['last_seen'] = max(session['last_seen'], orphan['last_seen'])
+        session['errors'] = (orphan['errors'] + session['errors'])[:MAX_SESSION_ERRORS]
+        session['slot_requests'] += orphan['slot_requests']
+        session['image'] = session['image'] or orphan['image']
+
+    def close(self, state, key, reason):
+        """Move a session to the closed list with its final status"""
+        session = state['open'].pop(key)
+        if reason == 'complete':
+            session['status'] = 'complete'
+        elif session['errors'] and session.get('last_error', 0) >= session['last_seen']:
+            session['status'] = 'failed'
+        else:
+            session['status'] = 'stalled'
+        reached = [s for s in STAGES if s in session['stages']]
+        session['last_stage'] = reached[-1] if reached else None
+        session.pop('last_dhcp', None)
+        session.pop('last_error', None)
+        state['closed'].append(session)
+
+    def expire(self, state, now):
+        """Close idle sessions and drop closed ones outside the window"""
+        timeout = self.config['session_timeout']
+        for key in [k for k, s in state['open'].items() if now - s['last_seen'] > timeout]:
+            self.close(state, key, 'timeout')
+        horizon = now - self.config['window_hours'] * 3600
+        closed = [s for s in state['closed'] if s['last_seen'] >= horizon]
+        state['closed'] = closed[-int(self.config['max_sessions']):]
+
+    def refresh(self):
+        """Read new events from every source and return the updated state"""
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.load_state()
+            self.asset_index()
+            events = []
+            try:
+                self.read_journal(state, events)
+            except OSError as e:
+                print(f"Error reading boot journal: {e}")
+            if self.transfers_path:
+                self.read_transfers(state, events)
+            self.read_nginx(state, events)
+            events.sort(key=lambda e: e['ts'])
+            for event in events:
+                self.ingest(state, event)
+            self.expire(state, time.time())
+            self.save_state(state)
+            return state
+
+    def sessions(self, client=None, limit=100):
+        """Newest sessions first, optionally for one MAC or IP"""
+        state = self.load_state()
+        result = sorted(list(state['open'].values()) + state['closed'],
+                        key=lambda s: s['started_at'], reverse=True)
+        if client:
+            client = client.strip().lower()
+            result = [s for s in result if client in (s['client'], s.get('mac'), s.get('ip'))]
+        return [self.describe(s) for s in result[:limit]]
+
+    def describe(self, session):
+        """Session with per-stage offsets and durations in seconds"""
+        result = dict(session)
+        result.setdefault('status', 'in_progress')
+        offsets = {}
+        durations = {}
+        previous = session['started_at']
+        for stage in STAGES:
+            if stage in session['stages']:
+                ts = session['stages'][stage]
+                offsets[stage] = round(ts - session['started_at'], 3)
+                durations[stage] = round(max(0.0, ts - previous), 3)
+                previous = ts
+        result['offsets'] = offsets
+        result['durations'] = durations
+        result['time_to_kernel'] = offsets.get('kernel')
+        result.pop('last_dhcp', None)
+        result.pop('last_error', None)
+        return result
+
+    def summary(self):
+        """Refresh and summarise the window: funnel, rates, percentiles, per image"""
+        state = self.refresh()
+        sessions = [self.describe(s) for s in state['closed']]
+        sessions += [self.describe(s) for s in state['open'].values()]
+        counts = {status: 0 for status in ('complete', 'failed', 'stalled', 'in_progress')}
+        funnel = {stage: 0 for stage in STAGES}
+        stalled_at = {}
+        ttk = []
+        total_time = []
+        per_image = {}
+        for session in sessions:
+            counts[session['status']] += 1
+            for stage in session['offsets']:
+                funnel[stage] += 1
+            if session['status'] in ('failed', 'stalled'):
+                where = session['last_stage'] or 'none'
+                stalled_at[where] = stalled_at.get(where, 0) + 1
+            if session['time_to_kernel'] is not None:
+                ttk.append(session['time_to_kernel'])
+            if session['status'] == 'complete' and session['offsets']:
+                total_time.append(max(session['offsets'].values()))
+            image = session.get('image')
+            if image:
+                entry = per_image.setdefault(image, {'sessions': 0, 'complete': 0, 'ttk': [], 'stages': {}})
+                entry['sessions'] += 1
+                entry['complete'] += session['status'] == 'complete'
+                if session['time_to_kernel'] is not None:
+                    entry['ttk'].append(session['time_to_kernel'])
+                for stage, duration in session['durations'].items():
+                    entry['stages'].setdefault(stage, []).append(duration)
+
+        images = {}
+        for image, entry in per_image.items():
+            medians = {stage: _median(values) for stage, values in entry['stages'].items()}
+            slowest = max(medians, key=medians.get) if medians else None
+            images[image] = {
+                'sessions': entry['sessions'],
+                'complete': entry['complete'],
+                'success_rate': int(entry['complete'] * 100 / entry['sessions']),
+                'time_to_kernel_p50': _median(entry['ttk']),
+                'time_to_kernel_p90': _percentile(entry['ttk'], 0.9),
+                'stage_medians': medians,
+                'slowest_stage': slowest
+            }
+
+        finished = counts['complete'] + counts['failed'] + counts['stalled']
+        return {
+            'window_hours': self.config['window_hours'],
+            'sessions': len(sessions),
+            **counts,
+            'success_rate': int(counts['complete'] * 100 / finished) if finished else 0,
+            'funnel': funnel,
+            'stalled_at': stalled_at,
+            'time_to_kernel': {
+                'p50': _percentile(ttk, 0.5),
+                'p90': _percentile(ttk, 0.9),
+                'p99': _percentile(ttk, 0.99)
+            },
+            'boot_time_p50': _median(total_time),
+            'images': images,
+            'image_bytes': state['image_bytes']
+        }
@@ -0,0 +1,174 @@
+"""
+Kapadokya NetBoot - Per-Client Menus
+Renders main.ipxe for a single client from precompiled parts, applying
+the default image and timeout assigned to its MAC, UUID, hostname or
+platform in config/assignments.yaml. Broken images follow the same
+'broken_images' policy as the compiled menus.
+"""
+
+import hashlib
+import os
+import threading
+
+import yaml
+
+from asset_verify import load_verdicts
+from menu_compiler import (MAIN_MENU_DEFAULT, MAIN_MENU_TIMEOUT, MANIFEST_NAME, choose_line,
+                           generate_image_entry, group_images, load_manifest, load_server_ip,
+                           main_menu_parts)
+from metrics import metrics
+
+ASSIGNED_LABEL = 'assigned'
+
+
+def normalize_mac(mac):
+    """Lower-case, colon separated MAC (iPXE ${mac:hexhyp} uses dashes)"""
+    return (mac or '').strip().lower().replace('-', ':')
+
+
+def _file_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class AssignmentTable:
+    """Client assignments indexed by MAC, UUID, hostname and platform.
+
+    assignments.yaml:
+        defaults: {timeout: 30000, default: local}
+        assignments:
+          - mac: 52:54:00:aa:bb:cc
+            image: ubuntu_2404_desktop
+            timeout: 5000
+          - platform: efi
+            buildarch: x86_64
+            default: ubuntu_menu
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._key = None
+        self._lock = threading.Lock()
+        self.defaults = {}
+        self.by_mac = {}
+        self.by_uuid = {}
+        self.by_hostname = {}
+        self.by_platform = {}
+
+    def refresh(self):
+        key = _file_key(self.path)
+        if key == self._key:
+            return
+        with self._lock:
+            if key == self._key:
+                return
+            data = {}
+            if key is not None:
+                with open(self.path) as f, metrics.timer('knetboot_yaml_duration_seconds',
+                                                         file=os.path.basename(self.path), op='load'):
+                    data = yaml.safe_load(f) or {}
+            by_mac, by_uuid, by_hostname, by_platform = {}, {}, {}, {}
+            for rule in data.get('assignments', []) or []:
+                if rule.get('mac'):
+                    by_mac[normalize_mac(rule['mac'])] = rule
+                elif rule.get('uuid'):
+                    by_uuid[str(rule['uuid']).lower()] = rule
+                elif rule.get('hostname'):
+                    by_hostname[str(rule['hostname']).lower()] = rule
+                elif rule.get('platform') or rule.get('buildarch'):
+                    by_platform[(rule.get('platform'), rule.get('buildarch'))] = rule
+            self.defaults = data.get('defaults', {}) or {}
+            self.by_mac, self.by_uuid = by_mac, by_uuid
+            self.by_hostname, self.by_platform = by_hostname, by_platform
+            self._key = key
+
+    def lookup(self, mac=None, uuid=None, hostname=None, platform=None, buildarch=None):
+        """Most specific rule for a client: MAC, UUID, hostname, then platform"""
+        self.refresh()
+        rule = (self.by_mac.get(normalize_mac(mac))
+                or self.by_uuid.get((uuid or '').lower())
+                or self.by_hostname.get((hostname or '').lower())
+                or self.by_platform.get((platform, buildarch))
+                or self.by_platform.get((platform, None))
+                or self.by_platform.get((None, buildarch)))
+        return rule or {}
+
+
+class ClientMenus:
+    """Precompiled main menu plus one boot entry per enabled image.
+
+    verdicts_path is the file the stats collector and verify jobs publish
+    broken images to; it is only re-read when it changes, and no asset is
+    checked while rendering. options['broken_images'] decides whether
+    broken images are flagged, skipped or ignored, as in compile_menus().
+    """
+
+    def __init__(self, registry, assignments, settings_path, menus_dir, options=None, verdicts_path=None):
+        self.registry = registry
+        self.options = options or {}
+        self.verdicts_path = verdicts_path
+        self.assignments = assignments
+        self.settings_path = settings_path
+        self.menus_dir = menus_dir
+        self._lock = threading.Lock()
+        self._version = None
+        self._parts = None
+        self._entries = {}
+
+    def _compile(self):
+        """Rebuild the template when the catalog, settings.yaml, the menu manifest or broken images changed"""
+        policy = self.options.get('broken_images', 'flag')
+        verdicts_key = _file_key(self.verdicts_path) if self.verdicts_path and policy != 'ignore' else None
+        version = (self.registry.version(), _file_key(self.settings_path),
+                   _file_key(os.path.join(self.menus_dir, MANIFEST_NAME)), verdicts_key)
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            broken = load_verdicts(self.verdicts_path) if verdicts_key else {}
+            server_ip = load_server_ip(self.settings_path)
+            categories, names = group_images(self.registry, set(broken) if policy == 'skip' else ())
+            entries = {}
+            for images in categories.values():
+                for img in images:
+                    entry = generate_image_entry(img, ASSIGNED_LABEL, 'main_menu', server_ip,
+                                                 self.options.get('admission', False))
+                    if entry:
+                        status = f" [BROKEN: {broken[img['id']]}]" if img['id'] in broken else ''
+                        entries[img['id']] = (f"item {ASSIGNED_LABEL} {img['name']} (assigned){status}\n", entry,
+                                              img['id'] in broken)
+            # Chain to the same hash-stamped category menus main.ipxe uses
+            chain_names = {}
+            for name, info in load_manifest(self.menus_dir).items():
+                cat_id = name[:-len('.ipxe')]
+                if 'stamped' in info and cat_id in names:
+                    chain_names[cat_id] = info['stamped']
+            self._parts = main_menu_parts(names, chain_names)
+            self._entries = entries
+            self._version = version
+
+    def render(self, mac=None, uuid=None, hostname=None, platform=None, buildarch=None):
+        """Return (menu, rule) for a client"""
+        self._compile()
+        rule = self.assignments.lookup(mac, uuid, hostname, platform, buildarch)
+        defaults = self.assignments.defaults
+        header, items, labels = self._parts
+
+        timeout = int(rule.get('timeout', defaults.get('timeout', MAIN_MENU_TIMEOUT)))
+        default = rule.get('default', defaults.get('default', MAIN_MENU_DEFAULT))
+        assigned = self._entries.get(rule.get('image'))
+        if assigned:
+            item, entry, is_broken = assigned
+            # A flagged broken image stays selectable but is never booted on timeout
+            choice = default if is_broken else ASSIGNED_LABEL
+            return header + item + items + choose_line(timeout, choice) + labels + entry, rule
+        return header + items + choose_line(timeout, default) + labels, rule
+
+
+def menu_etag(menu):
+    """Strong ETag derived from the rendered menu bytes"""
+    return hashlib.blake2b(menu.encode('utf-8'), digest_size=16).hexdigest()
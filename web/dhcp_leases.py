@@ -0,0 +1,198 @@
+"""
+Kapadokya NetBoot - DHCP Leases Index
+Streaming parser for ISC dhcpd.leases that tails the file from its last
+byte offset and keeps the current lease per IP and per MAC in memory.
+"""
+
+import os
+import re
+import threading
+import time
+from calendar import timegm
+
+from privileged_helper import HelperError
+
+LEASE_START_RE = re.compile(r'^lease\s+([\d.]+)\s*\{')
+STATEMENT_RE = re.compile(r'^(starts|ends|tstp|cltt)\s+(?:\d\s+(\S+\s+\S+)|epoch\s+(\d+)|(never))')
+
+
+def _parse_time(match):
+    """Convert a dhcpd date statement to a UTC epoch (None means never)"""
+    date_str, epoch, never = match.group(2), match.group(3), match.group(4)
+    if never:
+        return None
+    if epoch:
+        return int(epoch)
+    try:
+        return timegm(time.strptime(date_str.rstrip(';'), '%Y/%m/%d %H:%M:%S'))
+    except ValueError:
+        return None
+
+
+def _unquote(value):
+    value = value.rstrip(';').strip()
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def parse_lease_block(ip, lines):
+    """Parse the body of one ``lease <ip> { ... }`` block into a dict"""
+    lease = {
+        'ip': ip,
+        'mac': None,
+        'state': None,
+        'starts': None,
+        'ends': None,
+        'hostname': None,
+        'vendor_class': None
+    }
+    for line in lines:
+        line = line.strip()
+        if line.startswith('binding state '):
+            lease['state'] = line[len('binding state '):].rstrip(';').strip()
+        elif line.startswith('hardware ethernet '):
+            lease['mac'] = line[len('hardware ethernet '):].rstrip(';').strip().lower()
+        elif line.startswith('client-hostname '):
+            lease['hostname'] = _unquote(line[len('client-hostname '):])
+        elif line.startswith('set vendor-class-identifier'):
+            lease['vendor_class'] = _unquote(line.split('=', 1)[1]) if '=' in line else None
+        elif line.startswith('starts ') or line.startswith('ends '):
+            match = STATEMENT_RE.match(line)
+            if match:
+                lease[match.group(1)] = _parse_time(match)
+    return lease
+
+
+def is_active(lease, now=None):
+    """A lease is active while bound and not past its end time"""
+    if lease.get('state') != 'active':
+        return False
+    ends = lease.get('ends')
+    return ends is None or ends > (now if now is not None else time.time())
+
+
+class LeaseIndex:
+    """Incrementally maintained index of dhcpd leases by IP and MAC.
+
+    helper (a PrivilegedHelper) opens a root-only leases file for us.
+    """
+
+    def __init__(self, path, helper=None):
+        self.path = path
+        self.helper = helper
+        self.by_ip = {}
+        self.by_mac = {}
+        self._inode = None
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _reset(self, inode):
+        self.by_ip = {}
+        self.by_mac = {}
+        self._inode = inode
+        self._offset = 0
+
+    def _read_from(self, offset):
+        """Read the file from a byte offset, falling back to the privileged helper"""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                return f.read()
+        except PermissionError:
+            if self.helper is None:
+                raise
+            try:
+                fd = self.helper.open('open_leases')
+            except HelperError as e:
+                raise OSError(str(e))
+            with os.fdopen(fd, 'rb') as f:
+                f.seek(offset)
+                return f.read()
+
+    def _add(self, lease):
+        previous = self.by_ip.get(lease['ip'])
+        if previous and previous['mac'] and self.by_mac.get(previous['mac']) is previous:
+            del self.by_mac[previous['mac']]
+        self.by_ip[lease['ip']] = lease
+        if lease['mac']:
+            self.by_mac[lease['mac']] = lease
+
+    def feed(self, data):
+        """Parse complete lease blocks from data, returning bytes consumed.
+
+        A block still being written at the end of the file is left for the
+        next refresh.
+        """
+        consumed = 0
+        pos = 0
+        current_ip = None
+        body = []
+        while True:
+            newline = data.find(b'\n', pos)
+            if newline == -1:
+                break
+            line = data[pos:newline].decode('utf-8', 'replace').strip()
+            pos = newline + 1
+            if current_ip is None:
+                match = LEASE_START_RE.match(line)
+                if match:
+                    current_ip = match.group(1)
+                    body = []
+                elif not line.endswith('{'):
+                    # Comments, server-duid, authoring-byte-order...
+                    consumed = pos
+                    continue
+                else:
+                    # Other blocks (failover peer, host): skip to their end
+                    current_ip = ''
+                    body = []
+                continue
+            if line == '}':
+                if current_ip:
+                    self._add(parse_lease_block(current_ip, body))
+                current_ip = None
+                consumed = pos
+            else:
+                body.append(line)
+        return consumed
+
+    def refresh(self):
+        """Read whatever was appended since the last call.
+
+        dhcpd periodically rewrites the whole file (new inode, usually a
+        smaller size); when that happens the index is rebuilt from scratch.
+        """
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                self._reset(None)
+                return
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._reset(st.st_ino)
+            if st.st_size == self._offset:
+                return
+            data = self._read_from(self._offset)
+            self._offset += self.feed(data)
+
+    def get(self, key):
+        """Look up a lease by IP address or MAC address"""
+        self.refresh()
+        key = key.strip().lower()
+        return self.by_mac.get(key) or self.by_ip.get(key)
+
+    def leases(self, active_only=False):
+        """Return the current lease for every known IP"""
+        self.refresh()
+        now = time.time()
+        leases = list(self.by_ip.values())
+        if active_only:
+            leases = [l for l in leases if is_active(l, now)]
+        return leases
+
+    def active_count(self):
+        """Number of IPs with a bound, unexpired lease"""
+        self.refresh()
+        now = time.time()
+        return sum(1 for lease in self.by_ip.values() if is_active(lease, now))
@@ -0,0 +1,362 @@
+"""
+Kapadokya NetBoot - Stats History
+SQLite time-series store fed by the stats collector. Every snapshot is
+folded into minute, hour and day buckets as it arrives, each resolution
+kept for its own retention, so weeks of boot history can be queried and
+plotted without re-parsing logs.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+DEFAULTS = {
+    'enabled': True,
+    # Days each resolution is kept
+    'retention_days': {'minute': 2, 'hour': 90, 'day': 1825}
+}
+
+# Bucket width in seconds; day buckets start at local midnight
+RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Counters are recorded as deltas between snapshots and summed per bucket;
+# gauges are recorded as samples and averaged per bucket (with min/max)
+SERIES = {
+    'boots': ('counter', 'TFTP boot attempts'),
+    'boots_successful': ('counter', 'Successful TFTP boots'),
+    'http_boot_transfers': ('counter', 'Boot files sent over HTTP'),
+    'http_boot_bytes': ('counter', 'Boot file bytes sent over HTTP'),
+    'image_bytes': ('counter', 'Kernel, initrd and squashfs bytes served (label: image)'),
+    'active_leases': ('gauge', 'Bound, unexpired DHCP leases'),
+    'service_up': ('gauge', 'Service active, 1 or 0 (label: service)'),
+    'download_slots': ('gauge', 'Squashfs download slots in use'),
+    'download_queue': ('gauge', 'Clients waiting for a download slot'),
+    'time_to_kernel_p50': ('gauge', 'Median seconds from first boot event to kernel fetch')
+}
+# Ratios computed per bucket from two counters
+DERIVED = {
+    'success_rate': ('boots_successful', 'boots', 'Successful boots, percent')
+}
+
+# Points returned by a range query when no step is given
+MAX_POINTS = 500
+PRUNE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    resolution INTEGER NOT NULL,
+    series TEXT NOT NULL,
+    label TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    low REAL NOT NULL,
+    high REAL NOT NULL,
+    last REAL NOT NULL,
+    PRIMARY KEY (resolution, series, label, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events (
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    value TEXT,
+    previous TEXT
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+UPSERT = """
+INSERT INTO samples (resolution, series, label, bucket, count, total, low, high, last)
+VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)
+ON CONFLICT (resolution, series, label, bucket) DO UPDATE SET
+    count = count + 1,
+    total = total + excluded.total,
+    low = min(low, excluded.low),
+    high = max(high, excluded.high),
+    last = excluded.last
+"""
+
+
+class HistoryError(Exception):
+    """Invalid history query (unknown series, bad range)"""
+
+
+def load_history_config(system_config):
+    """The 'history' section of system.json merged over DEFAULTS"""
+    config = dict(DEFAULTS)
+    config.update(system_config.get('history', {}) or {})
+    config['retention_days'] = dict(DEFAULTS['retention_days'], **config.get('retention_days', {}))
+    return config
+
+
+def bucket_start(ts, resolution):
+    """Start of the bucket holding ts; day buckets follow local midnight"""
+    if resolution == RESOLUTIONS['day']:
+        local = time.localtime(ts)
+        return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+    return int(ts) // resolution * resolution
+
+
+def parse_time(value, now=None):
+    """Epoch seconds from an int/float, an ISO date(time) or a relative '-7d'/'-12h'/'-30m'"""
+    now = time.time() if now is None else now
+    if value is None or value == '':
+        return None
+    value = str(value).strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value.startswith('-') and value[-1:] in units:
+        try:
+            return now - float(value[1:-1]) * units[value[-1]]
+        except ValueError:
+            raise HistoryError(f"Invalid relative time: {value}")
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return time.mktime(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S' if 'T' in value else '%Y-%m-%d'))
+    except ValueError:
+        raise HistoryError(f"Invalid time: {value}")
+
+
+class History:
+    """Minute/hour/day rollups of the stats snapshot in one SQLite file.
+
+    Only the stats collector leader writes, once per refresh, in a single
+    transaction; any worker can read. Counter deltas are taken against the
+    raw values stored in the meta table, so a collector moving to another
+    worker (or a restart) does not double count, and a counter that went
+    down (midnight reset, service restart) counts its new value.
+    """
+
+    def __init__(self, path, config):
+        self.path = str(path)
+        self.config = config
+        self._ready = False
+        self._pruned_at = 0
+
+    def connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        if not self._ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._ready = True
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _meta(self, conn, key):
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row['value']) if row else {}
+
+    def _set_meta(self, conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def extract(self, data):
+        """(counters, gauges, services) from a snapshot's data section"""
+        boot = data.get('boot') or {}
+        http_boot = data.get('http_boot') or {}
+        funnel = data.get('funnel') or {}
+        admission = data.get('admission') or {}
+        counters = {
+            ('boots', ''): boot.get('total_boots_today'),
+            ('boots_successful', ''): boot.get('successful_boots'),
+            ('http_boot_transfers', ''): http_boot.get('transfers'),
+            ('http_boot_bytes', ''): http_boot.get('bytes')
+        }
+        for image, sent in (funnel.get('image_bytes') or {}).items():
+            counters[('image_bytes', image)] = sent
+        gauges = {
+            ('active_leases', ''): boot.get('active_leases'),
+            ('download_slots', ''): admission.get('active'),
+            ('download_queue', ''): admission.get('queue_depth'),
+            ('time_to_kernel_p50', ''): (funnel.get('time_to_kernel') or {}).get('p50')
+        }
+        services = {}
+        for name, info in (data.get('service_details') or {}).items():
+            if info:
+                gauges[('service_up', name)] = 1 if info.get('active') else 0
+                services[name] = info.get('state') or ('active' if info.get('active') else 'unknown')
+        return counters, gauges, services
+
+    def record(self, snapshot):
+        """Fold one stats snapshot into every resolution"""
+        if not self.config.get('enabled', True):
+            return
+        ts = snapshot['collected_at']
+        counters, gauges, services = self.extract(snapshot.get('data') or {})
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                previous = self._meta(conn, 'counters')
+                values = []
+                for (series, label), raw in counters.items():
+                    if raw is None:
+                        continue
+                    key = f"{series}|{label}"
+                    last = previous.get(key)
+                    previous[key] = raw
+                    if last is None:
+                        # First sighting only sets the baseline
+                        continue
+                    values.append((series, label, raw - last if raw >= last else raw))
+                values += [(series, label, value) for (series, label), value in gauges.items()
+                           if value is not None]
+                rows = []
+                for resolution in RESOLUTIONS.values():
+                    bucket = bucket_start(ts, resolution)
+                    for series, label, value in values:
+                        rows.append((resolution, series, label, bucket, value, value, value, value))
+                conn.executemany(UPSERT, rows)
+                self._set_meta(conn, 'counters', previous)
+
+                known = self._meta(conn, 'services')
+                for name, state in services.items():
+                    if known.get(name) != state:
+                        conn.execute('INSERT INTO events (ts, kind, subject, value, previous) VALUES (?, ?, ?, ?, ?)',
+                                     (ts, 'service', name, state, known.get(name)))
+                        known[name] = state
+                self._set_meta(conn, 'services', known)
+            if time.time() - self._pruned_at > PRUNE_INTERVAL:
+                self.prune(conn)
+        finally:
+            conn.close()
+
+    def prune(self, conn=None):
+        """Drop buckets and events older than their retention"""
+        own = conn is None
+        conn = conn or self.connect()
+        try:
+            now = time.time()
+            retention = self.config['retention_days']
+            with conn:
+                for name, resolution in RESOLUTIONS.items():
+                    conn.execute('DELETE FROM samples WHERE resolution = ? AND bucket < ?',
+                                 (resolution, now - retention[name] * 86400))
+                conn.execute('DELETE FROM events WHERE ts < ?', (now - retention['day'] * 86400,))
+            self._pruned_at = now
+        finally:
+            if own:
+                conn.close()
+
+    def pick_resolution(self, start, end, now=None):
+        """Finest resolution that still covers start and stays under MAX_POINTS"""
+        now = time.time() if now is None else now
+        retention = self.config['retention_days']
+        for name, resolution in RESOLUTIONS.items():
+            if start >= now - retention[name] * 86400 and (end - start) / resolution <= MAX_POINTS:
+                return resolution
+        return RESOLUTIONS['day']
+
+    def _rows(self, conn, resolution, series, label, start, end, step):
+        return conn.execute(
+            """SELECT (bucket - ?) / ? * ? + ? AS t, sum(count) AS count, sum(total) AS total,
+                      min(low) AS low, max(high) AS high
+               FROM samples
+               WHERE resolution = ? AND series = ? AND label = ? AND bucket >= ? AND bucket < ?
+               GROUP BY t ORDER BY t""",
+            (start, step, step, start, resolution, series, label, start, end)).fetchall()
+
+    def query(self, series, start=None, end=None, step=None, label=''):
+        """Downsampled points for one series between start and end.
+
+        Returns {series, label, kind, resolution, step, points: [{t, value,
+        min, max}]} where value is the sum of a counter or the mean of a
+        gauge over each step. The resolution is chosen from the range
+        unless step is given, in which case the coarsest resolution that
+        divides it is used.
+        """
+        now = time.time()
+        end = end if end is not None else now
+        start = start if start is not None else end - 86400
+        if end <= start:
+            raise HistoryError("start must be before end")
+        if series in DERIVED:
+            kind = 'ratio'
+        elif series in SERIES:
+            kind = SERIES[series][0]
+        else:
+            raise HistoryError(f"Unknown series: {series}")
+
+        if step:
+            step = int(step)
+            if step < RESOLUTIONS['minute']:
+                raise HistoryError("step must be at least 60 seconds")
+            resolution = max(r for r in RESOLUTIONS.values() if step % r == 0 or r == RESOLUTIONS['minute'])
+            if (end - start) / step > 10 * MAX_POINTS:
+                raise HistoryError("Too many points; use a larger step")
+        else:
+            resolution = self.pick_resolution(start, end, now)
+            step = resolution
+        start = bucket_start(start, resolution)
+
+        conn = self.connect()
+        try:
+            if kind == 'ratio':
+                numerator, denominator, _ = DERIVED[series]
+                top = {r['t']: r['total'] for r in self._rows(conn, resolution, numerator, label, start, end, step)}
+                bottom = self._rows(conn, resolution, denominator, label, start, end, step)
+                points = [{'t': r['t'], 'value': round(top.get(r['t'], 0) * 100 / r['total'], 1)}
+                          for r in bottom if r['total']]
+            else:
+                points = []
+                for r in self._rows(conn, resolution, series, label, start, end, step):
+                    value = r['total'] if kind == 'counter' else r['total'] / r['count']
+                    point = {'t': r['t'], 'value': round(value, 3)}
+                    if kind == 'gauge':
+                        point['min'], point['max'] = r['low'], r['high']
+                    points.append(point)
+        finally:
+            conn.close()
+        return {
+            'series': series,
+            'label': label,
+            'kind': kind,
+            'resolution': resolution,
+            'step': step,
+            'start': start,
+            'end': end,
+            'points': points
+        }
+
+    def series(self):
+        """Every series with its kind, description and the labels recorded for it"""
+        conn = self.connect()
+        try:
+            labels = {}
+            for row in conn.execute('SELECT DISTINCT series, label FROM samples WHERE resolution = ?',
+                                    (RESOLUTIONS['day'],)):
+                if row['label']:
+                    labels.setdefault(row['series'], []).append(row['label'])
+        finally:
+            conn.close()
+        result = [{'name': name, 'kind': kind, 'description': description, 'labels': sorted(labels.get(name, []))}
+                  for name, (kind, description) in SERIES.items()]
+        result += [{'name': name, 'kind': 'ratio', 'description': description, 'labels': []}
+                   for name, (_, _, description) in DERIVED.items()]
+        return result
+
+    def events(self, start=None, end=None, kind=None, limit=200):
+        """State-change events in a range, newest first"""
+        end = end if end is not None else time.time()
+        start = start if start is not None else end - 7 * 86400
+        sql = 'SELECT ts, kind, subject, value, previous FROM events WHERE ts >= ? AND ts < ?'
+        params = [start, end]
+        if kind:
+            sql += ' AND kind = ?'
+            params.append(kind)
+        sql += ' ORDER BY ts DESC LIMIT ?'
+        params.append(limit)
+        conn = self.connect()
+        try:
+            return [dict(row) for row in conn.execute(sql, params)]
+        finally:
+            conn.close()
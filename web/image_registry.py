@@ -0,0 +1,259 @@
+"""
+Kapadokya NetBoot - Image Registry
+In-memory view of images.yaml with id and category indexes, re-parsed
+only when the file's mtime/size/inode change. Shared by the web UI and
+scripts/menu-generator.py.
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import yaml
+
+from metrics import metrics
+
+BATCH_OPERATIONS = ('enable', 'disable', 'toggle', 'update', 'delete')
+
+# libyaml bindings are an order of magnitude faster than the pure-Python ones
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+class ImageRegistry:
+    """Cached, indexed access to the image catalog.
+
+    The lists and dicts handed out are shared with the cache and must be
+    treated as read-only; use update()/delete()/apply()/save() to change
+    images. Writes are atomic and serialised by a lock file, so concurrent
+    gunicorn workers cannot lose each other's updates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self._lock = threading.RLock()
+        self._key = None
+        self._images = []
+        self._by_id = {}
+        self._by_category = {}
+
+    def _file_key(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _index(self, images):
+        by_id = {}
+        by_category = {}
+        for image in images:
+            by_id[image.get('id')] = image
+            by_category.setdefault(image.get('category', 'other'), []).append(image)
+        self._images = images
+        self._by_id = by_id
+        self._by_category = by_category
+
+    def refresh(self):
+        """Re-parse images.yaml if it changed on disk since the last load"""
+        key = self._file_key()
+        if key == self._key:
+            return
+        with self._lock:
+            key = self._file_key()
+            if key == self._key:
+                return
+            images = []
+            if key is not None:
+                with open(self.path) as f, metrics.timer('knetboot_yaml_duration_seconds',
+                                                         file=os.path.basename(self.path), op='load'):
+                    data = yaml.load(f, Loader=SafeLoader) or {}
+                images = data.get('images', []) or []
+            self._index(images)
+            self._key = key
+
+    def version(self):
+        """Opaque token that changes whenever the catalog changes"""
+        self.refresh()
+        return self._key
+
+    def images(self):
+        """All images, in file order"""
+        self.refresh()
+        return self._images
+
+    def get(self, image_id):
+        """Image with the given id, or None"""
+        self.refresh()
+        return self._by_id.get(image_id)
+
+    def by_category(self, category):
+        """Images in a category, in file order"""
+        self.refresh()
+        return self._by_category.get(category, [])
+
+    def categories(self):
+        """Category ids in order of first appearance"""
+        self.refresh()
+        return list(self._by_category)
+
+    @contextmanager
+    def locked(self):
+        """Hold the catalog lock across threads and worker processes.
+
+        The cache is refreshed after the lock is taken, so read-modify-write
+        sequences inside the block always start from the latest file.
+        """
+        with self._lock:
+            with open(self.lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.refresh()
+                yield
+
+    def _write(self, images):
+        """Write to a temp file and rename it over images.yaml"""
+        directory = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.images-', suffix='.yaml')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                with metrics.timer('knetboot_yaml_duration_seconds', file=os.path.basename(self.path), op='dump'):
+                    yaml.dump({'images': images}, f, Dumper=SafeDumper, default_flow_style=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._index(images)
+        self._key = self._file_key()
+
+    def save(self, images):
+        """Write the catalog and make it the cached state"""
+        with self.locked():
+            self._write(images)
+
+    def update(self, image_id, **changes):
+        """Apply field changes to one image; returns the new image or None"""
+        with self.locked():
+            if image_id not in self._by_id:
+                return None
+            self._write([dict(i, **changes) if i.get('id') == image_id else i for i in self._images])
+            return self._by_id[image_id]
+
+    def delete(self, image_id):
+        """Remove an image; returns True if it existed"""
+        with self.locked():
+            if image_id not in self._by_id:
+                return False
+            self._write([i for i in self._images if i.get('id') != image_id])
+            return True
+
+    def upsert(self, image):
+        """Add an image, or replace the one with the same id in place"""
+        with self.locked():
+            image_id = image.get('id')
+            if image_id in self._by_id:
+                images = [image if i.get('id') == image_id else i for i in self._images]
+            else:
+                images = self._images + [image]
+            self._write(images)
+            return self._by_id[image_id]
+
+    def set_asset(self, image_id, field, rel_path, sha256=None, new_image=None):
+        """Point an image's kernel/initrd/squashfs at rel_path.
+
+        The image is created from new_image (disabled) if it does not exist
+        yet. The file's SHA-256, when known, is kept under 'checksums'.
+        Returns the updated image, or None if it neither exists nor can be
+        created.
+        """
+        with self.locked():
+            image = self._by_id.get(image_id)
+            if image is None:
+                if not new_image:
+                    return None
+                image = dict(new_image, id=image_id)
+                image.setdefault('enabled', False)
+                images = self._images + [image]
+            else:
+                images = list(self._images)
+            updated = dict(image, **{field: rel_path})
+            if sha256:
+                updated['checksums'] = dict(image.get('checksums') or {}, **{field: sha256})
+            self._write([updated if i.get('id') == image_id else i for i in images])
+            return self._by_id[image_id]
+
+    def apply(self, operations):
+        """Apply a batch of operations with a single locked, atomic write.
+
+        Each operation is a dict with 'op' (enable, disable, toggle, update
+        or delete), 'id', and for update a 'fields' dict. Operations run in
+        order against a working copy; if any of them is invalid nothing is
+        written. Returns (True, report) or (False, errors).
+        """
+        with self.locked():
+            order = [i.get('id') for i in self._images]
+            working = dict(self._by_id)
+            changed = []
+            deleted = []
+            errors = []
+
+            for index, operation in enumerate(operations):
+                if not isinstance(operation, dict):
+                    errors.append({'index': index, 'error': 'Operation must be an object'})
+                    continue
+                op = operation.get('op')
+                image_id = operation.get('id')
+                if op not in BATCH_OPERATIONS:
+                    errors.append({'index': index, 'id': image_id, 'error': f'Unknown operation: {op}'})
+                    continue
+                if image_id not in working:
+                    errors.append({'index': index, 'id': image_id, 'error': 'Image not found'})
+                    continue
+
+                if op == 'delete':
+                    del working[image_id]
+                    deleted.append(image_id)
+                    continue
+
+                image = dict(working[image_id])
+                if op == 'enable':
+                    image['enabled'] = True
+                elif op == 'disable':
+                    image['enabled'] = False
+                elif op == 'toggle':
+                    image['enabled'] = not image.get('enabled', False)
+                else:
+                    fields = operation.get('fields')
+                    if not isinstance(fields, dict) or not fields:
+                        errors.append({'index': index, 'id': image_id, 'error': 'update needs a non-empty fields object'})
+                        continue
+                    if 'id' in fields and fields['id'] != image_id:
+                        errors.append({'index': index, 'id': image_id, 'error': 'id cannot be changed'})
+                        continue
+                    image.update(fields)
+                working[image_id] = image
+                if image_id not in changed:
+                    changed.append(image_id)
+
+            if errors:
+                return False, errors
+
+            changed = [i for i in changed if i in working and working[i] != self._by_id[i]]
+            if changed or deleted:
+                self._write([working[i] for i in order if i in working])
+            return True, {
+                'applied': len(operations),
+                'changed': changed,
+                'deleted': deleted,
+                'written': bool(changed or deleted)
+            }
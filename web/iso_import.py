@@ -0,0 +1,400 @@
+"""
+Kapadokya NetBoot - ISO Import
+Reads ISO9660 images (with Rock Ridge or Joliet names) directly, without
+mounting, finds the casper/live kernel, initrd and squashfs and copies them
+into assets/<image id>/ with large sequential reads. Imports run as
+background jobs (see jobs.py).
+"""
+
+import hashlib
+import os
+import re
+import struct
+
+from jobs import BackgroundJobs, JobError
+from storage import format_bytes
+
+SECTOR = 2048
+COPY_CHUNK = 8 * 1024 * 1024
+# No leading dot: rules out '.', '..' and hidden directories such as assets/.store
+IMAGE_ID_RE = re.compile(r'^[\w+-][\w.+-]*$')
+
+# Where live systems keep their boot files, first match wins
+LAYOUTS = (
+    {
+        'name': 'casper',
+        'dir': 'casper',
+        'kernel': ('vmlinuz', 'vmlinuz.efi'),
+        'initrd': ('initrd', 'initrd.lz', 'initrd.gz', 'initrd.img'),
+        'squashfs': ('filesystem.squashfs',),
+        'boot_args': 'boot=casper netboot=url ip=dhcp'
+    },
+    {
+        'name': 'live',
+        'dir': 'live',
+        'kernel': ('vmlinuz',),
+        'initrd': ('initrd.img', 'initrd'),
+        'squashfs': ('filesystem.squashfs',),
+        'boot_args': 'boot=live components ip=dhcp',
+        # live-boot downloads the squashfs given by fetch=, not url=
+        'squashfs_arg': 'fetch'
+    },
+)
+BOOT_FIELDS = ('kernel', 'initrd', 'squashfs')
+
+
+class IsoImportError(JobError):
+    """Rejected import or unreadable ISO"""
+
+
+class IsoEntry:
+    """A file or directory in the image; large files may span several extents"""
+
+    __slots__ = ('name', 'is_dir', 'sections')
+
+    def __init__(self, name, is_dir, sections):
+        self.name = name
+        self.is_dir = is_dir
+        self.sections = sections
+
+    @property
+    def size(self):
+        return sum(size for _, size in self.sections)
+
+
+class IsoImage:
+    """Read-only access to an ISO9660 file system through a file descriptor"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self._read_descriptors()
+        except Exception:
+            os.close(self.fd)
+            raise
+        self._dirs = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        if len(data) < length:
+            raise IsoImportError(f'{os.path.basename(self.path)}: truncated image', 422)
+        return data
+
+    def _read_descriptors(self):
+        primary = None
+        joliet = None
+        for sector in range(16, 64):
+            descriptor = self._read(sector * SECTOR, SECTOR)
+            if descriptor[1:6] != b'CD001':
+                break
+            kind = descriptor[0]
+            if kind == 1 and primary is None:
+                primary = descriptor
+            elif kind == 2 and descriptor[88:91] in (b'%/@', b'%/C', b'%/E'):
+                joliet = descriptor
+            elif kind == 255:
+                break
+        if primary is None:
+            raise IsoImportError(f'{os.path.basename(self.path)} is not an ISO9660 image', 422)
+
+        self.volume_id = primary[40:72].decode('ascii', 'replace').strip()
+        self.block_size = struct.unpack_from('<H', primary, 128)[0] or SECTOR
+        root = self._parse_record(primary[156:190], 'plain')
+        # Rock Ridge names are the real file names; Joliet is next best
+        if self._has_rock_ridge(root):
+            self.names = 'rockridge'
+        elif joliet is not None:
+            self.names = 'joliet'
+            root = self._parse_record(joliet[156:190], 'joliet')
+        else:
+            self.names = 'plain'
+        self.root = root
+
+    def _has_rock_ridge(self, root):
+        extent, size = root.sections[0]
+        record = self._read(extent * self.block_size, min(size, SECTOR))
+        length = record[0]
+        name_len = record[32]
+        system_use = record[33 + name_len + (1 - name_len % 2):length]
+        return system_use[:2] == b'SP' and system_use[4:6] == b'\xbe\xef'
+
+    def _parse_record(self, record, names):
+        extent, size = struct.unpack_from('<I', record, 2)[0], struct.unpack_from('<I', record, 10)[0]
+        flags = record[25]
+        name_len = record[32]
+        raw = record[33:33 + name_len]
+        if raw in (b'\x00', b'\x01'):
+            name = '.' if raw == b'\x00' else '..'
+        elif names == 'joliet':
+            name = raw.decode('utf-16-be', 'replace').split(';')[0]
+        else:
+            name = None
+            if names == 'rockridge':
+                name = self._rock_ridge_name(record[33 + name_len + (1 - name_len % 2):record[0]])
+            if name is None:
+                name = raw.decode('ascii', 'replace').lower()
+                name = name.split(';')[0].rstrip('.')
+        return IsoEntry(name, bool(flags & 0x02), [(extent, size)])
+
+    @staticmethod
+    def _rock_ridge_name(system_use):
+        """Alternate name from the NM entries of a SUSP area, if any"""
+        parts = []
+        pos = 0
+        while pos + 4 <= len(system_use):
+            signature = system_use[pos:pos + 2]
+            length = system_use[pos + 2]
+            if length < 4:
+                break
+            if signature == b'NM':
+                flags = system_use[pos + 4]
+                parts.append(system_use[pos + 5:pos + length])
+                if not flags & 0x01:
+                    break
+            pos += length
+        return b''.join(parts).decode('utf-8', 'replace') if parts else None
+
+    def listdir(self, entry):
+        """{lower-case name: IsoEntry} for a directory"""
+        extent, size = entry.sections[0]
+        key = extent
+        if key in self._dirs:
+            return self._dirs[key]
+
+        data = self._read(extent * self.block_size, size)
+        entries = {}
+        pending = None
+        pos = 0
+        while pos < len(data):
+            length = data[pos]
+            if length == 0:
+                # Records never cross a sector boundary; skip the padding
+                pos = (pos // SECTOR + 1) * SECTOR
+                continue
+            record = data[pos:pos + length]
+            pos += length
+            child = self._parse_record(record, self.names)
+            if child.name in ('.', '..'):
+                continue
+            multi_extent = record[25] & 0x80
+            if pending is not None:
+                pending.sections.extend(child.sections)
+                child = pending
+            if multi_extent:
+                # Files over 4 GiB continue in the next record(s)
+                pending = child
+                continue
+            pending = None
+            entries[child.name.lower()] = child
+        self._dirs[key] = entries
+        return entries
+
+    def lookup(self, path):
+        """IsoEntry for a '/'-separated path (case-insensitive), or None"""
+        entry = self.root
+        for part in path.strip('/').split('/'):
+            if not part:
+                continue
+            if not entry.is_dir:
+                return None
+            entry = self.listdir(entry).get(part.lower())
+            if entry is None:
+                return None
+        return entry
+
+    def copy_to(self, entry, dest, progress=None):
+        """Copy a file out with large sequential reads; returns its SHA-256.
+
+        progress(nbytes) is called after every chunk and may raise to stop.
+        """
+        sha = hashlib.sha256()
+        buffer = bytearray(COPY_CHUNK)
+        view = memoryview(buffer)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with open(dest, 'wb') as out:
+            for extent, size in entry.sections:
+                offset = extent * self.block_size
+                remaining = size
+                while remaining:
+                    n = os.preadv(self.fd, [view[:min(COPY_CHUNK, remaining)]], offset)
+                    if n == 0:
+                        raise IsoImportError(f'{os.path.basename(self.path)}: truncated image', 422)
+                    chunk = view[:n]
+                    sha.update(chunk)
+                    out.write(chunk)
+                    offset += n
+                    remaining -= n
+                    if progress:
+                        progress(n)
+            out.flush()
+            os.fsync(out.fileno())
+        return sha.hexdigest()
+
+
+def _pick(entries, names):
+    """Entry matching one of names exactly, else by prefix (vmlinuz-6.1.0-...)"""
+    files = {name: entry for name, entry in entries.items() if not entry.is_dir}
+    for name in names:
+        if name in files:
+            return files[name]
+    for name in names:
+        matches = sorted(n for n in files if n.startswith(name) and not n.endswith(('.sig', '.gpg')))
+        if matches:
+            return files[matches[-1]]
+    return None
+
+
+def find_boot_files(iso):
+    """(layout, {field: (path, IsoEntry)}) for the first live layout found"""
+    for layout in LAYOUTS:
+        directory = iso.lookup(layout['dir'])
+        if directory is None or not directory.is_dir:
+            continue
+        entries = iso.listdir(directory)
+        found = {}
+        for field in BOOT_FIELDS:
+            entry = _pick(entries, layout[field])
+            if entry is None and field == 'squashfs':
+                # Layered installers (and 8.3-only images, where it is .squ):
+                # fall back to the largest squashfs
+                squashfs = [e for n, e in entries.items() if n.endswith(('.squashfs', '.squ')) and not e.is_dir]
+                entry = max(squashfs, key=lambda e: e.size, default=None)
+            if entry is not None:
+                found[field] = (f"{layout['dir']}/{entry.name}", entry)
+        if 'kernel' in found and 'squashfs' in found:
+            return layout, found
+    raise IsoImportError(f'No casper/ or live/ kernel and squashfs found in {os.path.basename(iso.path)}', 422)
+
+
+def inspect_iso(path):
+    """What an import of path would copy, without copying anything"""
+    with IsoImage(path) as iso:
+        layout, found = find_boot_files(iso)
+        return {
+            'volume_id': iso.volume_id,
+            'names': iso.names,
+            'layout': layout['name'],
+            'boot_args': layout['boot_args'],
+            'files': {field: {'path': p, 'size': e.size} for field, (p, e) in found.items()},
+            'total_bytes': sum(e.size for _, e in found.values())
+        }
+
+
+def import_iso(iso_path, base_dir, image_id, name=None, category='custom', description='', progress=None):
+    """Copy an ISO's boot files into assets/<image_id>/ and return the catalog entry.
+
+    Files are written under a temporary name and renamed when complete.
+    progress(field, nbytes) is called after every chunk and may raise to
+    abort; partial files are removed.
+    """
+    assets_dir = os.path.realpath(os.path.join(str(base_dir), 'assets'))
+    dest_dir = os.path.realpath(os.path.join(assets_dir, image_id))
+    if not dest_dir.startswith(assets_dir + os.sep):
+        raise IsoImportError(f'assets/{image_id} is outside the assets directory')
+    os.makedirs(dest_dir, exist_ok=True)
+    assets = {}
+    checksums = {}
+    part = None
+    try:
+        with IsoImage(iso_path) as iso:
+            layout, found = find_boot_files(iso)
+            total = sum(entry.size for _, entry in found.values())
+            for field, (path, entry) in found.items():
+                filename = os.path.basename(path)
+                part = os.path.join(dest_dir, f'.{filename}.import.part')
+                callback = (lambda nbytes, field=field: progress(field, nbytes)) if progress else None
+                checksums[field] = iso.copy_to(entry, part, callback)
+                os.chmod(part, 0o644)
+                os.replace(part, os.path.join(dest_dir, filename))
+                part = None
+                assets[field] = f"assets/{image_id}/{filename}"
+            volume_id = iso.volume_id
+    finally:
+        if part is not None:
+            try:
+                os.unlink(part)
+            except OSError:
+                pass
+
+    image = {
+        'id': image_id,
+        'name': name or volume_id or image_id,
+        'category': category,
+        'type': 'live',
+        **assets,
+        'boot_args': layout['boot_args'],
+        'enabled': False,
+        'size': format_bytes(total),
+        'description': description or f'Imported from {os.path.basename(iso_path)}',
+        'checksums': checksums
+    }
+    if layout.get('squashfs_arg'):
+        image['squashfs_arg'] = layout['squashfs_arg']
+    return image
+
+
+class ImportJobs(BackgroundJobs):
+    """ISO import jobs; at most `workers` copy at once across all gunicorn workers"""
+
+    kind = 'import'
+
+    def __init__(self, state_dir, iso_dir, base_dir, registry, workers=2):
+        super().__init__(state_dir, workers)
+        self.iso_dir = os.path.realpath(str(iso_dir))
+        self.base_dir = str(base_dir)
+        self.registry = registry
+
+    def isos(self):
+        """ISO files available for import under iso_dir"""
+        result = []
+        for root, _, files in os.walk(self.iso_dir):
+            for name in sorted(files):
+                if name.lower().endswith('.iso'):
+                    path = os.path.join(root, name)
+                    size = os.path.getsize(path)
+                    result.append({'name': os.path.relpath(path, self.iso_dir), 'size_bytes': size,
+                                   'size': format_bytes(size)})
+        return result
+
+    def resolve_iso(self, name):
+        path = os.path.realpath(os.path.join(self.iso_dir, name or ''))
+        if not path.startswith(self.iso_dir + os.sep) or not os.path.isfile(path):
+            raise IsoImportError(f'ISO not found: {name}', 404)
+        return path
+
+    def submit(self, iso_name, image_id, name=None, category=None, description='', replace=False):
+        """Validate the ISO, queue an import and return the job"""
+        if not IMAGE_ID_RE.match(image_id or ''):
+            raise IsoImportError('Image id may only contain letters, digits, _ . + - and cannot start with a dot')
+        if self.registry.get(image_id) is not None and not replace:
+            raise IsoImportError(f'Image {image_id} already exists', 409)
+        if self.active(image_id=image_id):
+            raise IsoImportError(f'Image {image_id} is already being imported', 409)
+        plan = inspect_iso(self.resolve_iso(iso_name))
+        return self.start(
+            iso=iso_name,
+            image_id=image_id,
+            name=name or plan['volume_id'] or image_id,
+            category=category or 'custom',
+            description=description or f'Imported from {iso_name}',
+            plan=plan,
+            bytes_total=plan['total_bytes']
+        )
+
+    def run(self, job, progress):
+        image = import_iso(self.resolve_iso(job['iso']), self.base_dir, job['image_id'],
+                           name=job['name'], category=job['category'],
+                           description=job['description'], progress=progress)
+        self.registry.upsert(image)
+        return {'image': image}
@@ -0,0 +1,202 @@
+"""
+Kapadokya NetBoot - Background Jobs
+Long-running work (ISO imports, mirror downloads) started from the web UI.
+Jobs run on a per-process thread pool so gunicorn request workers return
+immediately; their state is kept in one JSON file per job so every worker
+can report progress, and flock-held slot files limit how many run at once
+across all workers.
+"""
+
+import fcntl
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{16}$')
+# Job files are rewritten at most this often while a job makes progress
+PROGRESS_INTERVAL = 0.5
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class JobError(Exception):
+    """Rejected job request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class Cancelled(Exception):
+    """Raised inside a job once it has been asked to stop"""
+
+
+class BackgroundJobs:
+    """Job queue, runner and progress store; subclasses implement run()"""
+
+    kind = 'job'
+
+    def __init__(self, state_dir, workers=2):
+        self.state_dir = str(state_dir)
+        self.workers = max(1, int(workers))
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    # State ------------------------------------------------------------------
+
+    def _job_path(self, job_id):
+        if not JOB_ID_RE.match(job_id or ''):
+            raise JobError(f'{self.kind.capitalize()} job not found', 404)
+        return os.path.join(self.state_dir, f'{job_id}.json')
+
+    def save(self, job):
+        os.makedirs(self.state_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, prefix=f'.{self.kind}-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._job_path(job['id']))
+
+    def load(self, job_id):
+        try:
+            with open(self._job_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise JobError(f'{self.kind.capitalize()} job not found', 404)
+
+    def get(self, job_id):
+        return self._check_alive(self.load(job_id))
+
+    def _check_alive(self, job):
+        """Mark jobs whose worker process died (restart, crash) as interrupted"""
+        if job['status'] in ACTIVE_STATUSES:
+            try:
+                os.kill(job['pid'], 0)
+            except ProcessLookupError:
+                job['status'] = 'interrupted'
+                job['error'] = f'Web worker exited during the {self.kind}'
+                job['finished_at'] = time.time()
+                self.save(job)
+            except PermissionError:
+                pass
+        return job
+
+    def jobs(self):
+        """All known jobs, newest first"""
+        result = []
+        try:
+            names = os.listdir(self.state_dir)
+        except FileNotFoundError:
+            return result
+        for name in names:
+            if name.endswith('.json') and not name.startswith('.'):
+                try:
+                    result.append(self.get(name[:-len('.json')]))
+                except JobError:
+                    continue
+        return sorted(result, key=lambda j: j['created_at'], reverse=True)
+
+    def active(self, **match):
+        """Queued or running jobs whose fields equal match"""
+        return [j for j in self.jobs()
+                if j['status'] in ACTIVE_STATUSES and all(j.get(k) == v for k, v in match.items())]
+
+    # Lifecycle --------------------------------------------------------------
+
+    def start(self, **fields):
+        """Record a queued job and hand it to the thread pool"""
+        job = {
+            'id': secrets.token_hex(8),
+            **fields,
+            'status': 'queued',
+            'stage': None,
+            'bytes_done': fields.get('bytes_done', 0),
+            'bytes_total': fields.get('bytes_total', 0),
+            'error': None,
+            'pid': os.getpid(),
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None
+        }
+        self.save(job)
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.kind)
+            self._pool.submit(self._execute, job['id'])
+        return job
+
+    def cancel(self, job_id):
+        """Ask a queued or running job to stop"""
+        job = self.get(job_id)
+        if job['status'] not in ACTIVE_STATUSES:
+            raise JobError(f"Job is already {job['status']}", 409)
+        with open(os.path.join(self.state_dir, f'{job_id}.cancel'), 'w'):
+            pass
+        return job
+
+    def cancelled(self, job_id):
+        return os.path.exists(os.path.join(self.state_dir, f'{job_id}.cancel'))
+
+    def _acquire_slot(self, job_id):
+        """Open lock file holding one of the server-wide job slots"""
+        while True:
+            for index in range(self.workers):
+                slot = open(os.path.join(self.state_dir, f'slot-{index}.lock'), 'a')
+                try:
+                    fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot
+                except BlockingIOError:
+                    slot.close()
+            if self.cancelled(job_id):
+                raise Cancelled()
+            time.sleep(1)
+
+    def progress_callback(self, job):
+        """progress(stage, nbytes): count bytes, save now and then, honour cancel"""
+        lock = threading.Lock()
+        last_save = [0.0]
+
+        def progress(stage, nbytes):
+            with lock:
+                job['stage'] = stage
+                job['bytes_done'] += nbytes
+                now = time.monotonic()
+                if now - last_save[0] < PROGRESS_INTERVAL:
+                    return
+                last_save[0] = now
+                if self.cancelled(job['id']):
+                    raise Cancelled()
+                self.save(job)
+
+        return progress
+
+    def _execute(self, job_id):
+        job = self.load(job_id)
+        slot = None
+        try:
+            slot = self._acquire_slot(job_id)
+            job.update(status='running', started_at=time.time())
+            self.save(job)
+            result = self.run(job, self.progress_callback(job))
+            job.update(status='done', stage=None, **(result or {}))
+        except Cancelled:
+            job.update(status='cancelled', error='Cancelled')
+        except Exception as e:
+            print(f"Error in {self.kind} job {job_id}: {e}")
+            job.update(status='failed', error=str(e))
+        finally:
+            if slot is not None:
+                slot.close()
+            try:
+                os.unlink(os.path.join(self.state_dir, f'{job_id}.cancel'))
+            except FileNotFoundError:
+                pass
+            job['finished_at'] = time.time()
+            self.save(job)
+
+    def run(self, job, progress):
+        """Do the work; returns fields to store on the finished job"""
+        raise NotImplementedError
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Live Dashboard Stream
+Server-Sent Events for the dashboard, served next to the web UI (nginx
+proxies /admin/api/stream here) so open dashboards do not tie up the
+gunicorn sync workers. A single producer watches the stats snapshot
+published by the collector, the admission state and dhcpd.leases, and
+pushes only the values that changed to every connected viewer.
+
+Usage: python3 live_stream.py --address 127.0.0.1:5001 --run-dir /run/knetboot
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+
+from admission import AdmissionControl, load_admission_config
+from dhcp_leases import LeaseIndex
+from privileged_helper import PrivilegedHelper
+
+TICK_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 15.0
+# Client reconnect delay sent to EventSource, in milliseconds
+RETRY_MS = 3000
+# A viewer that falls this far behind is dropped (it reconnects and resyncs)
+MAX_CLIENT_BUFFER = 256 * 1024
+HEADER_TIMEOUT = 10
+MAX_CLIENTS = 512
+
+RESPONSE_HEADERS = (b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/event-stream\r\n"
+                    b"Cache-Control: no-cache\r\n"
+                    b"X-Accel-Buffering: no\r\n"
+                    b"Connection: keep-alive\r\n\r\n")
+
+
+def flatten(value, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}; lists and scalars are leaves"""
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            result.update(flatten(item, f"{prefix}{key}."))
+        return result
+    return {prefix[:-1]: value}
+
+
+_MISSING = object()
+
+
+def diff(previous, current):
+    """Changed and new keys with their values; removed keys map to None"""
+    delta = {k: v for k, v in current.items() if previous.get(k, _MISSING) != v}
+    delta.update({k: None for k in previous if k not in current})
+    return delta
+
+
+def encode(event, data, event_id=None):
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"data: {json.dumps(data, separators=(',', ':'))}\n\n"
+    return message.encode()
+
+
+class SnapshotFile:
+    """The collector's stats.json, re-read only when it changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._key = None
+        self._data = {}
+
+    def read(self):
+        try:
+            st = os.stat(self.path)
+            key = (st.st_mtime_ns, st.st_size)
+            if key != self._key:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+                self._key = key
+        except (OSError, ValueError):
+            pass
+        return self._data
+
+
+class LiveState:
+    """Dashboard values from the shared files, flattened to dotted keys"""
+
+    def __init__(self, snapshot_path, admission, lease_index):
+        self.snapshot = SnapshotFile(snapshot_path)
+        self.admission = admission
+        self.lease_index = lease_index
+
+    def collect(self):
+        snapshot = self.snapshot.read()
+        data = snapshot.get('data') or {}
+        boot = data.get('boot') or {}
+        funnel = data.get('funnel') or {}
+        state = {
+            'stats': {'collected_at': snapshot.get('collected_at')},
+            'services': {name: {'active': bool(info.get('active')),
+                                'state': info.get('state'),
+                                'sub_state': info.get('sub_state')}
+                         for name, info in (data.get('service_details') or {}).items() if info},
+            'boot': {key: boot.get(key) for key in ('total_boots_today', 'successful_boots', 'failed_boots',
+                                                     'success_rate', 'most_used_image')},
+            'leases': {'active': boot.get('active_leases')},
+            'funnel': {key: funnel.get(key) for key in ('sessions', 'complete', 'failed', 'stalled',
+                                                         'in_progress', 'success_rate', 'time_to_kernel',
+                                                         'funnel')}
+        }
+        # Faster sources than the collector interval, read on every tick
+        try:
+            state['leases']['active'] = self.lease_index.active_count()
+        except OSError:
+            pass
+        metrics = self.admission.metrics()
+        state['admission'] = {'active': metrics['active'], 'queue_depth': metrics['queue_depth'],
+                              'oldest_wait': metrics['oldest_wait']}
+        return flatten(state)
+
+
+class LiveStream:
+    """One producer, many viewers: each change is encoded once and written to all"""
+
+    def __init__(self, state, interval=TICK_INTERVAL):
+        self.state = state
+        self.interval = interval
+        self.clients = set()
+        self.current = {}
+        self.version = 0
+        self.started_at = time.time()
+
+    async def produce(self):
+        last_write = time.monotonic()
+        while True:
+            try:
+                current = await asyncio.to_thread(self.state.collect)
+            except Exception as e:
+                print(f"Error collecting live state: {e}")
+                current = self.current
+            delta = diff(self.current, current)
+            if delta:
+                self.current = current
+                self.version += 1
+                self.broadcast(encode('delta', delta, self.version))
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write > HEARTBEAT_INTERVAL:
+                # Comment line keeps proxies and idle connections alive
+                self.broadcast(b": ping\n\n")
+                last_write = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def broadcast(self, message):
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                self.clients.discard(writer)
+                writer.close()
+                continue
+            writer.write(message)
+
+    async def handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        method, _, rest = head.decode('latin-1').partition(' ')
+        path = rest.split(' ', 1)[0].split('?', 1)[0]
+        if method != 'GET' or path not in ('/stream', '/status'):
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await self._close(writer)
+            return
+        if path == '/status':
+            body = json.dumps({'clients': len(self.clients), 'version': self.version,
+                               'uptime': round(time.time() - self.started_at)}).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                         + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await self._close(writer)
+            return
+        if len(self.clients) >= MAX_CLIENTS:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await self._close(writer)
+            return
+
+        # Full state first, then deltas as the producer finds them
+        writer.write(RESPONSE_HEADERS + f"retry: {RETRY_MS}\n\n".encode()
+                     + encode('snapshot', self.current, self.version))
+        self.clients.add(writer)
+        try:
+            # Viewers never send anything; EOF means they went away
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            await self._close(writer)
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Kapadokya NetBoot live dashboard stream')
+    parser.add_argument('--address', default='127.0.0.1:5001', help='listen address (default: 127.0.0.1:5001)')
+    parser.add_argument('--run-dir', default=os.environ.get('KNETBOOT_RUN_DIR', '/run/knetboot'),
+                        help='runtime directory shared with the web UI')
+    parser.add_argument('--config', default='/opt/knetboot/config/system.json', help='system.json')
+    parser.add_argument('--leases', default=os.environ.get('KNETBOOT_DHCP_LEASES', '/var/lib/dhcp/dhcpd.leases'))
+    args = parser.parse_args()
+
+    try:
+        with open(args.config) as f:
+            system_config = json.load(f)
+    except (OSError, ValueError):
+        system_config = {}
+    state = LiveState(os.path.join(args.run_dir, 'stats.json'),
+                      AdmissionControl(os.path.join(args.run_dir, 'admission.json'),
+                                       load_admission_config(system_config)),
+                      LeaseIndex(args.leases, PrivilegedHelper()))
+    stream = LiveStream(state)
+    host, _, port = args.address.rpartition(':')
+
+    async def run():
+        server = await asyncio.start_server(stream.handle, host or '127.0.0.1', int(port))
+        producer = asyncio.create_task(stream.produce())
+        print(f"Live stream on {args.address}")
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        try:
+            await stop.wait()
+        finally:
+            producer.cancel()
+            server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
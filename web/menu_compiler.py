@@ -0,0 +1,442 @@
+"""
+Kapadokya NetBoot - Menu Compiler
+Library behind scripts/menu-generator.py: renders the iPXE menus from the
+image registry and rewrites only the files whose content hash changed.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from collections import defaultdict
+
+import yaml
+
+from metrics import metrics
+
+MANIFEST_NAME = 'manifest.json'
+STAMP_LENGTH = 12
+STAMPED_RE = re.compile(r'^[\w.-]+\.[0-9a-f]{%d}\.ipxe$' % STAMP_LENGTH)
+# Old stamped files are kept this long for clients still chaining to them
+STAMP_GRACE_SECONDS = 3600
+DEFAULT_SERVER_IP = '192.168.27.254'
+
+CATEGORY_NAMES = {
+    'ubuntu': 'Ubuntu Distributions',
+    'debian': 'Debian',
+    'centos': 'CentOS / RHEL',
+    'fedora': 'Fedora',
+    'custom': 'Custom Images',
+    'tools': 'Diagnostic Tools',
+    'system': 'System',
+    'other': 'Other'
+}
+
+def load_server_ip(settings_yaml):
+    """Read server.ip from settings.yaml"""
+    try:
+        with open(settings_yaml) as f, metrics.timer('knetboot_yaml_duration_seconds',
+                                                     file=os.path.basename(settings_yaml), op='load'):
+            settings = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return DEFAULT_SERVER_IP
+    return settings.get('server', {}).get('ip', DEFAULT_SERVER_IP)
+
+def group_images(registry, exclude=()):
+    """Enabled images per category plus category display names"""
+    categories = defaultdict(list)
+    names = {}
+    for category in registry.categories():
+        enabled = [img for img in registry.by_category(category)
+                   if img.get('enabled', False) and img['id'] not in exclude]
+        if not enabled:
+            continue  # Skip categories with only disabled images
+        categories[category].extend(enabled)
+        names[category] = CATEGORY_NAMES.get(category, category.title())
+    return categories, names
+
+MAIN_MENU_TIMEOUT = 30000
+MAIN_MENU_DEFAULT = 'local'
+
+def main_menu_parts(categories, chain_names=None):
+    """Split main.ipxe into (header, items, labels) around the choose line.
+
+    Per-client menus splice an extra item/label and their own choose line
+    into these precompiled parts instead of re-rendering the whole menu.
+    chain_names maps a category to the file its jump label chains to
+    (content-addressed names), defaulting to <category>.ipxe.
+    """
+    chain_names = chain_names or {}
+    header = """#!ipxe
+
+:main_menu
+menu Kapadokya NetBoot - Main Menu
+item --gap -- Boot Options:
+"""
+
+    # Add categories
+    items = ''
+    for cat_id, cat_name in sorted(categories.items()):
+        items += f"item {cat_id}_menu {cat_name}\n"
+
+    items += """item --gap -- System:
+item local Boot from Local Disk
+item shell iPXE Shell
+item reboot Reboot
+item exit Exit to BIOS
+item --gap --
+"""
+
+    labels = """
+:local
+echo Booting from local disk...
+exit
+
+:shell
+shell
+
+:reboot
+reboot
+
+:exit
+exit
+
+"""
+
+    # Add category jumps
+    for cat_id in categories.keys():
+        target = chain_names.get(cat_id, f"{cat_id}.ipxe")
+        labels += f":{cat_id}_menu\nchain ${{base_url}}/menus/{target} || goto main_menu\n\n"
+
+    return header, items, labels
+
+def choose_line(timeout=MAIN_MENU_TIMEOUT, default=MAIN_MENU_DEFAULT):
+    """iPXE choose statement with the given timeout (ms) and default item"""
+    return f"choose --timeout {timeout} --default {default} selected && goto ${{selected}}\n"
+
+def generate_main_menu(categories, chain_names=None):
+    """Generate main.ipxe menu"""
+    header, items, labels = main_menu_parts(categories, chain_names)
+    return header + items + choose_line() + labels
+
+def image_boot_commands(img, server_ip, squashfs_url=None):
+    """kernel, initrd and imgargs lines for an image (expects ${base_url})"""
+    # Kernel path
+    kernel_path = img['kernel'].replace('assets/', '${base_url}/assets/')
+    commands = f"kernel {kernel_path}\n"
+
+    # Initrd path (if exists)
+    if img.get('initrd'):
+        initrd_path = img['initrd'].replace('assets/', '${base_url}/assets/')
+        commands += f"initrd {initrd_path}\n"
+
+    # Boot arguments
+    if img.get('squashfs'):
+        squashfs_path = squashfs_url or img['squashfs'].replace('assets/', f'http://{server_ip}/knetboot/assets/')
+        boot_args = img.get('boot_args', 'boot=casper netboot=url ip=dhcp')
+        squashfs_arg = img.get('squashfs_arg', 'url')
+        commands += f"imgargs vmlinuz {boot_args} {squashfs_arg}={squashfs_path}\n"
+    elif img.get('boot_args'):
+        commands += f"imgargs vmlinuz {img['boot_args']}\n"
+    return commands
+
+def generate_image_entry(img, label, fallback, server_ip, admission=False):
+    """Boot entry for one image, jumping to fallback if the boot fails.
+
+    With admission, images with a squashfs chain to the web app's slot
+    script, which waits for a download slot before booting.
+    """
+    if img.get('type') == 'local':
+        return f":{label}\nexit\n\n"
+    if not img.get('kernel'):
+        return ''
+
+    entry = f":{label}\n"
+    entry += f"set base_url http://{server_ip}/knetboot\n"
+    if admission and img.get('squashfs'):
+        entry += f"chain --autofree ${{base_url}}/slot.ipxe?image={img['id']}&mac=${{net0/mac:hexhyp}} || goto {fallback}\n\n"
+        return entry
+    entry += image_boot_commands(img, server_ip)
+    entry += f"boot || goto {fallback}\n\n"
+    return entry
+
+def generate_category_menu(category, images, server_ip, admission=False, flagged=None):
+    """Generate category-specific menu (e.g., ubuntu.ipxe)
+
+    flagged maps image ids with missing/corrupt assets to the reason shown
+    in place of their status.
+    """
+    flagged = flagged or {}
+    cat_id = category['id']
+    cat_name = category['name']
+
+    menu = f"""#!ipxe
+
+:{cat_id}_menu
+menu {cat_name}
+item --gap -- Available Images:
+"""
+
+    # Add images
+    for img in images:
+        status = "[Enabled]" if img.get('enabled', False) else "[Disabled]"
+        if img['id'] in flagged:
+            status = f"[BROKEN: {flagged[img['id']]}]"
+        menu += f"item {img['id']} {img['name']} {status}\n"
+
+    menu += """item --gap --
+item back_main Back to Main Menu
+choose selected && goto ${selected}
+
+"""
+
+    # Add boot entries for each image
+    for img in images:
+        menu += generate_image_entry(img, img['id'], f"{cat_id}_menu", server_ip, admission)
+
+    menu += f":back_main\nchain ${{base_url}}/menus/main.ipxe\n"
+
+    return menu
+
+def content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def stamped_name(name, digest):
+    """Content-addressed file name, e.g. ubuntu.ipxe -> ubuntu.3f2a9c01b7de.ipxe"""
+    return f"{name[:-len('.ipxe')]}.{digest[:STAMP_LENGTH]}.ipxe"
+
+def load_menu_options(system_json):
+    """Artifact options from the 'menus' section of system.json, plus admission.enabled"""
+    try:
+        with open(system_json) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = {}
+    menus = config.get('menus', {})
+    return {
+        'gzip': bool(menus.get('gzip', False)),
+        'content_addressed': bool(menus.get('content_addressed', False)),
+        'admission': bool(config.get('admission', {}).get('enabled', False)),
+        # flag, skip or ignore images whose assets are missing or corrupt
+        'broken_images': menus.get('broken_images', 'flag')
+    }
+
+def render_category_menus(categories, names, server_ip, admission=False, flagged=None):
+    """Render category menus, returning {filename: content}"""
+    files = {}
+    for cat_id, cat_images in categories.items():
+        category = {'id': cat_id, 'name': names[cat_id]}
+        files[f'{cat_id}.ipxe'] = generate_category_menu(category, cat_images, server_ip, admission, flagged)
+    return files
+
+def chain_targets(category_files):
+    """Content-addressed chain target for each category"""
+    return {name[:-len('.ipxe')]: stamped_name(name, content_hash(content))
+            for name, content in category_files.items()}
+
+def render_menus(registry, server_ip, content_addressed=False, admission=False, exclude=(), flagged=None):
+    """Render every menu file, returning {filename: content}.
+
+    Category menus are rendered first so that, with content_addressed, the
+    main menu can chain to their hash-stamped names. Images in exclude are
+    left out; those in flagged are listed with their problem.
+    """
+    categories, names = group_images(registry, exclude)
+    category_files = render_category_menus(categories, names, server_ip, admission, flagged)
+    chain_names = chain_targets(category_files) if content_addressed else None
+    files = {'main.ipxe': generate_main_menu(names, chain_names)}
+    files.update(category_files)
+    return files
+
+def load_manifest(menus_dir):
+    """Previously written hashes: {filename: {'sha256', 'size', 'mtime_ns'}}"""
+    try:
+        with open(os.path.join(menus_dir, MANIFEST_NAME)) as f:
+            return json.load(f).get('files', {})
+    except (OSError, ValueError):
+        return {}
+
+def atomic_write(path, data, mode=0o664):
+    """Write bytes to path through a temp file and rename"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def current_hash(path, recorded):
+    """Hash of the file on disk, trusting the manifest while size/mtime match.
+
+    Menus edited through the web UI change mtime, so they get re-hashed
+    instead of being mistaken for the last generated content.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if recorded and recorded.get('size') == st.st_size and recorded.get('mtime_ns') == st.st_mtime_ns:
+        return recorded.get('sha256')
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def publish_artifacts(menus_dir, name, data, options, changed):
+    """Write the optional .gz and hash-stamped copies of one menu file.
+
+    Returns the manifest fields describing them. Variants are rewritten
+    only when the content changed or they are missing.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    info = {}
+    targets = [name]
+    if options.get('content_addressed') and name != 'main.ipxe':
+        stamped = stamped_name(name, digest)
+        info['stamped'] = stamped
+        stamped_path = os.path.join(menus_dir, stamped)
+        if changed or not os.path.exists(stamped_path):
+            atomic_write(stamped_path, data)
+        targets.append(stamped)
+    if options.get('gzip'):
+        # mtime=0 keeps the compressed bytes (and their ETag) deterministic
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        for target in targets:
+            gz_path = os.path.join(menus_dir, target + '.gz')
+            if changed or not os.path.exists(gz_path):
+                atomic_write(gz_path, compressed)
+        info['gzip'] = True
+    return info
+
+def prune_stamped(menus_dir, keep):
+    """Remove hash-stamped menus (and .gz) no longer referenced, after a grace period"""
+    removed = []
+    cutoff = time.time() - STAMP_GRACE_SECONDS
+    for entry in os.scandir(menus_dir):
+        name = entry.name[:-3] if entry.name.endswith('.gz') else entry.name
+        if not STAMPED_RE.match(name) or name in keep:
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed.append(entry.name)
+        except OSError:
+            pass
+    return removed
+
+def write_manifest(menus_dir, entries):
+    atomic_write(os.path.join(menus_dir, MANIFEST_NAME),
+                 json.dumps({'files': entries}, indent=2, sort_keys=True).encode('utf-8'))
+
+def compile_menus(registry, server_ip, menus_dir, incremental=True, options=None):
+    """Render the menus and write the ones that changed.
+
+    With incremental=False every file is rewritten, like the original
+    generator. Unchanged files are not touched, so their mtime (and any
+    nginx/iPXE cache validators derived from it) stays the same.
+    options may enable 'gzip' (precompressed .gz for gzip_static) and
+    'content_addressed' (hash-stamped category menus chained from main)
+    and 'admission' (squashfs images wait for a download slot).
+    options['broken'] maps image ids with missing or corrupt assets to a
+    reason; 'broken_images' decides whether they are flagged in the menu
+    (default), skipped, or ignored.
+    Returns a report with written/unchanged files and per-step timings.
+    """
+    options = options or {}
+    timings = {}
+    started = time.monotonic()
+
+    t0 = time.monotonic()
+    images = registry.images()
+    timings['load'] = time.monotonic() - t0
+
+    broken = options.get('broken') or {}
+    policy = options.get('broken_images', 'flag')
+    if policy == 'ignore':
+        broken = {}
+    exclude = set(broken) if policy == 'skip' else set()
+    flagged = broken if policy == 'flag' else {}
+
+    t0 = time.monotonic()
+    files = render_menus(registry, server_ip, options.get('content_addressed', False),
+                         options.get('admission', False), exclude, flagged)
+    timings['render'] = time.monotonic() - t0
+
+    t0 = time.monotonic()
+    os.makedirs(menus_dir, exist_ok=True)
+    manifest = load_manifest(menus_dir)
+    written = []
+    unchanged = []
+    entries = {}
+    for name, content in files.items():
+        path = os.path.join(menus_dir, name)
+        digest = content_hash(content)
+        data = content.encode('utf-8')
+        changed = not (incremental and current_hash(path, manifest.get(name)) == digest)
+        if changed:
+            atomic_write(path, data)
+            written.append(name)
+        else:
+            unchanged.append(name)
+        st = os.stat(path)
+        entries[name] = {'sha256': digest, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        entries[name].update(publish_artifacts(menus_dir, name, data, options, changed))
+    if entries != manifest:
+        write_manifest(menus_dir, entries)
+    pruned = prune_stamped(menus_dir, {e['stamped'] for e in entries.values() if 'stamped' in e})
+    timings['write'] = time.monotonic() - t0
+    timings['total'] = time.monotonic() - started
+
+    return {
+        'images': len(images),
+        'categories': [name[:-len('.ipxe')] for name in files if name != 'main.ipxe'],
+        'server_ip': server_ip,
+        'written': written,
+        'unchanged': unchanged,
+        'pruned': pruned,
+        'broken': sorted(broken),
+        'timings': {step: round(seconds * 1000, 3) for step, seconds in timings.items()}
+    }
+
+def publish_edited_menu(menus_dir, filename, options=None):
+    """Refresh artifacts and manifest after a menu was edited by hand.
+
+    For a category menu this stamps the new content and repoints main.ipxe
+    at it, so content-addressed chains never serve the pre-edit copy.
+    """
+    options = options or {}
+    manifest = load_manifest(menus_dir)
+    path = os.path.join(menus_dir, filename)
+    with open(path, 'rb') as f:
+        data = f.read()
+    st = os.stat(path)
+    entry = {'sha256': hashlib.sha256(data).hexdigest(), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    entry.update(publish_artifacts(menus_dir, filename, data, options, True))
+    manifest[filename] = entry
+
+    main_path = os.path.join(menus_dir, 'main.ipxe')
+    if 'stamped' in entry and os.path.exists(main_path):
+        with open(main_path) as f:
+            main = f.read()
+        stem = re.escape(filename[:-len('.ipxe')])
+        updated = re.sub(r'/menus/%s\.[0-9a-f]{%d}\.ipxe' % (stem, STAMP_LENGTH),
+                         '/menus/' + entry['stamped'], main)
+        if updated != main:
+            main_data = updated.encode('utf-8')
+            atomic_write(main_path, main_data)
+            st = os.stat(main_path)
+            main_entry = {'sha256': hashlib.sha256(main_data).hexdigest(), 'size': st.st_size,
+                          'mtime_ns': st.st_mtime_ns}
+            main_entry.update(publish_artifacts(menus_dir, 'main.ipxe', main_data, options, True))
+            manifest['main.ipxe'] = main_entry
+
+    write_manifest(menus_dir, manifest)
+    return entry
@@ -0,0 +1,307 @@
+"""
+Kapadokya NetBoot - Metrics
+Prometheus counters and histograms for the web app. Every gunicorn worker
+keeps its samples in memory and writes them to <run>/metrics/<pid>-<token>.json
+at most once a second; /metrics merges all of those files, so a scrape sees
+the whole server whichever worker answers it. Files of exited workers are
+folded into totals.json under a lock so counters never go backwards.
+"""
+
+import fcntl
+import json
+import os
+import re
+import secrets
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+FLUSH_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COMMAND_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+WORKER_FILE_RE = re.compile(r'^(\d+)-[0-9a-f]+\.json$')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name: (type, help, buckets)
+METRICS = {
+    'knetboot_http_requests_total':
+        ('counter', 'HTTP requests by Flask route, method and status', None),
+    'knetboot_http_request_duration_seconds':
+        ('histogram', 'HTTP request latency by Flask route', LATENCY_BUCKETS),
+    'knetboot_subprocess_duration_seconds':
+        ('histogram', 'Wall time of external commands (systemctl, journalctl, dhcpd -t, ...)', COMMAND_BUCKETS),
+    'knetboot_subprocess_failures_total':
+        ('counter', 'External commands that exited non-zero, timed out or could not start', None),
+    'knetboot_yaml_duration_seconds':
+        ('histogram', 'YAML load and dump time by file', LATENCY_BUCKETS),
+    'knetboot_menu_generation_duration_seconds':
+        ('histogram', 'iPXE menu compilation time', LATENCY_BUCKETS),
+    'knetboot_boot_file_requests_total':
+        ('counter', 'HTTP boot file requests by file and result (transfer, not_modified)', None),
+    'knetboot_asset_bytes_served_total':
+        ('counter', 'Body bytes of boot files and slot-limited assets handed out over HTTP', None),
+    'knetboot_image_boots_total':
+        ('counter', 'Download slots granted per image (boots that went through admission)', None),
+    'knetboot_helper_duration_seconds':
+        ('histogram', 'Round trip of privileged helper operations by op', COMMAND_BUCKETS),
+    'knetboot_helper_failures_total':
+        ('counter', 'Privileged helper operations that were rejected, failed or exited non-zero', None),
+}
+
+
+def format_labels(labels):
+    """{k="v",...} with values escaped as the exposition format requires"""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def command_label(args):
+    """Low-cardinality name of a command line: 'systemctl restart', 'dhcpd -t', ..."""
+    args = [str(a) for a in args]
+    if args and os.path.basename(args[0]) == 'sudo':
+        args = args[1:]
+    if not args:
+        return 'unknown'
+    name = os.path.basename(args[0])
+    if len(args) > 1 and not args[1].startswith('/') and len(args[1]) <= 20:
+        return f'{name} {args[1]}'
+    return name
+
+
+def _atomic_json(directory, path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _empty():
+    return {'counters': {}, 'histograms': {}}
+
+
+def merge_into(total, samples):
+    """Add one worker's samples to a running total"""
+    for name, series in samples.get('counters', {}).items():
+        target = total['counters'].setdefault(name, {})
+        for key, value in series.items():
+            target[key] = target.get(key, 0) + value
+    for name, series in samples.get('histograms', {}).items():
+        target = total['histograms'].setdefault(name, {})
+        for key, hist in series.items():
+            current = target.get(key)
+            if current is None or len(current['counts']) != len(hist['counts']):
+                target[key] = {'counts': list(hist['counts']), 'sum': hist['sum']}
+            else:
+                current['counts'] = [a + b for a, b in zip(current['counts'], hist['counts'])]
+                current['sum'] += hist['sum']
+    return total
+
+
+class Metrics:
+    """Per-process samples, flushed to a shared directory for /metrics"""
+
+    def __init__(self, state_dir=None):
+        self.state_dir = None
+        self._lock = threading.Lock()
+        self._samples = _empty()
+        self._dirty = False
+        self._last_flush = 0.0
+        self._token = secrets.token_hex(4)
+        # listener(name, seconds, labels) is called for every observation
+        self.listeners = []
+        if state_dir:
+            self.configure(state_dir)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forked)
+
+    def configure(self, state_dir):
+        """Start writing samples under state_dir (without it they stay in memory)"""
+        self.state_dir = str(state_dir)
+
+    def _forked(self):
+        # Samples recorded before a (pre)fork belong to the parent
+        self._lock = threading.Lock()
+        self._samples = _empty()
+        self._dirty = False
+        self._token = secrets.token_hex(4)
+
+    # Recording --------------------------------------------------------------
+
+    def inc(self, name, value=1, **labels):
+        key = format_labels(labels)
+        with self._lock:
+            series = self._samples['counters'].setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name, seconds, **labels):
+        buckets = METRICS[name][2]
+        key = format_labels(labels)
+        index = len(buckets)
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                index = i
+                break
+        with self._lock:
+            series = self._samples['histograms'].setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = {'counts': [0] * (len(buckets) + 1), 'sum': 0.0}
+            hist['counts'][index] += 1
+            hist['sum'] += seconds
+            self._dirty = True
+        for listener in self.listeners:
+            listener(name, seconds, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def run(self, args, **kwargs):
+        """subprocess.run, timed into knetboot_subprocess_duration_seconds"""
+        command = command_label(args)
+        started = time.monotonic()
+        try:
+            result = subprocess.run(args, **kwargs)
+        except (subprocess.SubprocessError, OSError):
+            self.inc('knetboot_subprocess_failures_total', command=command)
+            raise
+        finally:
+            self.observe('knetboot_subprocess_duration_seconds', time.monotonic() - started, command=command)
+        if result.returncode != 0:
+            self.inc('knetboot_subprocess_failures_total', command=command)
+        return result
+
+    # Sharing ----------------------------------------------------------------
+
+    def _worker_path(self):
+        return os.path.join(self.state_dir, f'{os.getpid()}-{self._token}.json')
+
+    def flush(self, force=False):
+        """Write this worker's samples if they changed (at most once a second)"""
+        if self.state_dir is None or not self._dirty:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < FLUSH_INTERVAL:
+            return
+        with self._lock:
+            data = json.loads(json.dumps(self._samples))
+            self._dirty = False
+        self._last_flush = now
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            _atomic_json(self.state_dir, self._worker_path(), data)
+        except OSError as e:
+            print(f"Error writing metrics: {e}")
+
+    def _fold_exited(self, names):
+        """Move samples of workers that exited into totals.json"""
+        totals_path = os.path.join(self.state_dir, 'totals.json')
+        with open(os.path.join(self.state_dir, 'totals.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(totals_path) as f:
+                    totals = json.load(f)
+            except (OSError, ValueError):
+                totals = _empty()
+            folded = []
+            for name in names:
+                path = os.path.join(self.state_dir, name)
+                try:
+                    with open(path) as f:
+                        merge_into(totals, json.load(f))
+                except (OSError, ValueError):
+                    continue
+                folded.append(path)
+            if folded:
+                _atomic_json(self.state_dir, totals_path, totals)
+                for path in folded:
+                    os.unlink(path)
+
+    def collect(self):
+        """Samples of every worker, past and present"""
+        self.flush(force=True)
+        total = _empty()
+        if self.state_dir is None:
+            with self._lock:
+                return merge_into(total, self._samples)
+        try:
+            names = os.listdir(self.state_dir)
+        except FileNotFoundError:
+            names = []
+        exited = []
+        for name in names:
+            match = WORKER_FILE_RE.match(name)
+            if not match:
+                continue
+            try:
+                os.kill(int(match.group(1)), 0)
+            except ProcessLookupError:
+                exited.append(name)
+            except PermissionError:
+                pass
+        if exited:
+            try:
+                self._fold_exited(exited)
+            except OSError as e:
+                print(f"Error folding metrics of exited workers: {e}")
+            names = os.listdir(self.state_dir)
+        for name in names:
+            if WORKER_FILE_RE.match(name) or name == 'totals.json':
+                try:
+                    with open(os.path.join(self.state_dir, name)) as f:
+                        merge_into(total, json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return total
+
+    def render(self, gauges=()):
+        """Prometheus text exposition of all samples plus (name, help, {labels: value}) gauges"""
+        samples = self.collect()
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            if kind == 'counter':
+                series = samples['counters'].get(name)
+                if not series:
+                    continue
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                lines += [f'{name}{key} {_number(value)}' for key, value in sorted(series.items())]
+            else:
+                series = samples['histograms'].get(name)
+                if not series:
+                    continue
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for key, hist in sorted(series.items()):
+                    inner = key[1:-1] + ',' if key else ''
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], hist['counts']):
+                        cumulative += count
+                        le = bound if bound == '+Inf' else _number(bound)
+                        lines.append(f'{name}_bucket{{{inner}le="{le}"}} {cumulative}')
+                    lines.append(f'{name}_sum{key} {_number(hist["sum"])}')
+                    lines.append(f'{name}_count{key} {cumulative}')
+        for name, help_text, series in gauges:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+            lines += [f'{name}{format_labels(labels)} {_number(value)}' for labels, value in series]
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+# Shared by the app and the modules it imports
+metrics = Metrics()
@@ -0,0 +1,420 @@
+"""
+Kapadokya NetBoot - Mirror Downloads
+Refreshes image assets from upstream mirrors with parallel HTTP Range
+segments spread over every mirror listed for the asset. Progress is kept
+in a small state file next to the partial download, so an interrupted
+download resumes where it stopped. The SHA-256 is computed while data
+arrives, following the contiguous prefix that has been written, and the
+finished file is renamed over the old asset in one step.
+
+Mirrors are listed per image in images.yaml:
+
+  sources:
+    squashfs:
+      urls: [http://mirror-a/.../filesystem.squashfs, http://mirror-b/...]
+      sha256: <optional expected digest>
+      sha256sums: <optional URL of a SHA256SUMS file>
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from jobs import BackgroundJobs, Cancelled, JobError
+from storage import ASSET_FIELDS
+
+DEFAULTS = {
+    # Downloads running at once across all gunicorn workers
+    'workers': 2,
+    # Parallel connections per download, spread over its mirrors
+    'connections': 8,
+    'segment_mb': 32,
+    # Attempts per segment before the download fails
+    'retries': 5,
+    'timeout': 30
+}
+IO_CHUNK = 1024 * 1024
+STATE_SAVE_INTERVAL = 1.0
+USER_AGENT = 'knetboot-mirror/1.0'
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def load_download_config(system_config):
+    """The 'downloads' section of system.json merged over DEFAULTS"""
+    config = dict(DEFAULTS)
+    config.update(system_config.get('downloads', {}) or {})
+    return config
+
+
+class DownloadError(JobError):
+    """Unusable mirrors, failed segments or a checksum mismatch"""
+
+
+def _request(url, timeout, headers=None):
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT, **(headers or {})})
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def probe(url, timeout=30):
+    """Size, range support and validators of a mirror URL"""
+    with _request(url, timeout, {'Range': 'bytes=0-0'}) as response:
+        headers = response.headers
+        match = CONTENT_RANGE_RE.match(headers.get('Content-Range', ''))
+        if response.status == 206 and match and match.group(3) != '*':
+            size = int(match.group(3))
+            ranges = True
+        else:
+            size = int(headers.get('Content-Length', -1))
+            ranges = False
+    if size < 0:
+        raise DownloadError(f'{url}: server did not report a size')
+    return {
+        'url': url,
+        'size': size,
+        'ranges': ranges,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified')
+    }
+
+
+def fetch_sha256sums(url, filename, timeout=30):
+    """Digest for filename from a SHA256SUMS-style file"""
+    with _request(url, timeout) as response:
+        text = response.read(1024 * 1024).decode('utf-8', 'replace')
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1].lstrip('*').lstrip('./').endswith(filename):
+            return parts[0].lower()
+    raise DownloadError(f'{filename} is not listed in {url}')
+
+
+class SegmentedDownload:
+    """Download one file from a set of mirrors into dest.part, resumably.
+
+    run() returns the SHA-256 of the complete file; the caller renames
+    part_path over the destination.
+    """
+
+    def __init__(self, urls, dest, sha256=None, connections=8, segment_size=32 * 1024 * 1024,
+                 retries=5, timeout=30, progress=None, on_plan=None):
+        self.urls = list(urls)
+        self.dest = dest
+        directory, name = os.path.split(dest)
+        self.part_path = os.path.join(directory, f'.{name}.download')
+        self.state_path = f'{self.part_path}.json'
+        self.expected = sha256.lower() if sha256 else None
+        self.connections = max(1, int(connections))
+        self.segment_size = max(IO_CHUNK, int(segment_size))
+        self.retries = int(retries)
+        self.timeout = timeout
+        self.progress = progress or (lambda stage, nbytes: None)
+        # on_plan(size, mirrors) once the mirrors have been probed
+        self.on_plan = on_plan
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._error = None
+
+    # State ------------------------------------------------------------------
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self):
+        directory = os.path.dirname(self.state_path) or '.'
+        with self._lock:
+            data = json.dumps(self.state)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.download-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.state_path)
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _plan(self):
+        """Probe mirrors and set up (or resume) the segment table"""
+        mirrors = []
+        errors = []
+        for url in self.urls:
+            try:
+                mirrors.append(probe(url, self.timeout))
+            except (OSError, http.client.HTTPException, DownloadError, ValueError) as e:
+                errors.append(f'{url}: {e}')
+        if not mirrors:
+            raise DownloadError('No mirror reachable: ' + '; '.join(errors))
+        size = mirrors[0]['size']
+        # A mirror serving a different size is out of sync; leave it out
+        mirrors = [m for m in mirrors if m['size'] == size]
+        if not all(m['ranges'] for m in mirrors):
+            mirrors = [m for m in mirrors if m['ranges']] or mirrors[:1]
+        self.mirrors = mirrors
+        self.size = size
+
+        state = self._load_state()
+        if state and state['size'] == size and os.path.exists(self.part_path):
+            # Resume only if no mirror we used before reports a new version
+            known = {m['url']: m for m in state['mirrors']}
+            if all((known[m['url']]['etag'], known[m['url']]['last_modified']) == (m['etag'], m['last_modified'])
+                   for m in mirrors if m['url'] in known):
+                state['mirrors'] = mirrors
+                self.state = state
+                return sum(s['done'] for s in state['segments'])
+
+        segments = []
+        if mirrors[0]['ranges']:
+            for start in range(0, size, self.segment_size):
+                segments.append({'start': start, 'end': min(size, start + self.segment_size), 'done': 0})
+        else:
+            segments.append({'start': 0, 'end': size, 'done': 0})
+        if not segments:
+            segments.append({'start': 0, 'end': 0, 'done': 0})
+        self.state = {'size': size, 'mirrors': mirrors, 'segments': segments, 'created_at': time.time()}
+        with open(self.part_path, 'wb') as f:
+            f.truncate(size)
+        self._save_state()
+        return 0
+
+    # Transfer ---------------------------------------------------------------
+
+    def _fetch_segment(self, fd, index, mirror):
+        segment = self.state['segments'][index]
+        start = segment['start'] + segment['done']
+        end = segment['end']
+        headers = {}
+        ranged = mirror['ranges'] and (start > 0 or end < self.size)
+        if ranged:
+            headers['Range'] = f'bytes={start}-{end - 1}'
+            validator = mirror['etag'] or mirror['last_modified']
+            if validator:
+                headers['If-Range'] = validator
+        with _request(mirror['url'], self.timeout, headers) as response:
+            if ranged:
+                if response.status != 206:
+                    raise DownloadError(f"{mirror['url']} changed during the download")
+                match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                if not match or int(match.group(1)) != start:
+                    raise DownloadError(f"{mirror['url']} answered with the wrong range")
+            if not ranged:
+                # Whole body again: skip what is already on disk
+                skip = start
+                while skip:
+                    skipped = len(response.read(min(IO_CHUNK, skip)))
+                    if not skipped:
+                        raise DownloadError(f"{mirror['url']}: connection closed early")
+                    skip -= skipped
+            position = start
+            while position < end and not self._stop.is_set():
+                chunk = response.read(min(IO_CHUNK, end - position))
+                if not chunk:
+                    raise DownloadError(f"{mirror['url']}: connection closed early")
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+                with self._changed:
+                    segment['done'] = position - segment['start']
+                    self._changed.notify_all()
+                self.progress('download', len(chunk))
+
+    def _worker(self, fd, pending, attempts):
+        while not self._stop.is_set():
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            # Spread segments over mirrors; move on to the next mirror after a failure
+            mirror = self.mirrors[(index + attempts[index]) % len(self.mirrors)]
+            try:
+                self._fetch_segment(fd, index, mirror)
+            except Cancelled as e:
+                self._fail(e)
+            except (OSError, http.client.HTTPException, DownloadError, ValueError) as e:
+                attempts[index] += 1
+                if attempts[index] > self.retries:
+                    self._fail(DownloadError(f'Segment {index} failed after {self.retries} retries: {e}'))
+                else:
+                    time.sleep(min(10, 0.5 * 2 ** attempts[index]))
+                    pending.put(index)
+            except BaseException as e:
+                self._fail(e)
+
+    def _fail(self, error):
+        with self._changed:
+            if self._error is None:
+                self._error = error
+            self._stop.set()
+            self._changed.notify_all()
+
+    def _frontier(self):
+        """End of the contiguous prefix of the file that has been written"""
+        for segment in self.state['segments']:
+            if segment['start'] + segment['done'] < segment['end']:
+                return segment['start'] + segment['done']
+        return self.size
+
+    def run(self):
+        resumed = self._plan()
+        if self.on_plan:
+            self.on_plan(self.size, self.mirrors)
+        if resumed:
+            self.progress('resume', resumed)
+
+        pending = queue.Queue()
+        for index, segment in enumerate(self.state['segments']):
+            if segment['start'] + segment['done'] < segment['end']:
+                pending.put(index)
+        attempts = [0] * len(self.state['segments'])
+
+        fd = os.open(self.part_path, os.O_RDWR)
+        try:
+            threads = [threading.Thread(target=self._worker, args=(fd, pending, attempts), daemon=True)
+                       for _ in range(min(self.connections, pending.qsize()))]
+            for thread in threads:
+                thread.start()
+
+            # Hash the written prefix while the segments are still arriving
+            sha = hashlib.sha256()
+            hashed = 0
+            last_save = time.monotonic()
+            while True:
+                # Sampled before the frontier, so a finished run is hashed to its end
+                alive = any(t.is_alive() for t in threads)
+                with self._changed:
+                    frontier = self._frontier()
+                    if frontier == hashed and self._error is None and alive:
+                        self._changed.wait(0.5)
+                        frontier = self._frontier()
+                while hashed < frontier:
+                    chunk = os.pread(fd, min(IO_CHUNK * 8, frontier - hashed), hashed)
+                    sha.update(chunk)
+                    hashed += len(chunk)
+                if time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+                    last_save = time.monotonic()
+                    self._save_state()
+                if self._error is not None or hashed == self.size or not alive:
+                    break
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self._save_state()
+            if self._error is not None:
+                raise self._error
+            if hashed != self.size:
+                raise DownloadError(f'Download stopped at {hashed} of {self.size} bytes')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        digest = sha.hexdigest()
+        if self.expected and digest != self.expected:
+            self.discard()
+            raise DownloadError(f'Checksum mismatch: expected {self.expected}, got {digest}')
+        return digest
+
+    def commit(self):
+        """Swap the finished download into place"""
+        os.chmod(self.part_path, 0o644)
+        os.replace(self.part_path, self.dest)
+        try:
+            os.unlink(self.state_path)
+        except FileNotFoundError:
+            pass
+
+
+def asset_sources(image, field):
+    """(urls, sha256, sha256sums URL) listed for an image asset"""
+    source = (image.get('sources') or {}).get(field)
+    if isinstance(source, list):
+        return source, None, None
+    if isinstance(source, dict):
+        return source.get('urls') or [], source.get('sha256'), source.get('sha256sums')
+    return [], None, None
+
+
+class DownloadJobs(BackgroundJobs):
+    """Mirror download jobs for catalog assets"""
+
+    kind = 'download'
+
+    def __init__(self, state_dir, base_dir, registry, config):
+        super().__init__(state_dir, config['workers'])
+        self.base_dir = str(base_dir)
+        self.assets_dir = os.path.realpath(os.path.join(self.base_dir, 'assets'))
+        self.registry = registry
+        self.config = config
+
+    def destination(self, image, field, urls):
+        """Catalog-relative path the asset is written to"""
+        rel_path = image.get(field)
+        if not rel_path:
+            filename = os.path.basename(urllib.parse.urlparse(urls[0]).path) or field
+            rel_path = f"assets/{image['id']}/{filename}"
+        path = os.path.realpath(os.path.join(self.base_dir, rel_path))
+        if not path.startswith(self.assets_dir + os.sep):
+            raise DownloadError(f'{rel_path} is outside the assets directory')
+        return rel_path
+
+    def submit(self, image_id, fields=None, urls=None, sha256=None):
+        """Queue downloads for an image's assets; returns the jobs"""
+        image = self.registry.get(image_id)
+        if image is None:
+            raise DownloadError(f'Image {image_id} not found', 404)
+        if fields is None:
+            fields = [f for f in ASSET_FIELDS if asset_sources(image, f)[0]] if not urls else ['squashfs']
+        jobs = []
+        for field in fields:
+            if field not in ASSET_FIELDS:
+                raise DownloadError(f'Unknown asset field: {field}')
+            field_urls, field_sha256, sha256sums = asset_sources(image, field)
+            if urls:
+                field_urls, field_sha256, sha256sums = urls, sha256, None
+            if not field_urls or not all(urllib.parse.urlparse(u).scheme in ('http', 'https') for u in field_urls):
+                raise DownloadError(f'No http(s) mirror URLs for {image_id} {field}')
+            if self.active(image_id=image_id, field=field):
+                raise DownloadError(f'{image_id} {field} is already downloading', 409)
+            jobs.append({
+                'image_id': image_id,
+                'field': field,
+                'urls': field_urls,
+                'sha256': field_sha256,
+                'sha256sums': sha256sums,
+                'path': self.destination(image, field, field_urls)
+            })
+        if not jobs:
+            raise DownloadError(f'No sources listed for {image_id}')
+        return [self.start(**job) for job in jobs]
+
+    def run(self, job, progress):
+        config = self.config
+        expected = job['sha256']
+        if not expected and job['sha256sums']:
+            filename = os.path.basename(urllib.parse.urlparse(job['urls'][0]).path)
+            expected = fetch_sha256sums(job['sha256sums'], filename, config['timeout'])
+
+        dest = os.path.join(self.base_dir, job['path'])
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        download = SegmentedDownload(job['urls'], dest, sha256=expected,
+                                     connections=config['connections'],
+                                     segment_size=config['segment_mb'] * 1024 * 1024,
+                                     retries=config['retries'], timeout=config['timeout'],
+                                     progress=progress, on_plan=lambda size, mirrors: job.update(
+                                         bytes_total=size, mirrors=[m['url'] for m in mirrors]))
+        digest = download.run()
+        download.commit()
+        self.registry.set_asset(job['image_id'], job['field'], job['path'], sha256=digest)
+        return {'sha256': digest, 'verified': bool(expected)}
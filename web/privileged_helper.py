@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - Privileged Helper
+Small root daemon that performs the few privileged actions of the web UI
+(service control, writing dhcpd.conf / tftpd-hpa / timesyncd config,
+timezone, TFTP boot files, opening a root-only dhcpd.leases) on behalf
+of www-data over a Unix socket, replacing one `sudo` fork per action.
+Only the operations in OPS are accepted, each with typed arguments, a
+timeout and a concurrency limit; results come back as JSON. The web app
+uses PrivilegedHelper.call(). The module imports nothing from the web
+tree: it is installed root-owned outside it and run from there.
+
+Protocol: one request per connection, a JSON line
+{"op": "service", "args": {"unit": "nginx", "action": "restart"}} answered by
+{"ok": true, "returncode": 0, "stdout": "", "stderr": "", "duration": 0.41}
+or {"ok": false, "error": "..."}. tftp_install takes the file as a
+descriptor passed with SCM_RIGHTS, so the helper never opens a path on
+the caller's behalf; open_leases answers with a read-only descriptor the
+same way.
+
+Usage: python3 /usr/local/lib/knetboot/privileged_helper.py --socket /run/knetboot-helper/helper.sock --user www-data
+"""
+
+import argparse
+import grp
+import json
+import os
+import pwd
+import re
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+SOCKET_PATH = os.environ.get('KNETBOOT_HELPER_SOCKET', '/run/knetboot-helper/helper.sock')
+SYSTEMCTL = '/usr/bin/systemctl'
+DHCPD = '/usr/sbin/dhcpd'
+TIMEDATECTL = '/usr/bin/timedatectl'
+ZONEINFO_DIR = '/usr/share/zoneinfo'
+DHCP_LEASES_PATH = '/var/lib/dhcp/dhcpd.leases'
+
+# Units the web UI may control, and what it may do with them
+SERVICE_UNITS = ('isc-dhcp-server', 'tftpd-hpa', 'knetboot-tftp', 'nginx', 'systemd-timesyncd')
+SERVICE_ACTIONS = ('start', 'stop', 'restart', 'enable', 'disable')
+# write_config target: (path, validate with dhcpd -t before installing)
+CONFIG_TARGETS = {
+    'dhcpd': ('/etc/dhcp/dhcpd.conf', True),
+    'tftpd-hpa': ('/etc/default/tftpd-hpa', False),
+    'timesyncd': ('/etc/systemd/timesyncd.conf.d/local.conf', False),
+}
+MAX_CONFIG_SIZE = 1024 * 1024
+MAX_BOOT_FILE_SIZE = 64 * 1024 * 1024
+MAX_REQUEST_SIZE = MAX_CONFIG_SIZE * 2
+BOOT_FILE_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$')
+TIMEZONE_RE = re.compile(r'^[A-Za-z0-9_+-]+(/[A-Za-z0-9_+-]+)*$')
+MAX_CONCURRENT = 8
+REQUEST_READ_TIMEOUT = 10
+
+
+class HelperError(Exception):
+    """Request rejected or not completed by the helper"""
+
+
+def _field(args, name, choices=None, pattern=None):
+    value = args.get(name)
+    if not isinstance(value, str) or not value:
+        raise HelperError(f"'{name}' is required")
+    if choices is not None and value not in choices:
+        raise HelperError(f"'{name}' must be one of: {', '.join(choices)}")
+    if pattern is not None and not pattern.match(value):
+        raise HelperError(f"Invalid {name}: {value!r}")
+    return value
+
+
+def _install(path, write, mode=0o644):
+    """Write through a temp file in the target directory, then rename over path"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.knetboot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            os.fchmod(f.fileno(), mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class Operations:
+    """The allow-listed operations; each returns (returncode, stdout, stderr[, fd to pass back])"""
+
+    def __init__(self, tftp_root, leases_path):
+        self.tftp_root = tftp_root
+        self.leases_path = leases_path
+        # Actions on the same unit run one at a time
+        self._unit_locks = {unit: threading.Lock() for unit in SERVICE_UNITS}
+
+    def ping(self, args, fd, timeout):
+        return 0, json.dumps({'ops': sorted(OPS), 'pid': os.getpid()}), ''
+
+    def service(self, args, fd, timeout):
+        unit = _field(args, 'unit', SERVICE_UNITS)
+        action = _field(args, 'action', SERVICE_ACTIONS)
+        with self._unit_locks[unit]:
+            return self._run([SYSTEMCTL, action, unit], timeout)
+
+    def write_config(self, args, fd, timeout):
+        path, validate = CONFIG_TARGETS[_field(args, 'target', tuple(CONFIG_TARGETS))]
+        content = args.get('content')
+        if not isinstance(content, str):
+            raise HelperError("'content' is required")
+        data = content.encode()
+        if len(data) > MAX_CONFIG_SIZE:
+            raise HelperError(f"Config larger than {MAX_CONFIG_SIZE} bytes")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not validate:
+            _install(path, lambda f: f.write(data))
+            return 0, '', ''
+
+        # Test the new dhcpd.conf next to the live one; a broken config is never installed
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.knetboot-')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write(data)
+                os.fchmod(f.fileno(), 0o644)
+            returncode, stdout, stderr = self._run([DHCPD, '-t', '-cf', tmp_path], timeout)
+            if returncode == 0:
+                os.replace(tmp_path, path)
+            return returncode, stdout, stderr.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def set_timezone(self, args, fd, timeout):
+        timezone = _field(args, 'timezone', pattern=TIMEZONE_RE)
+        if not os.path.isfile(os.path.join(ZONEINFO_DIR, timezone)):
+            raise HelperError(f"Unknown timezone: {timezone}")
+        return self._run([TIMEDATECTL, 'set-timezone', timezone], timeout)
+
+    def tftp_install(self, args, fd, timeout):
+        name = _field(args, 'name', pattern=BOOT_FILE_RE)
+        if fd is None:
+            raise HelperError("tftp_install needs the file passed as a descriptor")
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode):
+            raise HelperError("Passed descriptor is not a regular file")
+        if info.st_size > MAX_BOOT_FILE_SIZE:
+            raise HelperError(f"Boot file larger than {MAX_BOOT_FILE_SIZE} bytes")
+
+        def copy(f):
+            offset = 0
+            while True:
+                chunk = os.pread(fd, 1024 * 1024, offset)
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+
+        _install(os.path.join(self.tftp_root, name), copy)
+        return 0, '', ''
+
+    def tftp_delete(self, args, fd, timeout):
+        name = _field(args, 'name', pattern=BOOT_FILE_RE)
+        path = os.path.join(self.tftp_root, name)
+        try:
+            if stat.S_ISDIR(os.lstat(path).st_mode):
+                raise HelperError(f"{name} is a directory")
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return 0, '', ''
+
+    def open_leases(self, args, fd, timeout):
+        leases_fd = os.open(self.leases_path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        if not stat.S_ISREG(os.fstat(leases_fd).st_mode):
+            os.close(leases_fd)
+            raise HelperError("Leases file is not a regular file")
+        # The caller reads it at its own pace; nothing is copied through the socket
+        return 0, '', '', leases_fd
+
+    def _run(self, cmd, timeout):
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise HelperError(f"{os.path.basename(cmd[0])} timed out after {timeout}s")
+        return result.returncode, result.stdout, result.stderr
+
+
+# op: (timeout seconds, max concurrent)
+OPS = {
+    'ping': (1, MAX_CONCURRENT),
+    'service': (30, 4),
+    'write_config': (15, 1),
+    'set_timezone': (10, 1),
+    'tftp_install': (30, 2),
+    'tftp_delete': (5, 2),
+    'open_leases': (5, 4),
+}
+
+
+class HelperServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, operations, allowed_uids):
+        self.operations = operations
+        self.allowed_uids = allowed_uids
+        self.slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+        self.op_slots = {op: threading.BoundedSemaphore(limit) for op, (_, limit) in OPS.items()}
+        super().__init__(path, HelperHandler)
+
+    def execute(self, request, fd):
+        op = request.get('op')
+        args = request.get('args') or {}
+        if op not in OPS or not isinstance(args, dict):
+            raise HelperError(f"Unknown operation: {op!r}")
+        timeout, _ = OPS[op]
+        # Wait at most one timeout for a slot instead of piling up threads
+        if not self.slots.acquire(timeout=timeout):
+            raise HelperError("Helper busy, try again")
+        try:
+            if not self.op_slots[op].acquire(timeout=timeout):
+                raise HelperError(f"Too many concurrent {op} requests, try again")
+            try:
+                return getattr(self.operations, op)(args, fd, timeout)
+            finally:
+                self.op_slots[op].release()
+        finally:
+            self.slots.release()
+
+
+class HelperHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        conn = self.request
+        conn.settimeout(REQUEST_READ_TIMEOUT)
+        fd = None
+        reply_fds = []
+        started = time.monotonic()
+        try:
+            pid, uid, gid = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                                 struct.calcsize('3i')))
+            if uid != 0 and uid not in self.server.allowed_uids:
+                raise HelperError(f"uid {uid} is not allowed to use the helper")
+            data, fds, _, _ = socket.recv_fds(conn, 65536, 1)
+            fd = fds[0] if fds else None
+            while not data.endswith(b'\n'):
+                if len(data) > MAX_REQUEST_SIZE:
+                    raise HelperError("Request too large")
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                request = json.loads(data)
+            except ValueError:
+                raise HelperError("Malformed request")
+            if not isinstance(request, dict):
+                raise HelperError("Malformed request")
+            returncode, stdout, stderr, *reply_fds = self.server.execute(request, fd)
+            response = {'ok': True, 'returncode': returncode, 'stdout': stdout, 'stderr': stderr}
+        except HelperError as e:
+            response = {'ok': False, 'error': str(e)}
+        except socket.timeout:
+            return
+        except Exception as e:
+            print(f"Error handling helper request: {e}")
+            response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        finally:
+            if fd is not None:
+                os.close(fd)
+        response['duration'] = round(time.monotonic() - started, 3)
+        try:
+            socket.send_fds(conn, [json.dumps(response).encode() + b'\n'], reply_fds)
+        except OSError:
+            pass
+        finally:
+            for reply_fd in reply_fds:
+                os.close(reply_fd)
+
+
+class PrivilegedHelper:
+    """Client side used by the web app; one short connection per call.
+
+    observe(op, seconds, failed) is called after every call, so the web
+    app can record metrics without this module importing them.
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH, observe=None):
+        self.socket_path = socket_path
+        self.observe = observe
+
+    def _request(self, op, fd, args):
+        """(response, received fds) for one request"""
+        timeout, _ = OPS[op]
+        payload = json.dumps({'op': op, 'args': args}).encode() + b'\n'
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # Allow for queueing behind the op's concurrency limit plus the op itself
+            sock.settimeout(2 * timeout + 5)
+            sock.connect(self.socket_path)
+            if fd is not None:
+                socket.send_fds(sock, [payload], [fd])
+            else:
+                sock.sendall(payload)
+            # A passed descriptor arrives with the first bytes of the response
+            data, fds, _, _ = socket.recv_fds(sock, 65536, 1)
+            try:
+                while data and not data.endswith(b'\n'):
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                return json.loads(data), fds
+            except BaseException:
+                for received in fds:
+                    os.close(received)
+                raise
+
+    def _call(self, op, fd, args):
+        started = time.monotonic()
+        failed = True
+        try:
+            try:
+                response, fds = self._request(op, fd, args)
+            except (OSError, ValueError) as e:
+                raise HelperError(f"Privileged helper unavailable ({self.socket_path}): {e}")
+            if not response.get('ok'):
+                for received in fds:
+                    os.close(received)
+                raise HelperError(response.get('error') or 'Privileged helper failed')
+            failed = response['returncode'] != 0
+            return response, fds
+        finally:
+            if self.observe:
+                self.observe(op, time.monotonic() - started, failed)
+
+    def call(self, op, fd=None, **args):
+        """Run op and return a CompletedProcess; raises HelperError if it was not run"""
+        response, fds = self._call(op, fd, args)
+        for received in fds:
+            os.close(received)
+        return subprocess.CompletedProcess([op], response['returncode'], response['stdout'], response['stderr'])
+
+    def open(self, op, **args):
+        """Run an op that answers with a descriptor and return it (the caller closes it)"""
+        _, fds = self._call(op, None, args)
+        if not fds:
+            raise HelperError(f"{op} returned no descriptor")
+        for extra in fds[1:]:
+            os.close(extra)
+        return fds[0]
+
+
+def prepare_socket_dir(path, group):
+    """Socket directory traversable by root and the web group only"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    gid = grp.getgrnam(group).gr_gid if group else -1
+    os.chown(directory, 0, gid)
+    os.chmod(directory, 0o750)
+    if os.path.exists(path):
+        os.unlink(path)
+    return gid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Kapadokya NetBoot privileged helper')
+    parser.add_argument('--socket', default=SOCKET_PATH, help=f'Unix socket path (default: {SOCKET_PATH})')
+    parser.add_argument('--user', action='append', default=[],
+                        help='user allowed to connect besides root (repeatable, default: www-data)')
+    parser.add_argument('--group', default='www-data', help='group owning the socket')
+    parser.add_argument('--tftp-root', default=os.environ.get('KNETBOOT_TFTP_ROOT', '/srv/tftp'))
+    parser.add_argument('--leases', default=os.environ.get('KNETBOOT_DHCP_LEASES', DHCP_LEASES_PATH))
+    args = parser.parse_args()
+
+    allowed_uids = {pwd.getpwnam(user).pw_uid for user in (args.user or ['www-data'])}
+    gid = prepare_socket_dir(args.socket, args.group)
+    server = HelperServer(args.socket, Operations(args.tftp_root, args.leases), allowed_uids)
+    os.chown(args.socket, 0, gid)
+    os.chmod(args.socket, 0o660)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Privileged helper on {args.socket} (ops: {', '.join(sorted(OPS))})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
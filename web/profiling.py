@@ -0,0 +1,520 @@
+"""
+Kapadokya NetBoot - Request Profiling
+Opt-in WSGI middleware, installed next to PrefixMiddleware, that records a
+span for every subprocess, YAML load/dump, menu compilation and template
+render of a request, and counts the files it opens (through an audit hook,
+installed only once profiling is enabled or a capture first runs in the
+worker, since audit hooks can never be removed). Requests slower than
+profiling.slow_ms are appended with their span breakdown to a JSON lines
+slow log shared by all workers. Captures armed from the admin UI run the
+next N requests under a path prefix (in whichever worker gets them) under
+cProfile or a stack sampler and keep the results for download.
+"""
+
+import cProfile
+import fcntl
+import io
+import json
+import os
+import pstats
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+
+from metrics import metrics
+
+DEFAULTS = {
+    'enabled': False,
+    'slow_ms': 1000,
+    'max_spans': 200,
+    'slow_log_mb': 5,
+    'sample_interval_ms': 5
+}
+CAPTURE_MODES = ('cprofile', 'sample')
+CAPTURE_ID_RE = re.compile(r'^[0-9a-f]{12}$')
+RESULT_NAME_RE = re.compile(r'^\d+\.(json|prof|folded)$')
+MAX_CAPTURE_REQUESTS = 50
+CAPTURE_TTL = 3600
+# While nothing is armed, captures.json is looked at no more often than this
+ARMED_POLL_SECONDS = 1.0
+TOP_FUNCTIONS = 30
+
+# Metric observations that become spans: name -> (kind, label formatter)
+SPAN_METRICS = {
+    'knetboot_subprocess_duration_seconds': ('subprocess', lambda l: l.get('command', '')),
+    'knetboot_yaml_duration_seconds': ('yaml', lambda l: f"{l.get('op')} {l.get('file')}"),
+    'knetboot_menu_generation_duration_seconds': ('menu', lambda l: 'compile'),
+}
+
+_local = threading.local()
+
+
+class ProfilingError(Exception):
+    """Rejected capture request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def load_profiling_config(system_config):
+    """Profiling settings from the 'profiling' section of system.json"""
+    config = dict(DEFAULTS)
+    config.update(system_config.get('profiling', {}))
+    return config
+
+
+def _atomic_json(directory, path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.profiling-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class RequestTrace:
+    """Spans of the request running on the current thread"""
+
+    def __init__(self, method, path, max_spans):
+        self.method = method
+        self.path = path
+        self.max_spans = max_spans
+        self.started = time.monotonic()
+        self.spans = []
+        self.dropped = 0
+        self.files_opened = 0
+        self._renders = []
+
+    def add(self, kind, name, seconds):
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return
+        start = time.monotonic() - seconds - self.started
+        self.spans.append({'kind': kind, 'name': name,
+                           'start_ms': round(start * 1000, 2), 'ms': round(seconds * 1000, 2)})
+
+    def summary(self, status, duration):
+        by_kind = {}
+        for s in self.spans:
+            by_kind[s['kind']] = round(by_kind.get(s['kind'], 0) + s['ms'], 2)
+        # Nested spans (YAML inside a render, say) are counted in both kinds
+        accounted = sum(by_kind.values())
+        return {
+            'ts': time.time(),
+            'pid': os.getpid(),
+            'method': self.method,
+            'path': self.path,
+            'status': status,
+            'duration_ms': round(duration * 1000, 2),
+            'by_kind': by_kind,
+            'unaccounted_ms': round(max(0.0, duration * 1000 - accounted), 2),
+            'files_opened': self.files_opened,
+            'spans': self.spans,
+            'dropped_spans': self.dropped
+        }
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+class StackSampler:
+    """Samples one thread's stack every interval into collapsed stacks"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        """Brendan Gregg's collapsed format, ready for flamegraph.pl/speedscope"""
+        return ''.join(f"{stack} {count}\n" for stack, count in
+                       sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+    def top(self):
+        """Leaf frames with the most samples"""
+        leaves = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        total = max(1, self.samples)
+        return [{'function': leaf, 'samples': count, 'percent': round(count * 100 / total, 1)}
+                for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:TOP_FUNCTIONS]]
+
+
+def _cprofile_top(profile):
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    rows = []
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({'function': f"{name} ({os.path.basename(filename)}:{line})",
+                     'calls': nc, 'tottime_ms': round(tt * 1000, 3), 'cumtime_ms': round(ct * 1000, 3)})
+    rows.sort(key=lambda row: -row['cumtime_ms'])
+    return rows[:TOP_FUNCTIONS]
+
+
+class Profiler:
+    """Slow log and on-demand captures shared by all workers under state_dir"""
+
+    def __init__(self):
+        self.config = dict(DEFAULTS)
+        self.state_dir = None
+        self._hooked = False
+        self._audit_hooked = False
+        self._captures_key = None
+        self._captures = []
+        self._pending = False
+        self._next_poll = 0.0
+
+    def configure(self, config, state_dir):
+        self.config = config
+        self.state_dir = str(state_dir)
+        if not self._hooked:
+            metrics.listeners.append(self._on_metric)
+            self._hooked = True
+        if config['enabled']:
+            self._hook_audit()
+
+    def _hook_audit(self):
+        """Count file opens from now on; an audit hook stays for the life of the process"""
+        if not self._audit_hooked:
+            sys.addaudithook(self._on_audit)
+            self._audit_hooked = True
+
+    @property
+    def slow_log_path(self):
+        return os.path.join(self.state_dir, 'slow.jsonl')
+
+    @property
+    def captures_path(self):
+        return os.path.join(self.state_dir, 'captures.json')
+
+    # Span sources -----------------------------------------------------------
+
+    @staticmethod
+    def _on_metric(name, seconds, labels):
+        trace = current_trace()
+        if trace is not None and name in SPAN_METRICS:
+            kind, label = SPAN_METRICS[name]
+            trace.add(kind, label(labels), seconds)
+
+    @staticmethod
+    def _on_audit(event, args):
+        if event == 'open':
+            trace = getattr(_local, 'trace', None)
+            if trace is not None:
+                trace.files_opened += 1
+
+    @staticmethod
+    def template_started(sender, template, context, **extra):
+        trace = current_trace()
+        if trace is not None:
+            trace._renders.append(time.monotonic())
+
+    @staticmethod
+    def template_finished(sender, template, context, **extra):
+        trace = current_trace()
+        if trace is not None and trace._renders:
+            trace.add('render', template.name or 'template', time.monotonic() - trace._renders.pop())
+
+    def connect_templates(self, app):
+        """Record a render span for every template (Flask signals)"""
+        from flask import before_render_template, template_rendered
+        before_render_template.connect(self.template_started, app)
+        template_rendered.connect(self.template_finished, app)
+
+    # Slow log ---------------------------------------------------------------
+
+    def log_slow(self, entry):
+        """Append one JSON line; O_APPEND keeps lines from several workers whole"""
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            self._rotate()
+            fd = os.open(self.slow_log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"Error writing slow request log: {e}")
+
+    def _rotate(self):
+        limit = self.config['slow_log_mb'] * 1024 * 1024
+        try:
+            if os.path.getsize(self.slow_log_path) < limit:
+                return
+        except FileNotFoundError:
+            return
+        with open(os.path.join(self.state_dir, 'slow.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.getsize(self.slow_log_path) >= limit:
+                    os.replace(self.slow_log_path, self.slow_log_path + '.1')
+            except FileNotFoundError:
+                pass
+
+    def slow_requests(self, limit=50):
+        """Newest slow log entries first"""
+        if self.state_dir is None:
+            return []
+        try:
+            with open(self.slow_log_path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                # Entries are a few KB at most; read just the tail
+                f.seek(max(0, f.tell() - limit * 16384))
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in reversed(lines):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+            if len(entries) >= limit:
+                break
+        return entries
+
+    # Captures ---------------------------------------------------------------
+
+    def _load_captures(self):
+        try:
+            with open(self.captures_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _armed(self):
+        """Armed captures, cached on the captures file's stat
+
+        While none has requests left the file is stat'ed at most every
+        ARMED_POLL_SECONDS, so ordinary requests skip the check entirely.
+        """
+        now = time.monotonic()
+        if not self._pending and now < self._next_poll:
+            return []
+        self._next_poll = now + ARMED_POLL_SECONDS
+        try:
+            st = os.stat(self.captures_path)
+        except FileNotFoundError:
+            self._pending = False
+            return []
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if key != self._captures_key:
+            self._captures = self._load_captures()
+            self._captures_key = key
+        wall = time.time()
+        self._pending = any(c['taken'] < c['count'] and c['expires_at'] > wall for c in self._captures)
+        return self._captures
+
+    def _update_captures(self, change):
+        """Read-modify-write captures.json under a lock; change(list) returns a value"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(os.path.join(self.state_dir, 'captures.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            captures = self._load_captures()
+            result = change(captures)
+            _atomic_json(self.state_dir, self.captures_path, captures)
+            return result
+
+    def arm(self, path, mode='cprofile', count=1, method=None):
+        """Profile the next count requests whose path starts with path"""
+        if self.state_dir is None:
+            raise ProfilingError('Profiling is not configured', 503)
+        if not isinstance(path, str) or not path.startswith('/'):
+            raise ProfilingError('path must start with /')
+        if mode not in CAPTURE_MODES:
+            raise ProfilingError(f'mode must be one of: {", ".join(CAPTURE_MODES)}')
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            raise ProfilingError('count must be a number')
+        if not 1 <= count <= MAX_CAPTURE_REQUESTS:
+            raise ProfilingError(f'count must be between 1 and {MAX_CAPTURE_REQUESTS}')
+        capture = {
+            'id': secrets.token_hex(6),
+            'path': path,
+            'method': method.upper() if method else None,
+            'mode': mode,
+            'count': count,
+            'taken': 0,
+            'results': [],
+            'created_at': time.time(),
+            'expires_at': time.time() + CAPTURE_TTL
+        }
+        self._update_captures(lambda captures: captures.append(capture))
+        # Look at the new capture on this worker's next request
+        self._next_poll = 0.0
+        return capture
+
+    def captures(self):
+        return self._load_captures() if self.state_dir else []
+
+    def remove(self, capture_id):
+        """Disarm a capture and delete its results"""
+        if not CAPTURE_ID_RE.match(capture_id or ''):
+            raise ProfilingError('Capture not found', 404)
+
+        def drop(captures):
+            before = len(captures)
+            captures[:] = [c for c in captures if c['id'] != capture_id]
+            return before != len(captures)
+
+        if not self._update_captures(drop):
+            raise ProfilingError('Capture not found', 404)
+        directory = os.path.join(self.state_dir, capture_id)
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            os.unlink(os.path.join(directory, name))
+        if os.path.isdir(directory):
+            os.rmdir(directory)
+
+    def result_path(self, capture_id, name):
+        if not CAPTURE_ID_RE.match(capture_id or '') or not RESULT_NAME_RE.match(name or ''):
+            raise ProfilingError('Result not found', 404)
+        path = os.path.join(self.state_dir, capture_id, name)
+        if not os.path.isfile(path):
+            raise ProfilingError('Result not found', 404)
+        return path
+
+    def claim(self, method, path):
+        """Take one request slot of a matching capture, or None"""
+        now = time.time()
+        if not any(c['taken'] < c['count'] and c['expires_at'] > now and path.startswith(c['path'])
+                   and c['method'] in (None, method) for c in self._armed()):
+            return None
+
+        def take(captures):
+            for capture in captures:
+                if (capture['taken'] < capture['count'] and capture['expires_at'] > now
+                        and path.startswith(capture['path']) and capture['method'] in (None, method)):
+                    capture['taken'] += 1
+                    return dict(capture, sequence=capture['taken'])
+            return None
+
+        try:
+            return self._update_captures(take)
+        except OSError as e:
+            print(f"Error claiming profiling capture: {e}")
+            return None
+
+    def save_capture(self, capture, summary, files):
+        """Store a captured request's files and list it on the capture"""
+        directory = os.path.join(self.state_dir, capture['id'])
+        os.makedirs(directory, exist_ok=True)
+        names = []
+        for suffix, data in files.items():
+            name = f"{capture['sequence']}.{suffix}"
+            with open(os.path.join(directory, name), 'wb' if isinstance(data, bytes) else 'w') as f:
+                f.write(data)
+            names.append(name)
+        result = {'sequence': capture['sequence'], 'path': summary['path'], 'method': summary['method'],
+                  'status': summary['status'], 'duration_ms': summary['duration_ms'], 'files': names}
+
+        def record(captures):
+            for c in captures:
+                if c['id'] == capture['id']:
+                    c['results'].append(result)
+
+        self._update_captures(record)
+
+    # Request lifecycle ------------------------------------------------------
+
+    def run(self, app, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        path = environ.get('PATH_INFO', '')
+        capture = self.claim(method, path) if self.state_dir else None
+        if not self.config['enabled'] and capture is None:
+            return app(environ, start_response)
+        if capture:
+            self._hook_audit()
+
+        trace = RequestTrace(method, path, self.config['max_spans'])
+        status = []
+
+        def record_status(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(' ', 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        profile = sampler = None
+        _local.trace = trace
+        try:
+            if capture and capture['mode'] == 'cprofile':
+                profile = cProfile.Profile()
+                response = profile.runcall(app, environ, record_status)
+            elif capture:
+                with StackSampler(threading.get_ident(), self.config['sample_interval_ms'] / 1000) as sampler:
+                    response = app(environ, record_status)
+            else:
+                response = app(environ, record_status)
+        finally:
+            _local.trace = None
+            duration = time.monotonic() - trace.started
+            summary = trace.summary(status[0] if status else 500, duration)
+            try:
+                if self.config['enabled'] and duration * 1000 >= self.config['slow_ms']:
+                    self.log_slow(summary)
+                if capture:
+                    self._save_profile(capture, summary, profile, sampler)
+            except Exception as e:
+                print(f"Error recording request profile: {e}")
+        return response
+
+    def _save_profile(self, capture, summary, profile, sampler):
+        if profile is not None:
+            summary['top'] = _cprofile_top(profile)
+            fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, prefix='.profile-')
+            os.close(fd)
+            try:
+                profile.dump_stats(tmp_path)
+                with open(tmp_path, 'rb') as f:
+                    stats = f.read()
+            finally:
+                os.unlink(tmp_path)
+            files = {'json': json.dumps(summary), 'prof': stats}
+        else:
+            summary['top'] = sampler.top()
+            summary['samples'] = sampler.samples
+            files = {'json': json.dumps(summary), 'folded': sampler.folded()}
+        self.save_capture(capture, summary, files)
+
+
+class ProfilingMiddleware:
+    """WSGI wrapper handing each request to the profiler"""
+
+    def __init__(self, app, profiler):
+        self.app = app
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        return self.profiler.run(self.app, environ, start_response)
+
+
+# Shared by the app and the modules it imports
+profiler = Profiler()
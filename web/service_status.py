@@ -0,0 +1,106 @@
+"""
+Kapadokya NetBoot - Service Status
+Queries the state of several systemd units in a single `systemctl show`
+round trip with a hard timeout, falling back to per-unit `is-active`.
+"""
+
+import subprocess
+import time
+
+from metrics import metrics
+
+SHOW_PROPERTIES = ['Id', 'LoadState', 'ActiveState', 'SubState', 'ActiveEnterTimestamp', 'NRestarts']
+SYSTEMCTL = '/usr/bin/systemctl'
+
+
+def _unknown(state='unknown'):
+    return {
+        'active': False,
+        'state': state,
+        'sub_state': None,
+        'since': None,
+        'restarts': None,
+        'loaded': None
+    }
+
+
+def parse_show_output(output, units):
+    """Split `systemctl show` output into one dict per unit, in argument order"""
+    blocks = []
+    current = {}
+    for line in output.splitlines():
+        if not line.strip():
+            if current:
+                blocks.append(current)
+                current = {}
+            continue
+        key, _, value = line.partition('=')
+        current[key] = value
+    if current:
+        blocks.append(current)
+
+    status = {}
+    for unit, props in zip(units, blocks):
+        restarts = props.get('NRestarts')
+        status[unit] = {
+            'active': props.get('ActiveState') == 'active',
+            'state': props.get('ActiveState') or 'unknown',
+            'sub_state': props.get('SubState') or None,
+            'since': props.get('ActiveEnterTimestamp') or None,
+            'restarts': int(restarts) if restarts and restarts.isdigit() else None,
+            'loaded': props.get('LoadState') or None
+        }
+    return status
+
+
+def query_is_active(unit, timeout=3):
+    """Legacy single-unit probe through systemctl is-active (no root needed)"""
+    try:
+        result = metrics.run(
+            [SYSTEMCTL, 'is-active', unit],
+            capture_output=True,
+            text=True,
+            timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        return _unknown('timeout')
+    except Exception:
+        return _unknown()
+    state = result.stdout.strip() or 'unknown'
+    info = _unknown(state)
+    info['active'] = state == 'active'
+    return info
+
+
+def query_services(units, timeout=3):
+    """Return {unit: status dict} for all units in one systemctl call.
+
+    `systemctl show` is read-only and needs no sudo. If it fails or its
+    output does not cover every unit, the missing ones are probed one by
+    one with the legacy is-active call, sharing the same timeout: each
+    probe only gets what is left of it, so the whole query is bounded by
+    timeout.
+    """
+    units = list(units)
+    status = {}
+    deadline = time.monotonic() + timeout
+    try:
+        result = metrics.run(
+            [SYSTEMCTL, 'show', '--no-pager', '-p', ','.join(SHOW_PROPERTIES), '--'] + units,
+            capture_output=True,
+            text=True,
+            timeout=timeout
+        )
+        if result.returncode == 0:
+            status = parse_show_output(result.stdout, units)
+    except subprocess.TimeoutExpired:
+        print(f"Timeout querying service status for {', '.join(units)}")
+        return {unit: _unknown('timeout') for unit in units}
+    except Exception as e:
+        print(f"Error querying service status: {e}")
+
+    for unit in units:
+        if unit not in status:
+            remaining = deadline - time.monotonic()
+            status[unit] = query_is_active(unit, timeout=remaining) if remaining > 0 else _unknown('timeout')
+    return status
@@ -246,7 +246,8 @@ function regenerateMenus() {
         .then(data => {
             hideLoading();
             if (data.success) {
-                showToast('Menus regenerated successfully!', 'success');
+                const written = data.report ? data.report.written.length : 0;
+                showToast(`Menus regenerated successfully! (${written} file(s) updated)`, 'success');
                 setTimeout(() => location.reload(), 1000);
             } else {
                 console.error('Menu regeneration error:', data.error);
@@ -297,6 +298,71 @@ function createDiskUsageChart(canvasId, usedGB, totalGB) {
     });
 }
 
+const historyCharts = {};
+
+function createBootHistoryChart(canvasId, days) {
+    const ctx = document.getElementById(canvasId);
+    if (!ctx) return;
+
+    // Hourly bars for a day, daily bars beyond that
+    const step = days > 1 ? 86400 : 3600;
+    const query = `?start=-${days}d&step=${step}`;
+    Promise.all([
+        fetch('/admin/api/history/boots' + query).then(response => response.json()),
+        fetch('/admin/api/history/success_rate' + query).then(response => response.json())
+    ])
+    .then(([boots, rate]) => {
+        if (!boots.success || !rate.success) {
+            throw new Error(boots.error || rate.error);
+        }
+        const rates = Object.fromEntries(rate.points.map(p => [p.t, p.value]));
+        const label = t => {
+            const date = new Date(t * 1000);
+            return step === 3600 ? date.toLocaleTimeString([], {hour: '2-digit', minute: '2-digit'})
+                                 : date.toLocaleDateString();
+        };
+
+        if (historyCharts[canvasId]) {
+            historyCharts[canvasId].destroy();
+        }
+        historyCharts[canvasId] = new Chart(ctx, {
+            data: {
+                labels: boots.points.map(p => label(p.t)),
+                datasets: [{
+                    type: 'bar',
+                    label: 'Boots',
+                    data: boots.points.map(p => p.value),
+                    backgroundColor: '#206bc4',
+                    yAxisID: 'y'
+                }, {
+                    type: 'line',
+                    label: 'Success rate (%)',
+                    data: boots.points.map(p => rates[p.t] ?? null),
+                    borderColor: '#2fb344',
+                    backgroundColor: '#2fb344',
+                    yAxisID: 'rate'
+                }]
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: false,
+                scales: {
+                    y: {beginAtZero: true, position: 'left'},
+                    rate: {min: 0, max: 100, position: 'right', grid: {drawOnChartArea: false}}
+                },
+                plugins: {
+                    legend: {
+                        position: 'bottom'
+                    }
+                }
+            }
+        });
+    })
+    .catch(error => {
+        console.error('Boot history:', error);
+    });
+}
+
 function createServiceStatusChart(canvasId, services) {
     const ctx = document.getElementById(canvasId);
     if (!ctx) return;
@@ -338,6 +404,91 @@ function createServiceStatusChart(canvasId, services) {
     });
 }
 
+// =============================================================================
+// Live Dashboard (Server-Sent Events)
+// =============================================================================
+
+// Flattened values from the stream, e.g. {'services.dhcp.active': true}
+const liveState = {};
+let liveSource = null;
+
+function startLiveDashboard() {
+    if (!window.EventSource || liveSource) {
+        return;
+    }
+    // One long-lived connection; EventSource reconnects on its own and the
+    // server answers every (re)connect with a full snapshot
+    liveSource = new EventSource('/admin/api/stream');
+    liveSource.addEventListener('snapshot', event => applyLiveUpdate(JSON.parse(event.data), false));
+    liveSource.addEventListener('delta', event => applyLiveUpdate(JSON.parse(event.data), true));
+    setInterval(updateLiveAge, 1000);
+}
+
+function applyLiveUpdate(values, notify) {
+    Object.entries(values).forEach(([key, value]) => {
+        const previous = liveState[key];
+        if (value === null) {
+            delete liveState[key];
+        } else {
+            liveState[key] = value;
+        }
+
+        document.querySelectorAll(`[data-live="${key}"]`).forEach(element => {
+            element.textContent = value === null ? '-' : `${value}${element.dataset.liveSuffix || ''}`;
+            if (element.hasAttribute('data-live-rate') && value !== null) {
+                element.classList.toggle('text-success', value >= 80);
+                element.classList.toggle('text-warning', value >= 50 && value < 80);
+                element.classList.toggle('text-danger', value < 50);
+            }
+        });
+
+        const service = key.match(/^services\.(\w+)\.active$/);
+        if (service && value !== null) {
+            updateServiceStatus(service[1], value);
+            const toggle = document.querySelector(`[data-service="${service[1]}"] .form-check-input`);
+            if (toggle && !toggle.disabled) {
+                toggle.checked = value;
+            }
+            if (notify && previous !== undefined && previous !== value) {
+                showToast(`${service[1]} is now ${value ? 'active' : 'inactive'}`, value ? 'success' : 'warning');
+            }
+        }
+    });
+
+    const sessions = liveState['funnel.sessions'] || 1;
+    document.querySelectorAll('[data-live-bar]').forEach(bar => {
+        const reached = liveState[bar.dataset.liveBar] || 0;
+        bar.style.width = `${Math.min(100, Math.round(reached * 100 / sessions))}%`;
+    });
+
+    const active = name => liveState[`services.${name}.active`] === true;
+    if (['dhcp', 'tftp', 'nginx', 'web'].some(name => `services.${name}.active` in liveState)) {
+        document.querySelectorAll('[data-live-summary="active-services"]').forEach(element => {
+            element.textContent = ['dhcp', 'tftp', 'nginx', 'web'].filter(active).length;
+        });
+        document.querySelectorAll('[data-live-summary="server-status"]').forEach(element => {
+            element.innerHTML = ['dhcp', 'tftp', 'nginx'].every(active)
+                ? '<span class="text-green">Online</span>'
+                : '<span class="text-red">Degraded</span>';
+        });
+    }
+    updateLiveAge();
+}
+
+function updateLiveAge() {
+    const collectedAt = liveState['stats.collected_at'];
+    if (!collectedAt) {
+        return;
+    }
+    const age = Math.max(0, Math.floor(Date.now() / 1000 - collectedAt));
+    document.querySelectorAll('[data-live-age]').forEach(element => {
+        const stale = age > parseFloat(element.dataset.staleAfter || 'Infinity');
+        element.classList.toggle('text-warning', stale);
+        element.classList.toggle('text-secondary', !stale);
+        element.querySelector('.live-age').textContent = age;
+    });
+}
+
 // =============================================================================
 // Page Fade-In Animation
 // =============================================================================
@@ -350,6 +501,145 @@ function initPageAnimations() {
     });
 }
 
+// =============================================================================
+// Resumable Uploads
+// =============================================================================
+
+const UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 8;
+
+// Upload a File in chunks to /api/uploads; an interrupted chunk is retried
+// with backoff from the offset the server last committed.
+// options: {image: {id, field, name, category}, overwrite, onProgress(sent, total)}
+async function uploadFile(file, target, path, options = {}) {
+    const api = '/admin/api/uploads';
+    const onProgress = options.onProgress || function() {};
+
+    let response = await fetch(api, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            target: target,
+            path: path,
+            size: file.size,
+            overwrite: !!options.overwrite,
+            image: options.image
+        })
+    });
+    let data = await response.json();
+    if (!data.success) {
+        throw new Error(data.error);
+    }
+
+    const uploadId = data.upload.id;
+    let offset = 0;
+    let retries = 0;
+    onProgress(0, file.size);
+
+    while (offset < file.size) {
+        const chunk = file.slice(offset, offset + UPLOAD_CHUNK_SIZE);
+        try {
+            response = await fetch(`${api}/${uploadId}`, {
+                method: 'PATCH',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                    'Upload-Offset': String(offset)
+                },
+                body: chunk
+            });
+            data = await response.json();
+            if (response.status === 409 && data.offset !== undefined) {
+                // Server has a different offset (earlier chunk was lost): resume there
+                offset = data.offset;
+                continue;
+            }
+            if (!data.success) {
+                throw new Error(data.error);
+            }
+            offset = data.upload.offset;
+            retries = 0;
+            onProgress(offset, file.size);
+        } catch (error) {
+            if (++retries > UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, Math.min(30000, 1000 * 2 ** retries)));
+            // Ask where the server stands before sending again
+            const status = await fetch(`${api}/${uploadId}`).then(r => r.json()).catch(() => null);
+            if (status && status.success) {
+                offset = status.upload.offset;
+            }
+        }
+    }
+
+    response = await fetch(`${api}/${uploadId}/complete`, {method: 'POST'});
+    data = await response.json();
+    if (!data.success) {
+        throw new Error(data.error);
+    }
+    if (response.status === 202) {
+        // Another worker saw some chunks: the server finishes hashing in the background
+        return await waitForUploadJob(`${api}/jobs/${data.job.id}`);
+    }
+    return data;
+}
+
+async function waitForUploadJob(url) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        const data = await fetch(url).then(r => r.json()).catch(() => null);
+        if (!data) {
+            continue;
+        }
+        if (!data.success) {
+            throw new Error(data.error);
+        }
+        const job = data.job;
+        if (job.status === 'done') {
+            return {success: true, upload: job.upload, image: job.image};
+        }
+        if (job.status !== 'queued' && job.status !== 'running') {
+            throw new Error(job.error || `Upload ${job.status}`);
+        }
+    }
+}
+
+function bindUploadForm(form, buildRequest) {
+    const progress = form.querySelector('.upload-progress');
+    const bar = progress ? progress.querySelector('.progress-bar') : null;
+    const button = form.querySelector('button[type="submit"]');
+
+    form.addEventListener('submit', async function(event) {
+        event.preventDefault();
+        const file = form.querySelector('input[type="file"]').files[0];
+        if (!file) {
+            showToast('No file selected', 'warning');
+            return;
+        }
+        const request = buildRequest(file);
+        button.disabled = true;
+        if (progress) {
+            progress.classList.remove('d-none');
+        }
+        try {
+            await uploadFile(file, request.target, request.path, Object.assign({
+                onProgress: function(sent, total) {
+                    if (bar) {
+                        const percent = total ? Math.floor(sent * 100 / total) : 100;
+                        bar.style.width = `${percent}%`;
+                        bar.textContent = `${percent}%`;
+                    }
+                }
+            }, request.options || {}));
+            showToast(`${request.path} uploaded`, 'success');
+            setTimeout(() => location.reload(), 1000);
+        } catch (error) {
+            showToast(`Error: ${error.message}`, 'error');
+            button.disabled = false;
+        }
+    });
+}
+
 // =============================================================================
 // Initialize on DOM Ready
 // =============================================================================
@@ -0,0 +1,145 @@
+"""
+Kapadokya NetBoot - Stats Collector
+Refreshes dashboard statistics in the background and publishes a single
+snapshot file that every gunicorn worker reads instead of forking
+journalctl/systemctl/df on each request.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+class StatsCollector:
+    """Background collector with a snapshot shared between worker processes.
+
+    Each worker runs a collector thread, but only the one holding the lock
+    file actually refreshes; the others just read the published snapshot.
+    If the leader process dies its flock is released and another worker
+    takes over on its next tick.
+    """
+
+    def __init__(self, snapshot_path, sources, interval=15, on_refresh=None):
+        self.snapshot_path = Path(snapshot_path)
+        self.lock_path = self.snapshot_path.with_suffix('.lock')
+        self.sources = dict(sources)
+        self.interval = max(1, int(interval))
+        # Called with each published snapshot (e.g. to record history)
+        self.on_refresh = on_refresh
+        self._lock_fd = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._cache_key = None
+        self._cache = None
+
+    def start(self):
+        """Start the collector thread once per process"""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='knetboot-stats', daemon=True)
+            self._thread.start()
+
+    def _try_become_leader(self):
+        """Acquire the leader lock without blocking"""
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o664)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                if self._try_become_leader():
+                    self.refresh()
+            except Exception as e:
+                print(f"Error in stats collector: {e}")
+            time.sleep(self.interval)
+
+    def collect(self):
+        """Run every source and return a new snapshot dict"""
+        started = time.time()
+        data = {}
+        timings = {}
+        for name, source in self.sources.items():
+            t0 = time.monotonic()
+            try:
+                data[name] = source()
+            except Exception as e:
+                print(f"Error collecting {name}: {e}")
+                data[name] = None
+            timings[name] = round(time.monotonic() - t0, 4)
+        return {
+            'collected_at': started,
+            'interval': self.interval,
+            'durations': timings,
+            'data': data
+        }
+
+    def publish(self, snapshot):
+        """Atomically replace the snapshot file"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_path.parent, prefix='.stats-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.snapshot_path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def refresh(self):
+        """Collect and publish a snapshot, returning it"""
+        snapshot = self.collect()
+        self.publish(snapshot)
+        if self.on_refresh:
+            try:
+                self.on_refresh(snapshot)
+            except Exception as e:
+                print(f"Error recording stats snapshot: {e}")
+        return snapshot
+
+    def read(self):
+        """Return the latest snapshot, decorated with its age in seconds.
+
+        The parsed file is memoised on (mtime, size) so repeated reads cost a
+        single stat() call. If nothing has been published yet, the calling
+        worker collects synchronously once; only the leader publishes that
+        result (and passes it to on_refresh), so history never sees a
+        sample twice.
+        """
+        self.start()
+        try:
+            st = os.stat(self.snapshot_path)
+            key = (st.st_mtime_ns, st.st_size)
+            if key != self._cache_key:
+                with open(self.snapshot_path) as f:
+                    self._cache = json.load(f)
+                self._cache_key = key
+            snapshot = self._cache
+        except (OSError, ValueError):
+            if self._try_become_leader():
+                snapshot = self.refresh()
+            else:
+                snapshot = self.collect()
+
+        # Callers fill in defaults on data; keep those off the shared cache
+        result = dict(snapshot)
+        result['data'] = dict(snapshot['data'])
+        result['age'] = max(0.0, round(time.time() - snapshot['collected_at'], 1))
+        result['stale'] = result['age'] > 3 * self.interval
+        return result
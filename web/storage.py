@@ -0,0 +1,142 @@
+"""
+Kapadokya NetBoot - Storage Accounting
+Filesystem usage from os.statvfs and an index of the on-disk footprint of
+each image's kernel, initrd and squashfs, re-stat'ed at most every ttl seconds.
+"""
+
+import os
+import threading
+import time
+
+ASSET_FIELDS = ('kernel', 'initrd', 'squashfs')
+
+
+def format_bytes(num):
+    """Human readable size with binary units, e.g. 3.2G"""
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if abs(num) < 1024 or unit == 'T':
+            return f"{num:.0f}{unit}" if unit == 'B' else f"{num:.1f}{unit}"
+        num /= 1024.0
+
+
+def filesystem_usage(path):
+    """Usage of the filesystem holding path, in bytes (as df reports it)"""
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    free = st.f_bfree * st.f_frsize
+    available = st.f_bavail * st.f_frsize
+    used = total - free
+    # df computes Use% against the space usable by non-root users
+    usable = used + available
+    percent = int(-(-used * 100 // usable)) if usable else 0
+    return {
+        'path': str(path),
+        'device': os.stat(path).st_dev,
+        'total_bytes': total,
+        'used_bytes': used,
+        'available_bytes': available,
+        'percent': percent
+    }
+
+
+def get_storage_usage(paths):
+    """Usage for each named path, dropping paths that share a filesystem.
+
+    paths is an ordered {name: path} dict; the first name seen for a device
+    owns it and later names on the same device are listed in 'shared_with'.
+    """
+    filesystems = []
+    by_device = {}
+    for name, path in paths.items():
+        try:
+            usage = filesystem_usage(path)
+        except OSError:
+            continue
+        owner = by_device.get(usage['device'])
+        if owner is not None:
+            owner['shared_with'].append(name)
+            continue
+        usage['name'] = name
+        usage['shared_with'] = []
+        by_device[usage['device']] = usage
+        filesystems.append(usage)
+    return filesystems
+
+
+class AssetSizeIndex:
+    """Per-image on-disk bytes from a TTL cache of per-file stat results.
+
+    A file is only re-stat'ed once its entry is older than ttl seconds, so
+    rendering the Images page does not touch the asset tree at all within
+    that window; a replaced file shows its new size after at most ttl
+    seconds. The stat's (device, inode) lets files hardlinked between images
+    count once in the total.
+    """
+
+    def __init__(self, base_dir, ttl=30):
+        self.base_dir = base_dir
+        self.ttl = ttl
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, rel_path):
+        """Map an images.yaml asset path to an absolute path"""
+        return os.path.join(str(self.base_dir), rel_path)
+
+    def file_info(self, rel_path):
+        """Return cached (device, inode, mtime_ns, disk_bytes) or None if missing"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._files.get(rel_path)
+            if entry and now - entry[0] < self.ttl:
+                return entry[1]
+        try:
+            st = os.stat(self.resolve(rel_path))
+            info = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_blocks * 512)
+        except OSError:
+            info = None
+        with self._lock:
+            self._files[rel_path] = (now, info)
+        return info
+
+    def image_footprint(self, image):
+        """On-disk bytes of an image's assets and the list of missing ones"""
+        total = 0
+        missing = []
+        for field in ASSET_FIELDS:
+            rel_path = image.get(field)
+            if not rel_path:
+                continue
+            info = self.file_info(rel_path)
+            if info is None:
+                missing.append(field)
+            else:
+                total += info[3]
+        return {'bytes': total, 'size': format_bytes(total), 'missing': missing}
+
+    def catalog_footprint(self, images):
+        """Per-image footprint plus the deduplicated total for the catalog"""
+        per_image = {}
+        seen = set()
+        referenced = set()
+        total = 0
+        for image in images:
+            per_image[image.get('id')] = self.image_footprint(image)
+            for field in ASSET_FIELDS:
+                rel_path = image.get(field)
+                if rel_path:
+                    referenced.add(rel_path)
+                info = self.file_info(rel_path) if rel_path else None
+                if info and (info[0], info[1]) not in seen:
+                    seen.add((info[0], info[1]))
+                    total += info[3]
+        result = {
+            'images': per_image,
+            'total_bytes': total,
+            'total_size': format_bytes(total)
+        }
+        # Forget files no image refers to any more (removed or renamed assets)
+        with self._lock:
+            for rel_path in [p for p in self._files if p not in referenced]:
+                del self._files[rel_path]
+        return result
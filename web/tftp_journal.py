@@ -0,0 +1,171 @@
+"""
+Kapadokya NetBoot - TFTP Journal Ingestion
+Keeps today's TFTP boot counters up to date by reading only the journal
+entries written since the last stored cursor.
+"""
+
+import fcntl
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime
+
+from metrics import metrics
+
+RRQ_FILE_RE = re.compile(r'RRQ.*?([a-zA-Z0-9_\-\.]+\.(kpxe|efi|ipxe))')
+
+# Histogram size cap; requests for further files are counted under OTHER_FILES
+MAX_TRACKED_FILES = 256
+OTHER_FILES = '(other)'
+
+
+def _empty_state(day):
+    return {
+        'day': day,
+        'cursor': None,
+        'boot_attempts': 0,
+        'successful': 0,
+        'files': {}
+    }
+
+
+class TftpJournal:
+    """Incremental RRQ/sent counters backed by a small JSON state file"""
+
+    def __init__(self, state_path, unit='tftpd-hpa', timeout=10):
+        self.state_path = state_path
+        self.lock_path = f"{state_path}.lock"
+        self.unit = unit
+        self.timeout = timeout
+
+    def load_state(self):
+        """Load persisted counters, resetting them if the day rolled over"""
+        today = date.today().isoformat()
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return _empty_state(today)
+        if state.get('day') != today:
+            # Keep the cursor so yesterday's tail is not re-read
+            fresh = _empty_state(today)
+            fresh['cursor'] = state.get('cursor')
+            return fresh
+        return state
+
+    def save_state(self, state):
+        """Atomically write the state file"""
+        directory = os.path.dirname(self.state_path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tftp-journal-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _journal_command(self, cursor):
+        cmd = ['journalctl', '-u', self.unit, '--no-pager', '-o', 'json',
+               '--output-fields=MESSAGE,__REALTIME_TIMESTAMP,__CURSOR']
+        if cursor:
+            cmd += ['--after-cursor', cursor]
+        else:
+            cmd += ['--since', 'today']
+        return cmd
+
+    def ingest_entry(self, state, entry, midnight_us):
+        """Fold a single journal entry into the counters"""
+        try:
+            if int(entry.get('__REALTIME_TIMESTAMP', 0)) < midnight_us:
+                return
+        except ValueError:
+            pass
+
+        message = entry.get('MESSAGE') or ''
+        if isinstance(message, list):
+            # journald emits non-UTF-8 messages as byte arrays
+            message = bytes(message).decode('utf-8', 'replace')
+
+        lower = message.lower()
+        is_rrq = 'RRQ' in message
+        is_sent = 'sent' in lower
+
+        if is_rrq or is_sent:
+            state['boot_attempts'] += 1
+        if is_sent and ('kpxe' in lower or 'efi' in lower):
+            state['successful'] += 1
+
+        if is_rrq:
+            match = RRQ_FILE_RE.search(message)
+            if match:
+                files = state['files']
+                name = match.group(1)
+                if name not in files and len(files) >= MAX_TRACKED_FILES:
+                    name = OTHER_FILES
+                files[name] = files.get(name, 0) + 1
+
+    def refresh(self):
+        """Read new journal entries and return the updated state.
+
+        Output is streamed line by line so memory stays flat however many
+        entries arrived; if the timeout hits, the counters and cursor up to
+        the last processed entry are kept and the rest is read next time.
+        """
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.load_state()
+            midnight = datetime.combine(date.today(), datetime.min.time())
+            midnight_us = int(midnight.timestamp() * 1_000_000)
+            started = time.monotonic()
+            deadline = started + self.timeout
+
+            process = subprocess.Popen(
+                self._journal_command(state['cursor']),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            )
+            entries = 0
+            try:
+                for line in process.stdout:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries += 1
+                    self.ingest_entry(state, entry, midnight_us)
+                    state['cursor'] = entry.get('__CURSOR', state['cursor'])
+                    if time.monotonic() > deadline:
+                        print("Timeout while reading TFTP journal, continuing next refresh")
+                        process.kill()
+                        break
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                returncode = process.wait()
+                metrics.observe('knetboot_subprocess_duration_seconds', time.monotonic() - started,
+                                command='journalctl')
+
+            if returncode not in (0, -9) and entries == 0 and state['cursor']:
+                # Cursor no longer valid (journal rotated/vacuumed): recount today
+                print("TFTP journal cursor rejected, recounting from midnight")
+                state = _empty_state(state['day'])
+
+            self.save_state(state)
+            return state
+
+    def get_stats(self):
+        """Return boot counters in the shape used by get_boot_statistics()"""
+        state = self.refresh()
+        total = state['boot_attempts']
+        successful = state['successful']
+        files = {k: v for k, v in state['files'].items() if k != OTHER_FILES}
+        return {
+            'total_boots_today': total,
+            'successful_boots': successful,
+            'failed_boots': max(0, total - successful),
+            'success_rate': int((successful / total) * 100) if total > 0 else 0,
+            'most_used_image': max(files, key=files.get) if files else 'N/A',
+            'file_requests': state['files']
+        }
@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+"""
+Kapadokya NetBoot - TFTP Server
+Optional read-only asyncio TFTP engine for TFTP_ROOT, an alternative to
+tftpd-hpa. Negotiates blksize (RFC 2348), tsize and timeout (RFC 2349)
+and windowsize (RFC 7440) through OACK (RFC 2347), serves boot files
+from an in-memory cache and writes per-transfer statistics to a JSON
+file that the web UI reads for its boot counters.
+
+Usage: python3 tftp_server.py --root /srv/tftp --address 0.0.0.0:69
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import date
+
+RRQ, WRQ, DATA, ACK, ERROR, OACK = 1, 2, 3, 4, 5, 6
+
+ERR_UNDEFINED = 0
+ERR_NOT_FOUND = 1
+ERR_ACCESS = 2
+ERR_ILLEGAL = 4
+ERR_UNKNOWN_TID = 5
+ERR_OPTION = 8
+
+DEFAULT_BLKSIZE = 512
+MIN_BLKSIZE = 8
+MAX_BLKSIZE = 65464
+DEFAULT_TIMEOUT = 1.0
+MAX_RETRIES = 5
+MAX_WINDOWSIZE = 64
+# A window is sent as one burst; larger bursts overflow a default-sized
+# (~208 KiB) UDP receive buffer and lose their tail every time
+MAX_WINDOW_BYTES = 64 * 1024
+
+CACHE_BYTES = 256 * 1024 * 1024
+CACHE_FILE_BYTES = 64 * 1024 * 1024
+
+STATS_FLUSH_INTERVAL = 2.0
+RECENT_TRANSFERS = 50
+
+# Histogram size cap, as in tftp_journal
+MAX_TRACKED_FILES = 256
+OTHER_FILES = '(other)'
+
+
+def error_packet(code, message):
+    return struct.pack('!HH', ERROR, code) + message.encode('ascii', 'replace') + b'\0'
+
+
+def parse_request(packet):
+    """Split a RRQ/WRQ into (filename, mode, {option: value}); raises ValueError"""
+    fields = packet[2:].split(b'\0')
+    if len(fields) < 3 or fields[-1] != b'':
+        raise ValueError('malformed request')
+    fields = [f.decode('ascii', 'replace') for f in fields[:-1]]
+    filename, mode = fields[0], fields[1].lower()
+    if not filename or mode not in ('octet', 'netascii'):
+        raise ValueError(f'unsupported mode: {mode}')
+    options = {}
+    for name, value in zip(fields[2::2], fields[3::2]):
+        options[name.lower()] = value
+    return filename, mode, options
+
+
+def negotiate(options, size, max_blksize=MAX_BLKSIZE, max_windowsize=MAX_WINDOWSIZE):
+    """Return (accepted options for the OACK, blksize, windowsize, timeout).
+
+    Unknown or out-of-range options are left out of the OACK, which per
+    RFC 2347 means the client falls back to the default for them. The
+    windowsize is lowered so one window stays within MAX_WINDOW_BYTES.
+    """
+    accepted = {}
+    blksize, windowsize, timeout = DEFAULT_BLKSIZE, 1, DEFAULT_TIMEOUT
+
+    value = options.get('blksize', '')
+    if value.isdigit() and int(value) >= MIN_BLKSIZE:
+        blksize = min(int(value), max_blksize)
+        accepted['blksize'] = str(blksize)
+
+    if options.get('tsize', '').isdigit():
+        accepted['tsize'] = str(size)
+
+    value = options.get('timeout', '')
+    if value.isdigit() and 1 <= int(value) <= 255:
+        timeout = float(value)
+        accepted['timeout'] = value
+
+    value = options.get('windowsize', '')
+    if value.isdigit() and 1 <= int(value) <= 65535:
+        windowsize = max(1, min(int(value), max_windowsize, MAX_WINDOW_BYTES // (blksize + 4)))
+        accepted['windowsize'] = str(windowsize)
+
+    return accepted, blksize, windowsize, timeout
+
+
+def to_netascii(data):
+    return data.replace(b'\r', b'\r\0').replace(b'\n', b'\r\n')
+
+
+class FileCache:
+    """Boot file contents kept in memory, revalidated by (inode, mtime, size).
+
+    Files larger than max_file_bytes are not cached; they are read block
+    by block with os.pread instead. Least recently used files are dropped
+    once the cache holds more than max_bytes. open() does blocking file
+    I/O and is called from worker threads, so the index is locked.
+    """
+
+    def __init__(self, root, max_bytes=CACHE_BYTES, max_file_bytes=CACHE_FILE_BYTES):
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._files = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, filename):
+        """Map a requested name to a path under root, or None if it escapes it.
+
+        Like tftpd-hpa --secure, absolute names are taken relative to root.
+        """
+        filename = filename.replace('\\', '/')
+        if filename.startswith(self.root + '/'):
+            filename = filename[len(self.root):]
+        path = os.path.realpath(os.path.join(self.root, filename.lstrip('/')))
+        if path.startswith(self.root + os.sep):
+            return path
+        return None
+
+    def open(self, path):
+        """Return (data or None, size) for path; raises OSError"""
+        st = os.stat(path)
+        if not os.path.isfile(path):
+            raise IsADirectoryError(path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._files.get(path)
+            if entry and entry[0] == key:
+                self._files.move_to_end(path)
+                return entry[1], st.st_size
+            if entry:
+                self._drop(path)
+        if st.st_size > self.max_file_bytes:
+            return None, st.st_size
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            if path in self._files:
+                self._drop(path)
+            self._files[path] = (key, data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                self._drop(next(iter(self._files)))
+        return data, len(data)
+
+    def _drop(self, path):
+        _, data = self._files.pop(path)
+        self._bytes -= len(data)
+
+    def load(self, path, mode):
+        """open() plus netascii conversion, for use off the event loop"""
+        data, size = self.open(path)
+        if mode == 'netascii':
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            data = to_netascii(data)
+            size = len(data)
+        return data, size
+
+    def stats(self):
+        return {'files': len(self._files), 'bytes': self._bytes}
+
+
+class TransferStats:
+    """Today's transfer counters, flushed periodically to a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.time()
+        self.active = 0
+        self._dirty = False
+        self._state = self._load()
+
+    def _empty(self):
+        return {
+            'day': date.today().isoformat(),
+            'boot_attempts': 0,
+            'successful': 0,
+            'failed': 0,
+            'bytes': 0,
+            'retransmits': 0,
+            'files': {},
+            'recent': []
+        }
+
+    def _load(self):
+        """Continue today's counters after a restart"""
+        state = self._empty()
+        if not self.path:
+            return state
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return state
+        if saved.get('day') == state['day']:
+            for key in state:
+                state[key] = saved.get(key, state[key])
+        return state
+
+    def _today(self):
+        if self._state['day'] != date.today().isoformat():
+            self._state = self._empty()
+        return self._state
+
+    def request(self, filename):
+        """Count an RRQ"""
+        state = self._today()
+        state['boot_attempts'] += 1
+        files = state['files']
+        if filename not in files and len(files) >= MAX_TRACKED_FILES:
+            filename = OTHER_FILES
+        files[filename] = files.get(filename, 0) + 1
+        self._dirty = True
+
+    def finished(self, record):
+        """Fold one finished transfer into the counters"""
+        state = self._today()
+        state['successful' if record['status'] == 'ok' else 'failed'] += 1
+        state['bytes'] += record['bytes']
+        state['retransmits'] += record['retransmits']
+        recent = deque(state['recent'], maxlen=RECENT_TRANSFERS)
+        recent.append(record)
+        state['recent'] = list(recent)
+        self._dirty = True
+
+    def snapshot(self):
+        return dict(self._today(), active=self.active, started_at=self.started_at,
+                    updated_at=time.time())
+
+    def flush(self, force=False):
+        if not self.path or not (self._dirty or force):
+            return
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tftp-transfers-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            print(f"Error writing TFTP statistics: {e}")
+
+
+def read_transfer_stats(path):
+    """Built-in server counters in the shape of TftpJournal.get_stats()"""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    if state.get('day') != date.today().isoformat():
+        state = {}
+    total = state.get('boot_attempts', 0)
+    successful = state.get('successful', 0)
+    files = {k: v for k, v in state.get('files', {}).items() if k != OTHER_FILES}
+    return {
+        'total_boots_today': total,
+        'successful_boots': successful,
+        'failed_boots': state.get('failed', 0),
+        'success_rate': int((successful / total) * 100) if total > 0 else 0,
+        'most_used_image': max(files, key=files.get) if files else 'N/A',
+        'file_requests': state.get('files', {}),
+        'tftp_bytes': state.get('bytes', 0),
+        'tftp_retransmits': state.get('retransmits', 0),
+        'tftp_active': state.get('active', 0),
+        'recent_transfers': state.get('recent', [])
+    }
+
+
+class Transfer(asyncio.DatagramProtocol):
+    """One RRQ served from its own ephemeral port (the server TID).
+
+    Blocks are sent a window at a time; the client acknowledges the last
+    block it received in order and the next window starts after it. A
+    window is resent from the first unacknowledged block on timeout, or
+    once per window base on a duplicate ACK: every block of that resend
+    can trigger another duplicate ACK, and answering each of those would
+    turn one lost block into a retransmission storm.
+    """
+
+    def __init__(self, server, peer, filename, data, path, size,
+                 accepted, blksize, windowsize, timeout):
+        self.server = server
+        self.peer = peer
+        self.filename = filename
+        self.data = data
+        self.path = path
+        self.size = size
+        self.accepted = accepted
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.timeout = timeout
+        self.last_block = size // blksize + 1
+        self.base = 1
+        self.sent_upto = 0
+        # Window base already resent for a duplicate ACK (until the timer fires)
+        self.resent_base = None
+        self.awaiting_oack = bool(accepted)
+        self.retries = 0
+        self.retransmits = 0
+        self.started = time.monotonic()
+        self.transport = None
+        self.timer = None
+        self.fd = None
+        self.done = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.data is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        if self.awaiting_oack:
+            self.send_oack()
+        else:
+            self.send_window()
+
+    def block(self, number):
+        offset = (number - 1) * self.blksize
+        length = max(0, min(self.blksize, self.size - offset))
+        if self.data is not None:
+            payload = self.data[offset:offset + length]
+        else:
+            payload = os.pread(self.fd, length, offset)
+        return struct.pack('!HH', DATA, number & 0xFFFF) + payload
+
+    def send_oack(self):
+        packet = struct.pack('!H', OACK)
+        for name, value in self.accepted.items():
+            packet += name.encode() + b'\0' + value.encode() + b'\0'
+        self.transport.sendto(packet, self.peer)
+        self.arm_timer()
+
+    def send_window(self):
+        last = min(self.base + self.windowsize - 1, self.last_block)
+        for number in range(self.base, last + 1):
+            if number <= self.sent_upto:
+                self.retransmits += 1
+            self.transport.sendto(self.block(number), self.peer)
+        self.sent_upto = max(self.sent_upto, last)
+        self.arm_timer()
+
+    def arm_timer(self):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(self.timeout, self.on_timeout)
+
+    def on_timeout(self):
+        self.retries += 1
+        self.resent_base = None
+        if self.retries > MAX_RETRIES:
+            self.finish('timeout')
+        elif self.awaiting_oack:
+            self.retransmits += 1
+            self.send_oack()
+        else:
+            self.send_window()
+
+    def datagram_received(self, packet, addr):
+        if addr != self.peer:
+            self.transport.sendto(error_packet(ERR_UNKNOWN_TID, 'Unknown transfer ID'), addr)
+            return
+        if len(packet) < 4:
+            return
+        opcode, number = struct.unpack('!HH', packet[:4])
+        if opcode == ERROR:
+            self.finish('client error')
+        elif opcode == ACK:
+            self.on_ack(number)
+        else:
+            self.transport.sendto(error_packet(ERR_ILLEGAL, 'Illegal TFTP operation'), self.peer)
+            self.finish('illegal operation')
+
+    def on_ack(self, number):
+        if self.awaiting_oack:
+            if number == 0:
+                self.awaiting_oack = False
+                self.retries = 0
+                self.send_window()
+            return
+        # Map the 16-bit block number onto the window (block numbers roll over)
+        acked = self.base - 1 + ((number - (self.base - 1)) & 0xFFFF)
+        if acked > self.sent_upto:
+            return
+        if acked == self.last_block:
+            self.finish('ok')
+            return
+        if acked >= self.base:
+            self.base = acked + 1
+            self.retries = 0
+            self.send_window()
+        elif (self.windowsize > 1 and acked == self.base - 1 and self.sent_upto >= self.base
+              and self.resent_base != self.base):
+            # Client saw a gap in the window: resend it from the first missing block
+            self.resent_base = self.base
+            self.send_window()
+
+    def finish(self, status):
+        if self.done:
+            return
+        self.done = True
+        if self.timer:
+            self.timer.cancel()
+        if self.fd is not None:
+            os.close(self.fd)
+        self.transport.close()
+        delivered = self.size if status == 'ok' else min(self.size, (self.base - 1) * self.blksize)
+        self.server.transfer_finished({
+            'client': self.peer[0],
+            'port': self.peer[1],
+            'file': self.filename,
+            'status': status,
+            'bytes': delivered,
+            'size': self.size,
+            'duration_ms': round((time.monotonic() - self.started) * 1000, 3),
+            'retransmits': self.retransmits,
+            'blksize': self.blksize,
+            'windowsize': self.windowsize,
+            'finished_at': time.time()
+        })
+
+    def error_received(self, exc):
+        self.finish(f'socket error: {exc}')
+
+
+class TftpServer(asyncio.DatagramProtocol):
+    """Listener on port 69 that starts a Transfer for every RRQ"""
+
+    def __init__(self, root, stats_path=None, host='0.0.0.0', cache=None,
+                 max_blksize=MAX_BLKSIZE, max_windowsize=MAX_WINDOWSIZE, on_transfer=None):
+        self.host = host
+        self.cache = cache or FileCache(root)
+        self.stats = TransferStats(stats_path)
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.on_transfer = on_transfer
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        self.stats.flush()
+        asyncio.get_running_loop().call_later(STATS_FLUSH_INTERVAL, self.schedule_flush)
+
+    def datagram_received(self, packet, addr):
+        if len(packet) < 2:
+            return
+        opcode = struct.unpack('!H', packet[:2])[0]
+        if opcode == RRQ:
+            asyncio.ensure_future(self.start_transfer(packet, addr))
+        elif opcode == WRQ:
+            self.transport.sendto(error_packet(ERR_ACCESS, 'Server is read-only'), addr)
+        else:
+            self.transport.sendto(error_packet(ERR_ILLEGAL, 'Illegal TFTP operation'), addr)
+
+    async def reply_error(self, addr, code, message):
+        """Send an error from a fresh TID, as tftpd-hpa does"""
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            asyncio.DatagramProtocol, local_addr=(self.host, 0))
+        transport.sendto(error_packet(code, message), addr)
+        transport.close()
+
+    async def start_transfer(self, packet, addr):
+        try:
+            filename, mode, options = parse_request(packet)
+        except ValueError as e:
+            await self.reply_error(addr, ERR_ILLEGAL, str(e))
+            return
+
+        self.stats.request(filename)
+        path = self.cache.resolve(filename)
+        if path is None:
+            self.transfer_failed(addr, filename, 'access violation')
+            await self.reply_error(addr, ERR_ACCESS, 'Access violation')
+            return
+        try:
+            # Cache misses read up to CACHE_FILE_BYTES; keep that off the loop
+            data, size = await asyncio.to_thread(self.cache.load, path, mode)
+        except OSError:
+            self.transfer_failed(addr, filename, 'not found')
+            await self.reply_error(addr, ERR_NOT_FOUND, 'File not found')
+            return
+
+        accepted, blksize, windowsize, timeout = negotiate(
+            options, size, self.max_blksize, self.max_windowsize)
+        transfer = Transfer(self, addr, filename, data, path, size,
+                            accepted, blksize, windowsize, timeout)
+        self.stats.active += 1
+        try:
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: transfer, local_addr=(self.host, 0))
+        except OSError as e:
+            self.stats.active -= 1
+            self.transfer_failed(addr, filename, f'socket error: {e}')
+
+    def transfer_failed(self, addr, filename, status):
+        self.stats.finished({
+            'client': addr[0],
+            'port': addr[1],
+            'file': filename,
+            'status': status,
+            'bytes': 0,
+            'size': 0,
+            'duration_ms': 0,
+            'retransmits': 0,
+            'blksize': DEFAULT_BLKSIZE,
+            'windowsize': 1,
+            'finished_at': time.time()
+        })
+
+    def transfer_finished(self, record):
+        self.stats.active -= 1
+        self.stats.finished(record)
+        if self.on_transfer:
+            self.on_transfer(record)
+
+
+async def serve(root, host='0.0.0.0', port=69, stats_path=None, **kwargs):
+    """Bind the listener and return (transport, server)"""
+    server = TftpServer(root, stats_path=stats_path, host=host, **kwargs)
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: server, local_addr=(host, port))
+    return transport, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Kapadokya NetBoot TFTP server')
+    parser.add_argument('--root', default='/srv/tftp', help='directory to serve (default: /srv/tftp)')
+    parser.add_argument('--address', default='0.0.0.0:69', help='listen address (default: 0.0.0.0:69)')
+    parser.add_argument('--stats', default='/run/knetboot/tftp-transfers.json',
+                        help='statistics file read by the web UI')
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BYTES // (1024 * 1024),
+                        help='in-memory file cache size in MiB')
+    parser.add_argument('--max-blksize', type=int, default=MAX_BLKSIZE)
+    parser.add_argument('--max-windowsize', type=int, default=MAX_WINDOWSIZE)
+    args = parser.parse_args()
+
+    host, _, port = args.address.rpartition(':')
+    cache = FileCache(args.root, max_bytes=args.cache_mb * 1024 * 1024)
+
+    async def run():
+        transport, server = await serve(args.root, host or '0.0.0.0', int(port), args.stats, cache=cache,
+                                        max_blksize=args.max_blksize,
+                                        max_windowsize=args.max_windowsize)
+        print(f"Serving {args.root} on {args.address}")
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        try:
+            await stop.wait()
+        finally:
+            server.stats.flush(force=True)
+            transport.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+Kapadokya NetBoot - Resumable Uploads
+Chunked uploads streamed straight into ASSETS_DIR or TFTP_ROOT. Each
+upload writes to a hidden .part file next to its destination, keeps a
+rolling SHA-256 while chunks arrive and is renamed into place once the
+last byte is in. Targets the web user cannot write (the TFTP root) are
+staged in a directory of its own and handed to an installer instead.
+Upload state lives in small JSON files, so a transfer interrupted on one
+gunicorn worker resumes on any other. When the worker that gets the
+final request has not seen every chunk, hashing and installing run as
+a background job instead of re-reading the file inside the request.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+from jobs import BackgroundJobs
+
+IO_CHUNK = 1024 * 1024
+# Largest body accepted per PATCH; keeps each request well inside the
+# gunicorn worker timeout
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+# Abandoned uploads are removed after this long without a chunk
+UPLOAD_EXPIRY_SECONDS = 24 * 3600
+
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+PATH_RE = re.compile(r'^[\w.+-]+(/[\w.+-]+)*$')
+
+
+class UploadError(Exception):
+    """Rejected upload request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+
+class UploadManager:
+    """Create, append to, finish and abort resumable uploads.
+
+    targets maps a target name ('assets', 'tftp') to its root directory.
+    installers maps a target name to install(part_path, upload); those
+    targets are staged under staging_dir rather than written in place.
+    The rolling hash is kept per process and only extended while it is at
+    the committed offset; requests never re-read the .part file. A worker
+    whose hash fell behind drops it, and complete() then catches up from
+    the file (in a background job, see UploadJobs).
+    """
+
+    def __init__(self, state_dir, targets, staging_dir=None, installers=None):
+        self.state_dir = str(state_dir)
+        self.targets = {name: os.path.realpath(str(root)) for name, root in targets.items()}
+        self.staging_dir = str(staging_dir) if staging_dir else None
+        self.installers = installers or {}
+        self._hashers = {}
+        self._lock = threading.Lock()
+
+    # State ------------------------------------------------------------------
+
+    def _state_path(self, upload_id):
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            raise UploadError('Upload not found', 404)
+        return os.path.join(self.state_dir, f'{upload_id}.json')
+
+    def get(self, upload_id):
+        try:
+            with open(self._state_path(upload_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise UploadError('Upload not found', 404)
+
+    def _save(self, upload):
+        os.makedirs(self.state_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, prefix='.upload-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(upload, f)
+        os.replace(tmp_path, self._state_path(upload['id']))
+
+    def _forget(self, upload_id):
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        try:
+            os.unlink(self._state_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def resolve(self, target, rel_path):
+        """Absolute destination for rel_path under a target root"""
+        root = self.targets.get(target)
+        if root is None:
+            raise UploadError(f'Unknown upload target: {target}')
+        rel_path = (rel_path or '').strip('/')
+        if not PATH_RE.match(rel_path) or any(part in ('.', '..') or part.startswith('.')
+                                             for part in rel_path.split('/')):
+            raise UploadError(f'Invalid path: {rel_path}')
+        path = os.path.realpath(os.path.join(root, rel_path))
+        if not path.startswith(root + os.sep):
+            raise UploadError(f'Invalid path: {rel_path}')
+        return path
+
+    # Lifecycle --------------------------------------------------------------
+
+    def create(self, target, rel_path, size, sha256=None, overwrite=False, register=None):
+        """Start an upload and return its state"""
+        if not isinstance(size, int) or size < 0:
+            raise UploadError('size must be a non-negative integer')
+        if sha256 is not None and not re.match(r'^[0-9a-fA-F]{64}$', str(sha256)):
+            raise UploadError('sha256 must be 64 hex characters')
+        path = self.resolve(target, rel_path)
+        if os.path.exists(path) and not overwrite:
+            raise UploadError(f'{rel_path} already exists', 409)
+
+        upload = {
+            'id': secrets.token_hex(16),
+            'target': target,
+            'path': rel_path.strip('/'),
+            'size': size,
+            'offset': 0,
+            'expected_sha256': sha256.lower() if sha256 else None,
+            'overwrite': bool(overwrite),
+            'register': register,
+            'created_at': time.time(),
+            'updated_at': time.time()
+        }
+        part_path = self._part_path(upload)
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        with open(part_path, 'wb'):
+            pass
+        self._save(upload)
+        return upload
+
+    def _part_path(self, upload):
+        path = self.resolve(upload['target'], upload['path'])
+        if upload['target'] in self.installers:
+            return os.path.join(self.staging_dir, f".{upload['id']}.part")
+        return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{upload['id']}.part")
+
+    def hash_ready(self, upload):
+        """Whether this worker's rolling hash covers every committed byte"""
+        with self._lock:
+            offset, _ = self._hashers.get(upload['id'], (0, None))
+        return offset == upload['offset']
+
+    def _current_hasher(self, upload):
+        """This worker's rolling hash if it is at the committed offset, else None.
+
+        The hash is taken out of the cache while in use and only put back
+        once a chunk is committed, so a failed chunk cannot leave it ahead
+        of the file.
+        """
+        with self._lock:
+            offset, sha = self._hashers.pop(upload['id'], (0, hashlib.sha256()))
+        return sha if offset == upload['offset'] else None
+
+    def _hasher(self, upload, part_path, progress=None):
+        """A hash of the committed bytes, reading from the .part file what this worker missed"""
+        with self._lock:
+            offset, sha = self._hashers.pop(upload['id'], (0, hashlib.sha256()))
+        if offset > upload['offset']:
+            offset, sha = 0, hashlib.sha256()
+        if offset < upload['offset']:
+            with open(part_path, 'rb') as f:
+                f.seek(offset)
+                remaining = upload['offset'] - offset
+                while remaining:
+                    chunk = f.read(min(IO_CHUNK, remaining))
+                    if not chunk:
+                        raise UploadError('Partial file is shorter than recorded', 500)
+                    sha.update(chunk)
+                    remaining -= len(chunk)
+                    if progress:
+                        progress(len(chunk))
+            offset = upload['offset']
+        return offset, sha
+
+    def append(self, upload_id, offset, stream, length):
+        """Write length bytes from stream at offset; returns the new state.
+
+        The offset must match the committed one (HTTP 409 with the current
+        offset otherwise), which is how clients find where to resume.
+        """
+        upload = self.get(upload_id)
+        if length > MAX_CHUNK_BYTES:
+            raise UploadError(f'Chunk larger than {MAX_CHUNK_BYTES} bytes', 413)
+        part_path = self._part_path(upload)
+        try:
+            f = open(part_path, 'r+b')
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Another chunk is being written', 409, offset=upload['offset'])
+            # Re-read under the lock: another worker may have committed a chunk
+            upload = self.get(upload_id)
+            if offset != upload['offset']:
+                raise UploadError('Offset mismatch', 409, offset=upload['offset'])
+            if offset + length > upload['size']:
+                raise UploadError('Chunk goes past the declared size', 400)
+
+            sha = self._current_hasher(upload)
+            # Drop bytes of an earlier chunk that was cut off mid-request
+            f.truncate(offset)
+            f.seek(offset)
+            written = 0
+            while written < length:
+                chunk = stream.read(min(IO_CHUNK, length - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                if sha:
+                    sha.update(chunk)
+                written += len(chunk)
+            f.flush()
+
+            if written < length:
+                # Client went away; keep nothing past the committed offset
+                f.truncate(offset)
+                raise UploadError('Incomplete chunk', 400, offset=offset)
+
+            os.fsync(f.fileno())
+            upload['offset'] = offset + written
+            upload['updated_at'] = time.time()
+            self._save(upload)
+            if sha:
+                with self._lock:
+                    self._hashers[upload_id] = (upload['offset'], sha)
+        return upload
+
+    def complete(self, upload_id, progress=None):
+        """Verify size and checksum, then rename the file into place.
+
+        Hashes whatever this worker has not seen yet, reporting
+        progress(nbytes); callers that must not block use UploadJobs
+        unless hash_ready().
+        """
+        upload = self.get(upload_id)
+        if upload['offset'] != upload['size']:
+            raise UploadError('Upload is not complete', 409, offset=upload['offset'])
+        path = self.resolve(upload['target'], upload['path'])
+        part_path = self._part_path(upload)
+        try:
+            f = open(part_path, 'rb')
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Upload is already being completed', 409, offset=upload['offset'])
+            return self._finish(upload, path, part_path, progress)
+
+    def _finish(self, upload, path, part_path, progress):
+        upload_id = upload['id']
+        _, sha = self._hasher(upload, part_path, progress)
+        digest = sha.hexdigest()
+        if upload['expected_sha256'] and digest != upload['expected_sha256']:
+            self.abort(upload_id)
+            raise UploadError('Checksum mismatch, upload discarded', 422, sha256=digest)
+        if os.path.exists(path) and not upload['overwrite']:
+            raise UploadError(f"{upload['path']} already exists", 409)
+
+        install = self.installers.get(upload['target'])
+        if install:
+            # The part file stays for a retry if the installer fails
+            install(part_path, upload)
+            os.unlink(part_path)
+        else:
+            os.chmod(part_path, 0o644)
+            os.replace(part_path, path)
+        self._forget(upload_id)
+        return dict(upload, sha256=digest, completed_at=time.time())
+
+    def abort(self, upload_id):
+        upload = self.get(upload_id)
+        try:
+            os.unlink(self._part_path(upload))
+        except FileNotFoundError:
+            pass
+        self._forget(upload_id)
+
+    def uploads(self):
+        """Uploads in progress, dropping ones abandoned for too long"""
+        result = []
+        try:
+            names = os.listdir(self.state_dir)
+        except FileNotFoundError:
+            return result
+        now = time.time()
+        for name in names:
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            try:
+                upload = self.get(name[:-len('.json')])
+            except UploadError:
+                continue
+            if now - upload['updated_at'] > UPLOAD_EXPIRY_SECONDS:
+                self.abort(upload['id'])
+                continue
+            result.append(upload)
+        return result
+
+
+class UploadJobs(BackgroundJobs):
+    """Completion of uploads whose hash has to be caught up from the .part file.
+
+    on_complete(upload) runs after the file is in place and returns what
+    to store as the job's 'image' (catalog registration).
+    """
+
+    kind = 'upload'
+
+    def __init__(self, state_dir, manager, on_complete=None):
+        super().__init__(state_dir, workers=1)
+        self.manager = manager
+        self.on_complete = on_complete
+
+    def submit(self, upload_id):
+        """Queue completion of an upload; returns the job"""
+        upload = self.manager.get(upload_id)
+        if upload['offset'] != upload['size']:
+            raise UploadError('Upload is not complete', 409, offset=upload['offset'])
+        running = self.active(upload_id=upload_id)
+        if running:
+            return running[0]
+        return self.start(upload_id=upload_id, path=upload['path'], bytes_total=upload['size'])
+
+    def run(self, job, progress):
+        upload = self.manager.complete(job['upload_id'], progress=lambda n: progress('hash', n))
+        image = self.on_complete(upload) if self.on_complete else None
+        return {'upload': upload, 'image': image}